@@ -1,6 +1,7 @@
 """
 AI анализатор для подсчета калорий по фотографиям еды
 """
+import asyncio
 import openai
 import json
 import base64
@@ -11,6 +12,7 @@ import logging
 from food_database import food_database
 import hashlib
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -192,12 +194,15 @@ class CalorieAnalyzer:
 
     def __init__(self):
         self.client = openai.OpenAI(api_key=config.OPENAI_API_KEY)
+        # Свои потоки для анализа: синхронный клиент OpenAI и обработка фото
+        # не блокируют цикл событий и не занимают потоки для запросов к БД
+        self._executor = ThreadPoolExecutor(max_workers=config.AI_MAX_CONCURRENCY, thread_name_prefix='ai')
 
     def encode_image(self, image_bytes):
         """Кодирование изображения в base64"""
         return base64.b64encode(image_bytes).decode('utf-8')
 
-    def resize_image(self, image_bytes, max_size=1024):
+    def resize_image(self, image_bytes, max_size=config.AI_IMAGE_MAX_SIZE):
         """Изменение размера изображения для оптимизации"""
         try:
             image = Image.open(BytesIO(image_bytes))
@@ -226,11 +231,16 @@ class CalorieAnalyzer:
             return image_bytes
 
     async def analyze_food_image(self, image_bytes):
+        """Анализ изображения еды в отдельном потоке (см. _analyze_food_image_sync)"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._analyze_food_image_sync, image_bytes)
+
+    def _analyze_food_image_sync(self, image_bytes):
         """
         Анализ изображения еды и подсчет калорий
         
         Args:
-            image_bytes: Байты изображения
+            image_bytes: Байты изображения (bytes или bytearray)
             
         Returns:
             dict: Результат анализа с калориями и питательными веществами
@@ -305,10 +315,7 @@ class CalorieAnalyzer:
             return enhanced_result
             
         except Exception as e:
-            import traceback
-            error_details = traceback.format_exc()
-            logger.error(f"КРИТИЧЕСКАЯ ОШИБКА при анализе изображения: {e}")
-            logger.error(f"Полная трассировка: {error_details}")
+            logger.exception(f"КРИТИЧЕСКАЯ ОШИБКА при анализе изображения: {e}")
             
             # Возвращаем fallback результат вместо ошибки
             return self._create_fallback_result(f"Системная ошибка: {str(e)}")
@@ -2,21 +2,37 @@
 Основной файл телеграм-бота для подсчета калорий
 """
 import asyncio
+import bisect
 import logging
-import json
+import re
+import weakref
+import io
+import functools
+import hashlib
+import html
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
-import schedule
-import threading
-import time
-from io import BytesIO
+
+import aiohttp
+import orjson
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
 from telegram.constants import ParseMode
+from telegram.request import HTTPXRequest
+
+from sqlalchemy import text
 
 import config
-from database import DatabaseManager, create_tables
-from ai_analyzer import analyzer
+from database import (
+    DatabaseManager, session_scope, User, engine,
+    create_tables, migrate_telegram_id_if_needed,
+    get_user_today_date, get_user_day_end, has_completed_onboarding, IS_POSTGRES
+)
+from ai_analyzer import analyzer, translate_food_name
+from food_database import food_database
+from cache import profile_cache, redis_cache
 
 # Настройка логирования
 logging.basicConfig(
@@ -25,36 +41,595 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Ограничение одновременных анализов фото - защита от всплеска запросов к OpenAI
+_AI_SEMAPHORE = asyncio.Semaphore(config.AI_MAX_CONCURRENCY)
+
+# Блокировки чатов: при concurrent_updates обновления одного чата идут по очереди.
+# Слабые ссылки - блокировка живет, пока ее кто-то держит или ждет
+_CHAT_LOCKS = weakref.WeakValueDictionary()
+
+def serialized_per_chat(handler):
+    """Обработчик выполняется под блокировкой чата: разные чаты параллельно,
+    обновления одного чата (и его user_data, например waiting_for) - последовательно"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        chat = update.effective_chat
+        if chat is None:
+            return await handler(update, context)
+        lock = _CHAT_LOCKS.get(chat.id)
+        if lock is None:
+            lock = _CHAT_LOCKS[chat.id] = asyncio.Lock()
+        async with lock:
+            return await handler(update, context)
+    return wrapper
+
+# Общая HTTP-сессия для скачивания фото напрямую с файлового сервера Telegram
+_http_session = None
+
+def get_http_session():
+    """Возвращает общую aiohttp-сессию (создается при первом обращении)"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+    return _http_session
+
+def install_event_loop_policy():
+    """Цикл событий на uvloop (libuv) вместо стандартного selector-цикла, если uvloop доступен"""
+    try:
+        import uvloop
+    except ImportError:
+        logger.info("uvloop не установлен - используется стандартный цикл событий asyncio")
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logger.info("⚡ Цикл событий: uvloop")
+
+async def setup_db_executor(*_):
+    """Выделенный пул потоков для синхронных запросов к БД (asyncio.to_thread)"""
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=config.DB_THREAD_WORKERS, thread_name_prefix='db')
+    )
+
+class OrjsonHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest, разбирающий ответы Telegram через orjson (быстрее стандартного json)"""
+    
+    @staticmethod
+    def parse_json_payload(payload: bytes):
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            # Некорректный UTF-8 и прочие ошибки - стандартный разбор PTB с заменой символов
+            return HTTPXRequest.parse_json_payload(payload)
+
+def build_request(**kwargs):
+    """HTTP-клиент бота с orjson; пул соединений как у PTB по умолчанию (256)"""
+    kwargs.setdefault('connection_pool_size', 256)
+    return OrjsonHTTPXRequest(**kwargs)
+
+def build_rate_limiter():
+    """Ограничитель исходящих запросов к Telegram: ниже лимита 30 msg/s, с повтором после 429"""
+    return AIORateLimiter(overall_max_rate=28, overall_time_period=1, max_retries=3)
+
+async def close_shared_clients(*_):
+    """Закрывает общую aiohttp-сессию и соединения с Redis при остановке бота"""
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    await redis_cache.close()
+
+# Постоянная клавиатура главного меню
+_MAIN_KEYBOARD = ReplyKeyboardMarkup(
+    [
+        [
+            KeyboardButton("🍽️ Анализ еды"),
+            KeyboardButton("📊 Статистика")
+        ],
+        [
+            KeyboardButton("⚙️ Настройки"),
+            KeyboardButton("📅 История")
+        ],
+        [
+            KeyboardButton("🎯 Мои цели"),
+            KeyboardButton("❌ Отменить анализ")
+        ],
+        [
+            KeyboardButton("🏠 Главное меню"),
+            KeyboardButton("❓ Помощь")
+        ]
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=False,
+    input_field_placeholder="Отправьте фото еды или выберите действие..."
+)
+
+# Статические inline клавиатуры - собираются один раз при импорте модуля
+_HELP_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📸 Как отправить фото", callback_data="add_photo_tip"),
+        InlineKeyboardButton("🎯 Моя цель", callback_data="my_goal")
+    ],
+    [
+        InlineKeyboardButton("👤 Мой профиль", callback_data="profile"),
+        InlineKeyboardButton("📊 Статистика", callback_data="stats")
+    ],
+    [
+        InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")
+    ]
+])
+
+_STATS_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton(f"{config.EMOJIS['chart']} Подробная статистика", callback_data="detailed_stats")],
+    [InlineKeyboardButton(f"{config.EMOJIS['settings']} Настройки цели", callback_data="settings")],
+    [InlineKeyboardButton(f"{config.EMOJIS['back']} Главное меню", callback_data="main_menu")]
+])
+
+_SETTINGS_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🎯 Изменить цель калорий", callback_data="set_calorie_goal")],
+    [InlineKeyboardButton("🎯 Изменить цель по весу", callback_data="goals")],
+    [InlineKeyboardButton(f"{config.EMOJIS['scales']} Обновить вес", callback_data="set_weight")],
+    [InlineKeyboardButton("📏 Указать рост", callback_data="set_height")],
+    [InlineKeyboardButton("👤 Указать пол и возраст", callback_data="set_personal_info")],
+    [InlineKeyboardButton(f"{config.EMOJIS['back']} Назад", callback_data="main_menu")]
+])
+
+# Клавиатура с действиями после анализа фото
+_PHOTO_RESULT_MARKUP = InlineKeyboardMarkup([
+    # Первый ряд - уточнение калорий
+    [
+        InlineKeyboardButton("🔍 Уточнить калории", callback_data="refine_calories")
+    ],
+    # Второй ряд - основные действия
+    [
+        InlineKeyboardButton("📊 Посмотреть статистику", callback_data="stats"),
+        InlineKeyboardButton("👤 Мой профиль", callback_data="profile")
+    ],
+    # Третий ряд - редактирование и добавление
+    [
+        InlineKeyboardButton("🔧 Исправить анализ", callback_data="correct_analysis"),
+        InlineKeyboardButton("➕ Добавить еще блюдо", callback_data="add_more")
+    ],
+    # Четвертый ряд - навигация
+    [
+        InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")
+    ]
+])
+
+# Клавиатуры экранов настроек, исправления анализа и профиля
+_CANCEL_TO_SETTINGS_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton(f"{config.EMOJIS['back']} Отмена", callback_data="settings")]
+])
+
+_SETTINGS_SAVED_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton(f"{config.EMOJIS['settings']} Настройки", callback_data="settings")],
+    [InlineKeyboardButton(f"{config.EMOJIS['back']} Главное меню", callback_data="main_menu")]
+])
+
+_CANCEL_CORRECTION_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("❌ Отмена", callback_data="cancel_correction")]
+])
+
+_CORRECTION_DONE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton(f"{config.EMOJIS['stats']} Статистика", callback_data="stats")],
+    [InlineKeyboardButton(f"{config.EMOJIS['back']} Главное меню", callback_data="main_menu")]
+])
+
+_PROFILE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📅 История по дням", callback_data="daily_history")],
+    [InlineKeyboardButton("📊 Недельная статистика", callback_data="weekly_stats_detail")],
+    [InlineKeyboardButton("⚙️ Изменить параметры", callback_data="edit_profile")],
+    [InlineKeyboardButton(f"{config.EMOJIS['back']} Главное меню", callback_data="main_menu")]
+])
+
+_DAILY_HISTORY_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📊 Подробная статистика", callback_data="detailed_stats")],
+    [InlineKeyboardButton(f"{config.EMOJIS['back']} К профилю", callback_data="back_to_profile")]
+])
+
+_WEEKLY_DETAIL_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📅 История по дням", callback_data="daily_history")],
+    [InlineKeyboardButton(f"{config.EMOJIS['back']} К профилю", callback_data="back_to_profile")]
+])
+
+# Клавиатуры остальных экранов: экран -> ряды кнопок (текст, callback_data).
+# Разметка собирается при первом обращении и дальше берется из кеша _markup
+_SCREEN_BUTTONS = {
+    # Единственная кнопка возврата в меню (ошибки и отмена уточнения калорий)
+    "main_menu": (
+        (("🏠 Главное меню", "main_menu"),),
+    ),
+    "photo_tip": (
+        (("🏠 Главное меню", "main_menu"),),
+    ),
+    "my_goal": (
+        (("⚙️ Изменить цель", "set_calorie_goal"),),
+        (("🏠 Главное меню", "main_menu"),),
+    ),
+    "data_status": (
+        (("⚙️ Настройки профиля", "settings"),),
+        (("🏠 Главное меню", "main_menu"),),
+    ),
+    "weight_goal_saved": (
+        (("⚙️ Настройки", "settings"),),
+        (("🏠 Главное меню", "main_menu"),),
+    ),
+    "goals": (
+        (("📉 Похудеть", "goal_lose"),),
+        (("⚖️ Сохранить вес", "goal_maintain"),),
+        (("📈 Набрать вес", "goal_gain"),),
+        (("💪 Рекомпозиция", "goal_recomp"),),
+        (("🏠 Главное меню", "main_menu"),),
+    ),
+    "goal_selected": (
+        (("🎯 Мои цели", "goals_menu"),),
+        (("📊 Статистика", "stats"),),
+        (("🏠 Главное меню", "main_menu"),),
+    ),
+    "fatsecret_applied": (
+        (("🔍 Уточнить другой продукт", "refine_calories"),),
+        (("📊 Статистика", "stats"),),
+        (("🏠 Главное меню", "main_menu"),),
+    ),
+    "fatsecret_not_found": (
+        (("🔙 Назад к списку", "refine_calories"),),
+        (("🏠 Главное меню", "main_menu"),),
+    ),
+    "detailed_stats": (
+        ((f"{config.EMOJIS['back']} К статистике", "stats"),),
+    ),
+    "onboarding_welcome": (
+        (("🚀 Да, давайте настроим!", "start_setup"),),
+        (("⏭️ Пропустить (базовые настройки)", "skip_setup"),),
+    ),
+    "onboarding_gender": (
+        (("👨 Мужской", "gender_male"), ("👩 Женский", "gender_female")),
+    ),
+    # Кнопка "Назад" на шагах ввода возраста, роста и веса
+    "onboarding_age": (
+        (("🔙 Назад", "start_setup"),),
+    ),
+    "onboarding_height": (
+        (("🔙 Назад", "onboarding_age"),),
+    ),
+    "onboarding_weight": (
+        (("🔙 Назад", "onboarding_height"),),
+    ),
+    "onboarding_activity": (
+        (("🛋️ Низкий (сидячая работа, нет спорта)", "activity_low"),),
+        (("🚶 Умеренный (легкие тренировки 1-3 раза в неделю)", "activity_moderate"),),
+        (("🏃 Высокий (интенсивные тренировки 4-7 раз в неделю)", "activity_high"),),
+    ),
+    "onboarding_done": (
+        (("🍽️ Начать анализ еды!", "add_photo_tip"),),
+        (("👤 Мой профиль", "profile"),),
+    ),
+    "onboarding_retry": (
+        (("🔄 Попробовать снова", "start_onboarding"),),
+    ),
+    "onboarding_skipped": (
+        (("📸 Анализ фото", "add_photo_tip"),),
+        (("👤 Мой профиль", "profile"),),
+    ),
+}
+
+@functools.lru_cache(maxsize=64)
+def _markup(screen: str) -> InlineKeyboardMarkup:
+    """Inline клавиатура экрана из _SCREEN_BUTTONS (один объект на экран)"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(text, callback_data=callback_data) for text, callback_data in row]
+        for row in _SCREEN_BUTTONS[screen]
+    ])
+
+# Тип базы данных и подписи о сохранности данных - вычисляются один раз при импорте
+_DB_TYPE = "PostgreSQL" if IS_POSTGRES else \
+           "SQLite" if config.DATABASE_URL.startswith('sqlite') else "Другая"
+
+_DB_PERSISTENCE_TEXT = "✅ Данные сохраняются между перезапусками" if IS_POSTGRES else \
+                       "⚠️ Данные могут сбрасываться при обновлениях бота"
+
+# Безопасное отображение URL (без пароля)
+if '@' in config.DATABASE_URL:
+    _DB_INFO = f"Подключение: ...@{config.DATABASE_URL.split('@')[1]}"
+else:
+    _DB_INFO = f"URL: {config.DATABASE_URL[:30]}..."
+
+# Предупреждение о потере данных для /admindb
+if _DB_TYPE == "SQLite":
+    _DB_PERSISTENCE_WARNING = """
+⚠️ ВАЖНО: Используется SQLite база данных!
+❌ Данные будут СБРАСЫВАТЬСЯ при каждом деплое
+💡 Настройте PostgreSQL в Railway для постоянного хранения
+
+📋 Инструкция по настройке:
+1. В Railway: Add Service → Database → PostgreSQL
+2. Скопируйте Postgres Connection URL  
+3. Добавьте переменную DATABASE_URL в бот-сервисе
+4. Перезапустите бот"""
+else:
+    _DB_PERSISTENCE_WARNING = "✅ Используется постоянная база данных - данные сохраняются!"
+
+# Справка статична (тип базы данных известен при запуске) - собираем один раз
+_HELP_MESSAGE_HTML = f"""
+❓ <b>Справка по использованию бота</b>
+
+🚀 <b>Быстрый старт:</b>
+1️⃣ Отправьте фото еды боту
+2️⃣ Получите анализ калорий за 5 секунд  
+3️⃣ Следите за прогрессом в статистике
+
+📸 <b>Анализ фото еды:</b>
+• AI определяет виды продуктов
+• Подсчитывает калории, БЖУ и вес
+• Работает с любыми блюдами
+• Точность анализа 85-95%
+
+💡 <b>Советы для лучших результатов:</b>
+🔍 Хорошее освещение
+🍽️ Вся порция в кадре
+📏 Добавьте ложку для масштаба
+🎯 Четкое фото без размытия
+
+📊 <b>Что отслеживает бот:</b>
+• Ежедневные калории и БЖУ
+• Прогресс к вашей цели
+• Статистика по дням/неделям  
+• История всех записей
+
+⚙️ <b>Персонализация:</b>
+• Установите свою цель калорий
+• Укажите вес, рост, возраст
+• Настройте уведомления
+• Экспортируйте данные
+
+🔒 <b>Безопасность данных:</b>
+{'''• ✅ PostgreSQL - данные сохраняются навсегда
+• 🛡️ Никаких потерь при обновлениях''' if IS_POSTGRES else 
+'''• ⚠️ SQLite - данные могут сбрасываться
+• 💡 Рекомендуется настроить PostgreSQL'''}
+
+❓ Остались вопросы? Просто напишите мне!
+"""
+
+# Разбор текстового ввода настроек и коррекции анализа
+_INT_INPUT_RE = re.compile(r'^\s*(\d+)\s*$')
+_NUMBER_INPUT_RE = re.compile(r'^\s*(\d+(?:[.,]\d+)?)\s*$')
+_INVALID_INPUT_TEXT = "Неверный формат данных"
+_PERSONAL_INFO_INPUT_RE = re.compile(r'^\s*(?P<age>\d{1,3})\s+(?P<gender>муж|жен)', re.IGNORECASE)
+_CORRECTION_CALORIES_RE = re.compile(r'^\s*(?:калории|calories)\s+(\d+)\s*$', re.IGNORECASE)
+
+# Категории ИМТ: границы (18.5, 25, 30) и подписи интервалов между ними
+_BMI_EDGES = (18.5, 25, 30)
+_BMI_LABELS = (
+    ("Недостаток веса", "📉"),
+    ("Нормальный вес", "✅"),
+    ("Избыточный вес", "📈"),
+    ("Ожирение", "🔺"),
+)
+
+# Оценка дня в истории калорий: близко к цели, мало, много, норма
+_DAY_STATUS_EMOJI = ("🎯", "🔽", "🔺", "📊")
+
+# Оценка недели: близко к цели, мало, много, норма (индекс - status из get_weekly_stats)
+_WEEK_STATUS_LABELS = ("🎯 Отлично", "🔽 Мало калорий", "🔺 Много калорий", "📊 Норма")
+_WEEKLY_REPORT_STATUS = (
+    ("🎯 Отлично! Вы близки к цели", "🎉"),
+    ("🔽 Стоит увеличить калорийность", "💪"),
+    ("🔺 Возможно, стоит быть умереннее", "🧘‍♂️"),
+    ("📊 Держитесь в норме", "✅"),
+)
+
+# Допустимые значения настроек: поле -> (минимум, максимум)
+_SETTINGS_RANGES = {
+    'calorie_goal': (500, 5000),
+    'weight': (20, 300),
+    'height': (100, 250),
+    'age': (10, 120),
+}
+
+# Неизменные тексты обработчика фото
+_PHOTO_ANALYZING_TEXT = f"{config.EMOJIS['food']} Анализирую ваше блюдо...\n⏳ Это может занять несколько секунд"
+_PHOTO_ERROR_TEXT = (
+    f"{config.EMOJIS['error']} Произошла ошибка при анализе фото.\n\n"
+    "Пожалуйста, попробуйте еще раз или отправьте другое изображение."
+)
+
+# Статичные тексты подсказки по фото и онбординга (Markdown)
+_PHOTO_TIP_TEXT = """📸 **Как отправить фото для анализа**
+
+🎯 **Простые шаги:**
+1. Нажмите 📎 (скрепка) в чате
+2. Выберите "Камера" или "Фото"
+3. Сфотографируйте еду или выберите из галереи
+4. Отправьте фото боту
+
+💡 **Советы для лучшего анализа:**
+• 📏 Покажите еду целиком на тарелке
+• 💡 Хорошее освещение поможет AI
+• 🥄 Разместите ложку/вилку для масштаба
+• 🍽️ Один прием пищи = одно фото
+
+✨ **Что я определю:**
+• Виды продуктов и их количество
+• Калории, белки, жиры, углеводы  
+• Размер порций и вес продуктов
+
+🚀 Отправляйте фото прямо сейчас!"""
+
+# Имя бота подставляется один раз при импорте, на каждый вызов - только имя пользователя
+_ONBOARDING_WELCOME_TEMPLATE = """
+🎯 **Добро пожаловать в {bot_name}!**
+
+👋 Привет, **{first_name}**!
+
+Я ваш персональный AI-помощник по подсчету калорий! 
+
+🔬 **Для точного расчета калорий** мне нужно узнать о вас несколько вещей:
+• 👤 Ваш пол, возраст, рост и вес
+• 🏃 Уровень физической активности  
+• 🎯 Автоматический расчет персональной нормы калорий
+
+⏱️ **Это займет всего 2 минуты**, но сделает анализ намного точнее!
+
+💡 **После настройки вы получите:**
+• 🎯 Персональную норму калорий именно для вас
+• 📊 Точный анализ прогресса к цели
+• 💪 Рекомендации по питанию
+
+Готовы настроить ваш профиль?
+""".replace('{bot_name}', config.BOT_NAME)
+
+_ONBOARDING_GENDER_TEXT = """
+👤 **Шаг 1 из 5: Ваш пол**
+
+Пол влияет на базальный метаболизм и расчет нормы калорий.
+
+Выберите ваш пол:
+"""
+
+# Приветствие /start (HTML) для пользователей, прошедших онбординг; имя бота подставляется один раз при импорте
+_WELCOME_TEMPLATE = """
+🍎 <b>{bot_name}</b>
+        
+👋 С возвращением, <b>{first_name}</b>! 
+
+📊 <b>Сегодня:</b> {progress_text}
+💡 <b>Совет:</b> Отправьте фото еды для анализа калорий
+
+🔥 <b>Ваш персональный помощник готов:</b>
+• 📸 AI анализ фото еды с учетом ваших целей
+• 📈 Умная статистика питания
+• 🎯 Персональная норма калорий: {daily_goal} ккал/день
+• 📱 Полная история ваших достижений
+
+Выберите действие или отправьте фото еды:
+""".replace('{bot_name}', html.escape(config.BOT_NAME))
+
+# Шаблон личного кабинета (общий для команды /profile и кнопки профиля)
+_PROFILE_TEMPLATE = """
+👤 <b>Личный кабинет</b>
+
+<b>Основная информация:</b>
+📝 Имя: {name}
+📊 Ведёте записи: {tracking_days} дней
+🎯 Цель калорий: {goal} ккал/день
+
+<b>Физические параметры:</b>
+⚖️ Вес: {weight} кг
+📏 Рост: {height} см
+🎂 Возраст: {age} лет
+🚻 Пол: {gender}
+
+<b>Текущая статистика:</b>
+🔥 Сегодня: {today_calories} / {goal} ккал
+📈 За неделю: {week_avg:.0f} ккал/день (среднее)
+📅 За месяц: {month_avg:.0f} ккал/день (среднее)
+"""
+
+# Подписи целей по весу
+_WEIGHT_GOAL_LABELS = {
+    'lose': '📉 Похудение',
+    'maintain': '⚖️ Поддержание веса',
+    'gain': '📈 Набор веса',
+    'recomp': '💪 Рекомпозиция'
+}
+
+# Тексты статистики (Markdown): эмодзи подставлены при импорте, в обработчике - один format
+_STATS_HEADER = f"{config.EMOJIS['stats']} **Статистика питания**\n\n"
+_STATS_TODAY_TEMPLATE = (
+    "**Сегодня ({day})**\n"
+    f"{config.EMOJIS['fire']} Калории: {{calories:.0f}} из {{goal}}\n"
+    "🎯 Цель: {weight_goal}\n"
+    f"{config.EMOJIS['muscle']} Белки: {{proteins:.1f}}г\n"
+    "🍞 Углеводы: {carbs:.1f}г\n"
+    "🥑 Жиры: {fats:.1f}г\n"
+    f"{config.EMOJIS['food']} Приемов пищи: {{meals}}\n\n"
+    "{progress}\n\n"
+)
+_STATS_PROGRESS_OK = f"📊 Прогресс к цели: {{:.1f}}% {config.EMOJIS['checkmark']}"
+_STATS_PROGRESS_OVER = f"📊 Превышение цели: {{:.1f}}% {config.EMOJIS['warning']}"
+_STATS_WEEK_TEMPLATE = (
+    "**За неделю (средние в день)**\n"
+    f"{config.EMOJIS['fire']} Калории: {{avg:.0f}}\n"
+    "📈 Всего за неделю: {total:.0f} ккал\n"
+    "📅 Дней с записями: {days} из 7"
+)
+
+_DETAILED_STATS_TEMPLATE = f"""{config.EMOJIS['chart']} **Подробная статистика за 30 дней**
+
+**Общие показатели:**
+📊 Дней с записями: {{days}} из 30
+🔥 Общее потребление: {{total_calories:.0f}} ккал
+📈 Среднее в день: {{avg_calories:.0f}} ккал
+🎯 Цель в день: {{goal}} ккал
+
+**Соблюдение цели:**
+✅ Дней в пределах цели: {{goal_days}} ({{goal_percentage:.1f}}%)
+⚠️ Дней с превышением: {{over_days}}
+
+**Питательные вещества (среднее в день):**
+💪 Белки: {{avg_proteins:.1f}}г
+🍞 Углеводы: {{avg_carbs:.1f}}г
+🥑 Жиры: {{avg_fats:.1f}}г
+"""
+
+@dataclass(slots=True)
+class OnboardingState:
+    """Ответы онбординга, хранятся одним объектом в context.user_data['onboarding']"""
+    gender: str = ''
+    age: int = 0
+    height: float = 0.0
+    weight: float = 0.0
+    activity: str = ''
+
+def _format_date(d) -> str:
+    """Дата как ДД.ММ.ГГГГ (то же, что strftime('%d.%m.%Y'), без вызова strftime)"""
+    return f"{d.day:02d}.{d.month:02d}.{d.year}"
+
+def _format_day_time(d) -> str:
+    """Дата и время как ДД.ММ ЧЧ:ММ (то же, что strftime('%d.%m %H:%M'))"""
+    return f"{d.day:02d}.{d.month:02d} {d.hour:02d}:{d.minute:02d}"
+
 class CalorieBotHandlers:
     """Обработчики команд телеграм-бота"""
     
     @staticmethod
     def get_main_keyboard():
-        """Создает постоянную клавиатуру для главного меню"""
-        keyboard = [
-            [
-                KeyboardButton("🍽️ Анализ еды"),
-                KeyboardButton("📊 Статистика")
-            ],
-            [
-                KeyboardButton("⚙️ Настройки"),
-                KeyboardButton("📅 История")
-            ],
-            [
-                KeyboardButton("🎯 Мои цели"),
-                KeyboardButton("❌ Отменить анализ")
-            ],
-            [
-                KeyboardButton("🏠 Главное меню"),
-                KeyboardButton("❓ Помощь")
-            ]
-        ]
-        return ReplyKeyboardMarkup(
-            keyboard, 
-            resize_keyboard=True, 
-            one_time_keyboard=False,
-            input_field_placeholder="Отправьте фото еды или выберите действие..."
+        """Постоянная клавиатура главного меню (общий экземпляр _MAIN_KEYBOARD)"""
+        return _MAIN_KEYBOARD
+    
+    @staticmethod
+    async def get_db_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Пользователь из БД - не больше одного запроса на update
+        
+        Результат запоминается в user_data вместе с update_id, поэтому цепочки
+        обработчиков (кнопка -> статистика -> ...) не повторяют запрос,
+        а следующий update загружает свежие данные.
+        """
+        cached = context.user_data.get('_db_user')
+        if cached and cached[0] == update.update_id:
+            return cached[1]
+        
+        user = update.effective_user
+        db_user = await asyncio.to_thread(
+            DatabaseManager.get_or_create_user,
+            telegram_id=user.id,
+            username=user.username,
+            first_name=user.first_name,
+            last_name=user.last_name
         )
+        context.user_data['_db_user'] = (update.update_id, db_user)
+        return db_user
+    
+    @staticmethod
+    async def get_today_calories(db_user) -> float:
+        """Калории пользователя за сегодня: счетчик дня из Redis, при промахе - из БД"""
+        user_timezone = getattr(db_user, 'timezone', 'UTC') or 'UTC'
+        user_today = get_user_today_date(user_timezone)
+        
+        today_calories = await redis_cache.get_today_calories(db_user.id, user_today)
+        if today_calories is None:
+            today_calories = await asyncio.to_thread(DatabaseManager.get_today_calories, db_user.id, user_timezone)
+            await redis_cache.set_today_calories(
+                db_user.id, user_today, today_calories, get_user_day_end(user_today, user_timezone)
+            )
+        return today_calories
     
     @staticmethod
     async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -64,44 +639,25 @@ class CalorieBotHandlers:
         # Сбрасываем флаг сохранения анализа при возврате в главное меню
         context.user_data.pop('preserve_analysis_message', None)
         
-        telegram_user = DatabaseManager.get_or_create_user(
-            telegram_id=user.id,
-            username=user.username,
-            first_name=user.first_name,
-            last_name=user.last_name
-        )
+        telegram_user = await CalorieBotHandlers.get_db_user(update, context)
         
-        # Проверяем завершен ли онбординг
-        if not DatabaseManager.is_onboarding_completed(user.id):
+        # Проверяем завершен ли онбординг (по уже загруженному пользователю, без запроса в БД)
+        if not has_completed_onboarding(telegram_user):
             await CalorieBotHandlers.start_onboarding(update, context)
             return
         
         # Если онбординг завершен, показываем обычное меню
         # Получаем быструю статистику для приветствия с учетом таймзоны
-        user_timezone = getattr(telegram_user, 'timezone', 'UTC') or 'UTC'
-        today_calories = DatabaseManager.get_today_calories(telegram_user.id, user_timezone)
+        today_calories = await CalorieBotHandlers.get_today_calories(telegram_user)
         daily_goal = telegram_user.daily_calorie_goal
         
         # Статус дня
         progress_emoji = "🟢" if today_calories < daily_goal else "🔴" if today_calories > daily_goal * 1.1 else "🟡"
         progress_text = f"{today_calories:.0f} / {daily_goal} ккал {progress_emoji}"
         
-        welcome_message = f"""
-🍎 **{config.BOT_NAME}**
-        
-👋 С возвращением, **{user.first_name}**! 
-
-📊 **Сегодня:** {progress_text}
-💡 **Совет:** Отправьте фото еды для анализа калорий
-
-🔥 **Ваш персональный помощник готов:**
-• 📸 AI анализ фото еды с учетом ваших целей
-• 📈 Умная статистика питания
-• 🎯 Персональная норма калорий: {daily_goal} ккал/день
-• 📱 Полная история ваших достижений
-
-Выберите действие или отправьте фото еды:
-"""
+        welcome_message = _WELCOME_TEMPLATE.format(
+            first_name=html.escape(user.first_name or ''), progress_text=progress_text, daily_goal=daily_goal
+        )
         
         # Используем постоянную клавиатуру вместо inline кнопок
         reply_markup = CalorieBotHandlers.get_main_keyboard()
@@ -111,14 +667,14 @@ class CalorieBotHandlers:
             # Это нажатие кнопки - отправляем новое сообщение с постоянной клавиатурой
             await update.callback_query.message.reply_text(
                 welcome_message,
-                parse_mode=ParseMode.MARKDOWN,
+                parse_mode=ParseMode.HTML,
                 reply_markup=reply_markup
             )
         else:
             # Это команда /start
             await update.message.reply_text(
                 welcome_message,
-                parse_mode=ParseMode.MARKDOWN,
+                parse_mode=ParseMode.HTML,
                 reply_markup=reply_markup
             )
     
@@ -128,16 +684,16 @@ class CalorieBotHandlers:
         user = update.effective_user
         
         # Принудительно устанавливаем цель 3000 ккал
-        success = DatabaseManager.force_update_user_goal(user.id, 3000)
+        success = await asyncio.to_thread(DatabaseManager.force_update_user_goal, user.id, 3000)
         
         if success:
-            message = f"✅ **Цель обновлена!**\n\nВаша новая цель: **3000 ккал в день**\n\nТеперь статистика будет отображаться правильно!"
+            message = "✅ <b>Цель обновлена!</b>\n\nВаша новая цель: <b>3000 ккал в день</b>\n\nТеперь статистика будет отображаться правильно!"
         else:
             message = "❌ Ошибка при обновлении цели. Попробуйте еще раз."
         
         await update.message.reply_text(
             message,
-            parse_mode=ParseMode.MARKDOWN
+            parse_mode=ParseMode.HTML
         )
     
     @staticmethod
@@ -146,7 +702,7 @@ class CalorieBotHandlers:
         user = update.effective_user
         
         # Проверяем только админа (если указан)
-        if config.ADMIN_USER_ID and str(user.id) != config.ADMIN_USER_ID:
+        if config.ADMIN_USER_IDS and user.id not in config.ADMIN_USER_IDS:
             await update.message.reply_text("❌ Команда доступна только администратору")
             return
         
@@ -154,7 +710,6 @@ class CalorieBotHandlers:
         
         try:
             # Простой тестовый запрос
-            from ai_analyzer import analyzer
             test_response = analyzer.client.chat.completions.create(
                 model=config.AI_MODEL,
                 messages=[{"role": "user", "content": "Ответь одним словом: 'работаю'"}],
@@ -166,8 +721,7 @@ class CalorieBotHandlers:
             
         except Exception as e:
             await update.message.reply_text(f"❌ Ошибка OpenAI API: {str(e)}")
-            import traceback
-            logger.error(f"Ошибка тестирования OpenAI: {traceback.format_exc()}")
+            logger.exception("Ошибка тестирования OpenAI")
 
     @staticmethod
     async def debug_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -176,12 +730,14 @@ class CalorieBotHandlers:
         
         try:
             # Получаем пользователя
-            db_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
+            db_user = await CalorieBotHandlers.get_db_user(update, context)
             
-            # Получаем статистику с учетом таймзоны
+            # Получаем статистику с учетом таймзоны (независимые запросы выполняются параллельно)
             user_timezone = getattr(db_user, 'timezone', 'UTC') or 'UTC'
-            tracking_days = DatabaseManager.get_tracking_days(db_user.id)
-            today_calories = DatabaseManager.get_today_calories(db_user.id, user_timezone)
+            tracking_days, today_calories = await asyncio.gather(
+                asyncio.to_thread(DatabaseManager.get_tracking_days, db_user.id),
+                asyncio.to_thread(DatabaseManager.get_today_calories, db_user.id, user_timezone)
+            )
             
             message = f"""
 🔍 **Диагностика пользователя**
@@ -223,10 +779,11 @@ class CalorieBotHandlers:
         
         try:
             # Получаем пользователя
-            db_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
+            db_user = await CalorieBotHandlers.get_db_user(update, context)
             
             # Сбрасываем все настройки на дефолтные
-            updated_user = DatabaseManager.update_user_settings(
+            updated_user = await asyncio.to_thread(
+                DatabaseManager.update_user_settings,
                 db_user.id,
                 daily_calorie_goal=2000,
                 weight=None,
@@ -235,6 +792,10 @@ class CalorieBotHandlers:
                 gender=None
             )
             
+            await redis_cache.invalidate_today_calories(
+                db_user.id, get_user_today_date(getattr(db_user, 'timezone', 'UTC') or 'UTC')
+            )
+            
             logger.info(f"🔄 Пользователь {user.id} сброшен к дефолтным настройкам")
             
             await update.message.reply_text(
@@ -258,40 +819,17 @@ class CalorieBotHandlers:
     @staticmethod 
     async def debug_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда /debugstats - проверка состояния таблиц DailyStats и FoodEntry"""
-        user = update.effective_user
         
         try:
             # Получаем пользователя
-            db_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
+            db_user = await CalorieBotHandlers.get_db_user(update, context)
             
-            # Проверяем FoodEntry
-            from database import SessionLocal, FoodEntry, DailyStats
-            from sqlalchemy import func
-            
-            db = SessionLocal()
-            try:
-                # Считаем записи в FoodEntry
-                food_entries_count = db.query(func.count(FoodEntry.id)).filter(
-                    FoodEntry.user_id == db_user.id
-                ).scalar()
-                
-                # Считаем записи в DailyStats
-                daily_stats_count = db.query(func.count(DailyStats.id)).filter(
-                    DailyStats.user_id == db_user.id
-                ).scalar()
-                
-                # Последние 3 записи FoodEntry
-                recent_food_entries = db.query(FoodEntry).filter(
-                    FoodEntry.user_id == db_user.id
-                ).order_by(FoodEntry.created_at.desc()).limit(3).all()
-                
-                # Последние 3 записи DailyStats
-                recent_daily_stats = db.query(DailyStats).filter(
-                    DailyStats.user_id == db_user.id
-                ).order_by(DailyStats.date.desc()).limit(3).all()
-                
-            finally:
-                db.close()
+            # Проверяем FoodEntry и DailyStats
+            diagnostics = await asyncio.to_thread(DatabaseManager.get_tables_diagnostics, db_user.id)
+            food_entries_count = diagnostics['food_entries_count']
+            daily_stats_count = diagnostics['daily_stats_count']
+            recent_food_entries = diagnostics['recent_food_entries']
+            recent_daily_stats = diagnostics['recent_daily_stats']
             
             message = f"""
 🔍 **Диагностика таблиц базы данных**
@@ -323,44 +861,25 @@ class CalorieBotHandlers:
             
         except Exception as e:
             await update.message.reply_text(f"❌ Ошибка диагностики таблиц: {e}")
-            import traceback
-            logger.error(f"Ошибка debug_stats: {traceback.format_exc()}")
+            logger.exception("Ошибка debug_stats")
 
     @staticmethod 
     async def rebuild_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда /rebuildstats - принудительное пересоздание DailyStats из FoodEntry"""
-        user = update.effective_user
         
         try:
             # Получаем пользователя
-            db_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
+            db_user = await CalorieBotHandlers.get_db_user(update, context)
             
-            # Получаем все уникальные даты из FoodEntry
-            from database import SessionLocal, FoodEntry
-            from sqlalchemy import func
-            
-            db = SessionLocal()
-            try:
-                # Получаем все уникальные даты записей пользователя
-                unique_dates = db.query(
-                    func.date(FoodEntry.created_at).label('date')
-                ).filter(
-                    FoodEntry.user_id == db_user.id
-                ).distinct().all()
-                
-            finally:
-                db.close()
+            # Пересоздаем статистику сразу за все дни с записями
+            rebuilt_count = await asyncio.to_thread(DatabaseManager.rebuild_daily_stats, db_user.id)
             
-            if not unique_dates:
+            if not rebuilt_count:
                 await update.message.reply_text("📊 У вас нет записей для пересоздания статистики")
                 return
             
-            # Пересоздаем статистику для каждой даты
-            rebuilt_count = 0
-            for date_row in unique_dates:
-                date = date_row.date
-                DatabaseManager._update_daily_stats(db_user.id, date)
-                rebuilt_count += 1
+            user_timezone = getattr(db_user, 'timezone', 'UTC') or 'UTC'
+            await redis_cache.invalidate_today_calories(db_user.id, get_user_today_date(user_timezone))
             
             message = f"""
 ✅ **Статистика пересоздана!**
@@ -380,19 +899,13 @@ class CalorieBotHandlers:
             
         except Exception as e:
             await update.message.reply_text(f"❌ Ошибка пересоздания статистики: {e}")
-            import traceback
-            logger.error(f"Ошибка rebuild_stats: {traceback.format_exc()}")
+            logger.exception("Ошибка rebuild_stats")
 
     # ======= ADMIN COMMANDS =======
     @staticmethod
     def is_admin(user_id):
         """Проверяет является ли пользователь админом"""
-        if not config.ADMIN_USER_ID:
-            return False
-        try:
-            return str(user_id) == config.ADMIN_USER_ID
-        except:
-            return False
+        return user_id in config.ADMIN_USER_IDS
 
     @staticmethod
     async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -404,7 +917,7 @@ class CalorieBotHandlers:
             return
         
         try:
-            stats = DatabaseManager.get_admin_stats()
+            stats = await asyncio.to_thread(DatabaseManager.get_admin_stats)
             
             message = f"""
 👑 <b>Административная панель</b>
@@ -424,7 +937,7 @@ class CalorieBotHandlers:
             
             for i, user in enumerate(stats['top_users'], 1):
                 # Экранируем имя пользователя для безопасного отображения
-                name_safe = user['name'].replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+                name_safe = html.escape(user['name'], quote=False)
                 message += f"{i}. {name_safe} - {user['entries_count']} записей\n"
             
             if not stats['top_users']:
@@ -456,7 +969,7 @@ class CalorieBotHandlers:
             return
         
         try:
-            users = DatabaseManager.get_all_users_summary()
+            users = await asyncio.to_thread(DatabaseManager.get_all_users_summary)
             
             if not users:
                 await update.message.reply_text("📝 Пользователей пока нет")
@@ -464,6 +977,7 @@ class CalorieBotHandlers:
             
             # Используем HTML вместо Markdown для лучшей совместимости
             message = f"👥 <b>Все пользователи ({len(users)}):</b>\n\n"
+            now = datetime.now(timezone.utc)
             
             for i, user_info in enumerate(users[:15], 1):  # Показываем только первых 15
                 name = user_info['name']
@@ -479,14 +993,14 @@ class CalorieBotHandlers:
                         # Если нет timezone, добавляем UTC
                         last_activity = last_activity.replace(tzinfo=timezone.utc)
                     
-                    days_ago = (datetime.now(timezone.utc) - last_activity).days
+                    days_ago = (now - last_activity).days
                     activity = f"{days_ago}д назад" if days_ago > 0 else "сегодня"
                 else:
                     activity = "неактивен"
                 
                 # Экранируем HTML символы
-                name_escaped = name.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-                username_escaped = username.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+                name_escaped = html.escape(name, quote=False)
+                username_escaped = html.escape(username, quote=False)
                 
                 message += f"{i}. <b>{name_escaped}</b> ({username_escaped})\n"
                 message += f"   ID: <code>{user_info['telegram_id']}</code> • {entries} записей • цель {goal} ккал\n"
@@ -520,7 +1034,7 @@ class CalorieBotHandlers:
         
         try:
             telegram_id = int(context.args[0])
-            user_info = DatabaseManager.get_user_detailed_info(telegram_id)
+            user_info = await asyncio.to_thread(DatabaseManager.get_user_detailed_info, telegram_id)
             
             if not user_info:
                 await update.message.reply_text(f"❌ Пользователь с ID {telegram_id} не найден")
@@ -529,8 +1043,8 @@ class CalorieBotHandlers:
             user_obj = user_info['user']
             
             # Экранируем данные для безопасного отображения в HTML
-            name_safe = (user_obj.first_name or 'Неизвестно').replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-            username_safe = (user_obj.username or 'нет').replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+            name_safe = html.escape(user_obj.first_name or 'Неизвестно', quote=False)
+            username_safe = html.escape(user_obj.username or 'нет', quote=False)
             
             message = f"""
 🔍 <b>Детальная информация о пользователе</b>
@@ -585,57 +1099,27 @@ class CalorieBotHandlers:
             return
         
         try:
-            users = DatabaseManager.get_all_users_summary()
+            csv_buffer = io.BytesIO()
+            users_count = await asyncio.to_thread(DatabaseManager.export_users_csv, csv_buffer)
             
-            if not users:
+            if not users_count:
                 await update.message.reply_text("📝 Нет данных для экспорта")
                 return
             
-            # Создаем CSV данные
-            import io
-            import csv
-            
-            csv_data = io.StringIO()
-            writer = csv.writer(csv_data)
-            
-            # Заголовки
-            writer.writerow([
-                'Telegram ID', 'Имя', 'Username', 'Дата регистрации',
-                'Последняя активность', 'Количество записей', 'Цель калорий',
-                'Вес', 'Рост', 'Возраст', 'Пол'
-            ])
-            
-            # Данные пользователей
-            for user_info in users:
-                writer.writerow([
-                    user_info['telegram_id'],
-                    user_info['name'],
-                    user_info['username'] or '',
-                    user_info['created_at'].strftime('%Y-%m-%d %H:%M:%S') if user_info['created_at'] else '',
-                    user_info['last_activity'].strftime('%Y-%m-%d %H:%M:%S') if user_info['last_activity'] else '',
-                    user_info['entries_count'],
-                    user_info['daily_calorie_goal'],
-                    user_info['weight'] or '',
-                    user_info['height'] or '',
-                    user_info['age'] or '',
-                    user_info['gender'] or ''
-                ])
-            
-            # Отправляем файл
-            csv_content = csv_data.getvalue().encode('utf-8')
-            
-            filename = f"users_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+            csv_buffer.seek(0)
+            
+            now = datetime.now()
+            filename = f"users_export_{now:%Y%m%d_%H%M%S}.csv"
             
             await update.message.reply_document(
-                document=io.BytesIO(csv_content),
+                document=csv_buffer,
                 filename=filename,
-                caption=f"📊 Экспорт данных пользователей\n👥 Пользователей: {len(users)}\n📅 Дата: {datetime.now().strftime('%d.%m.%Y %H:%M')}"
+                caption=f"📊 Экспорт данных пользователей\n👥 Пользователей: {users_count}\n📅 Дата: {now:%d.%m.%Y %H:%M}"
             )
             
         except Exception as e:
             await update.message.reply_text(f"❌ Ошибка экспорта данных: {e}")
-            import traceback
-            logger.error(f"Ошибка admin_export: {traceback.format_exc()}")
+            logger.exception("Ошибка admin_export")
 
     @staticmethod
     async def admin_test_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -673,8 +1157,7 @@ class CalorieBotHandlers:
         try:
             await update.message.reply_text("🔧 Запускаю принудительную миграцию...")
             
-            from database import migrate_telegram_id_if_needed
-            migrate_telegram_id_if_needed()
+            await asyncio.to_thread(migrate_telegram_id_if_needed)
             
             await update.message.reply_text("✅ Принудительная миграция завершена! Проверьте логи.")
             
@@ -689,22 +1172,20 @@ class CalorieBotHandlers:
             return
             
         try:
-            import logging
-            from database import engine, User
             
-            # Проверяем тип telegram_id в базе данных
-            with engine.connect() as connection:
-                result = connection.execute(text("""
-                    SELECT data_type, is_nullable, column_default
-                    FROM information_schema.columns 
-                    WHERE table_name = 'users' 
-                    AND column_name = 'telegram_id'
-                """))
-                
-                row = result.fetchone()
-                if row:
-                    data_type, is_nullable, column_default = row
-                    status = f"""
+            # Тип поля telegram_id и тест вставки большого ID - независимые запросы, выполняются параллельно
+            test_large_id = 9876543210  # Большой ID для теста
+            row, test_error = await asyncio.gather(
+                asyncio.to_thread(DatabaseManager.get_telegram_id_column_info),
+                asyncio.to_thread(DatabaseManager.probe_large_telegram_id, test_large_id),
+                return_exceptions=True
+            )
+            if isinstance(row, Exception):
+                raise row
+            
+            if row:
+                data_type, is_nullable, column_default = row
+                status = f"""
 🔍 **СТАТУС МИГРАЦИИ telegram_id**
 
 📊 **Информация о поле:**
@@ -718,36 +1199,12 @@ class CalorieBotHandlers:
 {'''• Миграция успешна! Проблемы решены.''' if data_type == 'bigint' else '''• ТРЕБУЕТСЯ выполнить автоматическую миграцию
 • При следующем перезапуске бота миграция должна произойти автоматически'''}
 """
-                else:
-                    status = "❌ Таблица users или поле telegram_id не найдено"
-                
-            # Тестируем создание пользователя с большим ID  
-            test_large_id = 9876543210  # Большой ID для теста
-            try:
-                from database import DatabaseManager
-                test_user = DatabaseManager.get_or_create_user(
-                    telegram_id=test_large_id, 
-                    username="test_large_id",
-                    first_name="TestUser"
-                )
-                
-                if hasattr(test_user, 'id') and test_user.id is not None:
-                    test_result = "✅ Большие Telegram ID поддерживаются"
-                    # Удаляем тестового пользователя
-                    try:
-                        from database import SessionLocal
-                        db = SessionLocal()
-                        real_test_user = db.query(User).filter(User.telegram_id == test_large_id).first()
-                        if real_test_user:
-                            db.delete(real_test_user)
-                            db.commit()
-                        db.close()
-                    except:
-                        pass
-                else:
-                    test_result = "⚠️ Большие Telegram ID создают временных пользователей"
-                    
-            except Exception as test_error:
+            else:
+                status = "❌ Таблица users или поле telegram_id не найдено"
+            
+            if test_error is None:
+                test_result = "✅ Большие Telegram ID поддерживаются"
+            else:
                 test_result = f"❌ Ошибка при тесте большого ID: {test_error}"
             
             status += f"\n\n🧪 **Тест больших Telegram ID:**\n{test_result}"
@@ -767,7 +1224,7 @@ class CalorieBotHandlers:
             return
         
         try:
-            users = DatabaseManager.get_all_users_summary()
+            users = await asyncio.to_thread(DatabaseManager.get_all_users_summary)
             
             if not users:
                 await update.message.reply_text("📝 Пользователей нет для отладки")
@@ -775,6 +1232,7 @@ class CalorieBotHandlers:
             
             # Берем первого пользователя для отладки
             user_info = users[0]
+            now = datetime.now(timezone.utc)
             
             message = f"""🔧 ОТЛАДКА TIMEZONE
 
@@ -787,14 +1245,14 @@ class CalorieBotHandlers:
 🕐 last_activity: {user_info['last_activity']}
    timezone: {user_info['last_activity'].tzinfo if user_info['last_activity'] else 'None'}
 
-⏰ datetime.now(timezone.utc): {datetime.now(timezone.utc)}
+⏰ datetime.now(timezone.utc): {now}
 
 ✅ Тест вычитания:"""
             
             # Тест вычитания
             try:
                 if user_info['last_activity']:
-                    days_diff = (datetime.now(timezone.utc) - user_info['last_activity']).days
+                    days_diff = (now - user_info['last_activity']).days
                     message += f"\n   {days_diff} дней назад - ✅ OK"
                 else:
                     message += f"\n   last_activity = None - ✅ OK"
@@ -816,48 +1274,21 @@ class CalorieBotHandlers:
             return
         
         try:
-            # Информация о базе данных
-            db_type = "PostgreSQL" if config.DATABASE_URL.startswith('postgresql') else \
-                     "SQLite" if config.DATABASE_URL.startswith('sqlite') else "Другая"
-            
-            # Безопасное отображение URL (без пароля)
-            if '@' in config.DATABASE_URL:
-                safe_url = config.DATABASE_URL.split('@')[1]
-                db_info = f"Подключение: ...@{safe_url}"
-            else:
-                db_info = f"URL: {config.DATABASE_URL[:30]}..."
-            
             # Статистика базы данных
-            stats = DatabaseManager.get_admin_stats()
-            
-            # Проверка на потерю данных
-            persistent_warning = ""
-            if db_type == "SQLite":
-                persistent_warning = """
-⚠️ ВАЖНО: Используется SQLite база данных!
-❌ Данные будут СБРАСЫВАТЬСЯ при каждом деплое
-💡 Настройте PostgreSQL в Railway для постоянного хранения
-
-📋 Инструкция по настройке:
-1. В Railway: Add Service → Database → PostgreSQL
-2. Скопируйте Postgres Connection URL  
-3. Добавьте переменную DATABASE_URL в бот-сервисе
-4. Перезапустите бот"""
-            else:
-                persistent_warning = "✅ Используется постоянная база данных - данные сохраняются!"
+            stats = await asyncio.to_thread(DatabaseManager.get_admin_stats)
             
             message = f"""💾 <b>Информация о базе данных</b>
 
 🔧 <b>Конфигурация:</b>
-• Тип: {db_type}
-• {db_info}
+• Тип: {_DB_TYPE}
+• {_DB_INFO}
 
 📊 <b>Текущие данные:</b>
 • Пользователей: {stats['total_users']}
 • Записей о еде: {stats['total_food_entries']}
 • Активных за неделю: {stats['active_users_7d']}
 
-{persistent_warning}
+{_DB_PERSISTENCE_WARNING}
 
 🔍 <b>Диагностические команды:</b>
 /debugstats - состояние таблиц БД
@@ -873,32 +1304,31 @@ class CalorieBotHandlers:
             await update.message.reply_text(f"❌ Ошибка получения информации о БД: {e}")
 
     @staticmethod
-    async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Команда /status - проверка статуса данных пользователя"""
+    async def _render_status(update: Update, context: ContextTypes.DEFAULT_TYPE, send, reply_markup=None):
+        """Общая часть /status и кнопки "Статус данных": собирает статус и отправляет через send
+
+        send - update.message.reply_text для команды или query.edit_message_text для кнопки.
+        """
         user = update.effective_user
+
+        # Получаем пользователя
+        db_user = await CalorieBotHandlers.get_db_user(update, context)
         
-        try:
-            # Получаем пользователя
-            db_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
-            
-            # Определяем тип базы данных
-            db_type = "PostgreSQL" if config.DATABASE_URL.startswith('postgresql') else \
-                     "SQLite" if config.DATABASE_URL.startswith('sqlite') else "Другая"
-            
-            persistent = "✅ Данные сохраняются между перезапусками" if db_type == "PostgreSQL" else \
-                        "⚠️ Данные могут сбрасываться при обновлениях бота"
-            
-            # Статистика пользователя
-            tracking_days = DatabaseManager.get_tracking_days(db_user.id)
-            today_calories = DatabaseManager.get_today_calories(db_user.id)
-            
-            # Дата создания аккаунта
-            created_date = db_user.created_at.strftime('%d.%m.%Y') if db_user.created_at else "Неизвестно"
-            
-            message = f"""📊 <b>Статус ваших данных</b>
+        # Статистика пользователя с учетом таймзоны: один агрегирующий запрос, общий кеш с личным кабинетом
+        user_timezone = getattr(db_user, 'timezone', 'UTC') or 'UTC'
+        profile_info = await CalorieBotHandlers.cached_profile_query(
+            db_user.id, 'info', DatabaseManager.get_user_info, db_user.id, user_timezone
+        )
+        tracking_days = profile_info['tracking_days']
+        today_calories = profile_info['today_calories']
+        
+        # Дата создания аккаунта
+        created_date = _format_date(db_user.created_at) if db_user.created_at else "Неизвестно"
+        
+        message = f"""📊 <b>Статус ваших данных</b>
 
 👤 <b>Профиль:</b>
-• Имя: {user.first_name or 'Не указано'}
+• Имя: {html.escape(user.first_name or 'Не указано')}
 • Дата регистрации: {created_date}
 • Цель калорий: {db_user.daily_calorie_goal} ккал/день
 
@@ -908,22 +1338,24 @@ class CalorieBotHandlers:
 • Настроен ли профиль: {'✅ Да' if (db_user.weight or db_user.height) else '⚙️ Нет (настройте в /settings)'}
 
 💾 <b>Хранение данных:</b>
-• База данных: {db_type}
-• {persistent}
+• База данных: {_DB_TYPE}
+• {_DB_PERSISTENCE_TEXT}
 
 💡 <b>Что это означает:</b>
 {'''✅ Ваши данные в безопасности! 
-   Настройки и история сохранятся при обновлениях бота''' if db_type == "PostgreSQL" else 
+   Настройки и история сохранятся при обновлениях бота''' if IS_POSTGRES else 
 '''⚠️ При обновлениях бота данные могут сброситься
    Рекомендуется администратору настроить PostgreSQL'''}
 
 🔧 Используйте /settings для настройки профиля"""
-            
-            await update.message.reply_text(
-                message, 
-                parse_mode=ParseMode.HTML
-            )
-            
+        
+        await send(message, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+
+    @staticmethod
+    async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Команда /status - проверка статуса данных пользователя"""
+        try:
+            await CalorieBotHandlers._render_status(update, context, update.message.reply_text)
         except Exception as e:
             await update.message.reply_text(f"❌ Ошибка получения статуса: {e}")
 
@@ -934,32 +1366,12 @@ class CalorieBotHandlers:
         """Обработчик кнопки "Анализ фото" - подсказки по отправке фото"""
         query = update.callback_query
         
-        message = f"""📸 **Как отправить фото для анализа**
-
-🎯 **Простые шаги:**
-1. Нажмите 📎 (скрепка) в чате
-2. Выберите "Камера" или "Фото"
-3. Сфотографируйте еду или выберите из галереи
-4. Отправьте фото боту
-
-💡 **Советы для лучшего анализа:**
-• 📏 Покажите еду целиком на тарелке
-• 💡 Хорошее освещение поможет AI
-• 🥄 Разместите ложку/вилку для масштаба
-• 🍽️ Один прием пищи = одно фото
-
-✨ **Что я определю:**
-• Виды продуктов и их количество
-• Калории, белки, жиры, углеводы  
-• Размер порций и вес продуктов
-
-🚀 Отправляйте фото прямо сейчас!"""
+        message = _PHOTO_TIP_TEXT
 
         # Используем постоянную клавиатуру для обычных сообщений
         if query:
             # Это callback query - используем inline кнопки
-            keyboard = [[InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = _markup("photo_tip")
             await query.edit_message_text(
                 message,
                 parse_mode=ParseMode.MARKDOWN,
@@ -981,9 +1393,8 @@ class CalorieBotHandlers:
         user = query.from_user
         
         try:
-            db_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
-            user_timezone = getattr(db_user, 'timezone', 'UTC') or 'UTC'
-            today_calories = DatabaseManager.get_today_calories(db_user.id, user_timezone)
+            db_user = await CalorieBotHandlers.get_db_user(update, context)
+            today_calories = await CalorieBotHandlers.get_today_calories(db_user)
             daily_goal = db_user.daily_calorie_goal
             
             # Расчет прогресса
@@ -1014,11 +1425,7 @@ class CalorieBotHandlers:
 
 🔧 Хотите изменить цель? Используйте ⚙️ Настройки"""
 
-            keyboard = [
-                [InlineKeyboardButton("⚙️ Изменить цель", callback_data="set_calorie_goal")],
-                [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = _markup("my_goal")
             
             await query.edit_message_text(
                 message,
@@ -1033,61 +1440,8 @@ class CalorieBotHandlers:
     async def data_status_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик кнопки "Статус данных" - callback версия status_command"""
         query = update.callback_query
-        user = query.from_user
-        
         try:
-            # Получаем пользователя
-            db_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
-            
-            # Определяем тип базы данных
-            db_type = "PostgreSQL" if config.DATABASE_URL.startswith('postgresql') else \
-                     "SQLite" if config.DATABASE_URL.startswith('sqlite') else "Другая"
-            
-            persistent = "✅ Данные сохраняются между перезапусками" if db_type == "PostgreSQL" else \
-                        "⚠️ Данные могут сбрасываться при обновлениях бота"
-            
-            # Статистика пользователя с учетом таймзоны
-            user_timezone = getattr(db_user, 'timezone', 'UTC') or 'UTC'
-            tracking_days = DatabaseManager.get_tracking_days(db_user.id)
-            today_calories = DatabaseManager.get_today_calories(db_user.id, user_timezone)
-            
-            # Дата создания аккаунта
-            created_date = db_user.created_at.strftime('%d.%m.%Y') if db_user.created_at else "Неизвестно"
-            
-            message = f"""💾 **Статус ваших данных**
-
-👤 **Профиль:**
-• Имя: {user.first_name or 'Не указано'}
-• Дата регистрации: {created_date}
-• Цель калорий: {db_user.daily_calorie_goal} ккал/день
-
-📈 **Активность:**
-• Дней с записями: {tracking_days}
-• Калорий сегодня: {today_calories:.0f}
-• Настроен профиль: {'✅ Да' if (db_user.weight or db_user.height) else '⚙️ Нет'}
-
-💾 **Хранение данных:**
-• База данных: {db_type}
-• {persistent}
-
-💡 **Это означает:**
-{'''✅ Ваши данные в безопасности! 
-   Настройки и история сохранятся при обновлениях''' if db_type == "PostgreSQL" else 
-'''⚠️ При обновлениях данные могут сброситься
-   Рекомендуется администратору настроить PostgreSQL'''}"""
-
-            keyboard = [
-                [InlineKeyboardButton("⚙️ Настройки профиля", callback_data="settings")],
-                [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                message,
-                parse_mode=ParseMode.MARKDOWN,
-                reply_markup=reply_markup
-            )
-            
+            await CalorieBotHandlers._render_status(update, context, query.edit_message_text, _markup("data_status"))
         except Exception as e:
             await query.edit_message_text(f"❌ Ошибка получения статуса: {e}")
 
@@ -1098,34 +1452,9 @@ class CalorieBotHandlers:
         """Начать процесс персонализированного онбординга"""
         user = update.effective_user
         
-        welcome_message = f"""
-🎯 **Добро пожаловать в {config.BOT_NAME}!**
-
-👋 Привет, **{user.first_name}**!
-
-Я ваш персональный AI-помощник по подсчету калорий! 
-
-🔬 **Для точного расчета калорий** мне нужно узнать о вас несколько вещей:
-• 👤 Ваш пол, возраст, рост и вес
-• 🏃 Уровень физической активности  
-• 🎯 Автоматический расчет персональной нормы калорий
-
-⏱️ **Это займет всего 2 минуты**, но сделает анализ намного точнее!
-
-💡 **После настройки вы получите:**
-• 🎯 Персональную норму калорий именно для вас
-• 📊 Точный анализ прогресса к цели
-• 💪 Рекомендации по питанию
-
-Готовы настроить ваш профиль?
-"""
-        
-        keyboard = [
-            [InlineKeyboardButton("🚀 Да, давайте настроим!", callback_data="start_setup")],
-            [InlineKeyboardButton("⏭️ Пропустить (базовые настройки)", callback_data="skip_setup")]
-        ]
+        welcome_message = _ONBOARDING_WELCOME_TEMPLATE.format(first_name=user.first_name)
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = _markup("onboarding_welcome")
         
         if update.callback_query:
             await update.callback_query.edit_message_text(
@@ -1145,22 +1474,9 @@ class CalorieBotHandlers:
         """Шаг 1: Выбор пола"""
         query = update.callback_query
         
-        message = f"""
-👤 **Шаг 1 из 5: Ваш пол**
-
-Пол влияет на базальный метаболизм и расчет нормы калорий.
-
-Выберите ваш пол:
-"""
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("👨 Мужской", callback_data="gender_male"),
-                InlineKeyboardButton("👩 Женский", callback_data="gender_female")
-            ]
-        ]
+        message = _ONBOARDING_GENDER_TEXT
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = _markup("onboarding_gender")
         
         await query.edit_message_text(
             message,
@@ -1173,12 +1489,13 @@ class CalorieBotHandlers:
         """Шаг 2: Ввод возраста"""
         query = update.callback_query
         
-        # Сохраняем выбранный пол
+        # Сохраняем выбранный пол - с него начинается новое состояние онбординга
+        state = context.user_data['onboarding'] = OnboardingState()
         if query.data == "gender_male":
-            context.user_data['onboarding_gender'] = 'male'
+            state.gender = 'male'
             gender_text = "мужской"
         else:
-            context.user_data['onboarding_gender'] = 'female'
+            state.gender = 'female'
             gender_text = "женский"
         
         message = f"""
@@ -1191,8 +1508,7 @@ class CalorieBotHandlers:
 **Напишите ваш возраст** (например: 25):
 """
         
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="start_setup")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = _markup("onboarding_age")
         
         await query.edit_message_text(
             message,
@@ -1205,16 +1521,20 @@ class CalorieBotHandlers:
     @staticmethod
     async def onboarding_height(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Шаг 3: Ввод роста"""
-        try:
-            age = int(update.message.text.strip())
-            if age < 10 or age > 100:
-                await update.message.reply_text("❌ Пожалуйста, введите корректный возраст (10-100 лет)")
-                return
-            
-            context.user_data['onboarding_age'] = age
-            gender_text = "мужской" if context.user_data['onboarding_gender'] == 'male' else "женский"
-            
-            message = f"""
+        match = _INT_INPUT_RE.match(update.message.text)
+        if not match:
+            await update.message.reply_text("❌ Пожалуйста, введите возраст числом (например: 25)")
+            return
+        age = int(match.group(1))
+        if age < 10 or age > 100:
+            await update.message.reply_text("❌ Пожалуйста, введите корректный возраст (10-100 лет)")
+            return
+        
+        state = context.user_data['onboarding']
+        state.age = age
+        gender_text = "мужской" if state.gender == 'male' else "женский"
+        
+        message = f"""
 📏 **Шаг 3 из 5: Ваш рост**
 
 ✅ Пол: {gender_text}
@@ -1224,35 +1544,35 @@ class CalorieBotHandlers:
 
 **Напишите ваш рост в сантиметрах** (например: 175):
 """
-            
-            keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="onboarding_age")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await update.message.reply_text(
-                message,
-                parse_mode=ParseMode.MARKDOWN,
-                reply_markup=reply_markup
-            )
-            
-            context.user_data['waiting_for'] = 'height'
-            
-        except ValueError:
-            await update.message.reply_text("❌ Пожалуйста, введите возраст числом (например: 25)")
+        
+        reply_markup = _markup("onboarding_height")
+        
+        await update.message.reply_text(
+            message,
+            parse_mode=ParseMode.MARKDOWN,
+            reply_markup=reply_markup
+        )
+        
+        context.user_data['waiting_for'] = 'height'
 
     @staticmethod
     async def onboarding_weight(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Шаг 4: Ввод веса"""
-        try:
-            height = float(update.message.text.strip())
-            if height < 100 or height > 250:
-                await update.message.reply_text("❌ Пожалуйста, введите корректный рост (100-250 см)")
-                return
-            
-            context.user_data['onboarding_height'] = height
-            gender_text = "мужской" if context.user_data['onboarding_gender'] == 'male' else "женский"
-            age = context.user_data['onboarding_age']
-            
-            message = f"""
+        match = _NUMBER_INPUT_RE.match(update.message.text)
+        if not match:
+            await update.message.reply_text("❌ Пожалуйста, введите рост числом (например: 175)")
+            return
+        height = float(match.group(1).replace(',', '.'))
+        if height < 100 or height > 250:
+            await update.message.reply_text("❌ Пожалуйста, введите корректный рост (100-250 см)")
+            return
+        
+        state = context.user_data['onboarding']
+        state.height = height
+        gender_text = "мужской" if state.gender == 'male' else "женский"
+        age = state.age
+        
+        message = f"""
 ⚖️ **Шаг 4 из 5: Ваш вес**
 
 ✅ Пол: {gender_text}
@@ -1263,36 +1583,36 @@ class CalorieBotHandlers:
 
 **Напишите ваш текущий вес в килограммах** (например: 70 или 65.5):
 """
-            
-            keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="onboarding_height")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await update.message.reply_text(
-                message,
-                parse_mode=ParseMode.MARKDOWN,
-                reply_markup=reply_markup
-            )
-            
-            context.user_data['waiting_for'] = 'weight'
-            
-        except ValueError:
-            await update.message.reply_text("❌ Пожалуйста, введите рост числом (например: 175)")
+        
+        reply_markup = _markup("onboarding_weight")
+        
+        await update.message.reply_text(
+            message,
+            parse_mode=ParseMode.MARKDOWN,
+            reply_markup=reply_markup
+        )
+        
+        context.user_data['waiting_for'] = 'weight'
 
     @staticmethod
     async def onboarding_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Шаг 5: Выбор уровня активности"""
-        try:
-            weight = float(update.message.text.strip())
-            if weight < 30 or weight > 200:
-                await update.message.reply_text("❌ Пожалуйста, введите корректный вес (30-200 кг)")
-                return
-            
-            context.user_data['onboarding_weight'] = weight
-            gender_text = "мужской" if context.user_data['onboarding_gender'] == 'male' else "женский"
-            age = context.user_data['onboarding_age']
-            height = context.user_data['onboarding_height']
-            
-            message = f"""
+        match = _NUMBER_INPUT_RE.match(update.message.text)
+        if not match:
+            await update.message.reply_text("❌ Пожалуйста, введите вес числом (например: 70 или 65.5)")
+            return
+        weight = float(match.group(1).replace(',', '.'))
+        if weight < 30 or weight > 200:
+            await update.message.reply_text("❌ Пожалуйста, введите корректный вес (30-200 кг)")
+            return
+        
+        state = context.user_data['onboarding']
+        state.weight = weight
+        gender_text = "мужской" if state.gender == 'male' else "женский"
+        age = state.age
+        height = state.height
+        
+        message = f"""
 🏃 **Шаг 5 из 5: Уровень активности**
 
 ✅ Пол: {gender_text}
@@ -1302,25 +1622,16 @@ class CalorieBotHandlers:
 
 Выберите ваш уровень физической активности:
 """
-            
-            keyboard = [
-                [InlineKeyboardButton("🛋️ Низкий (сидячая работа, нет спорта)", callback_data="activity_low")],
-                [InlineKeyboardButton("🚶 Умеренный (легкие тренировки 1-3 раза в неделю)", callback_data="activity_moderate")],
-                [InlineKeyboardButton("🏃 Высокий (интенсивные тренировки 4-7 раз в неделю)", callback_data="activity_high")]
-            ]
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await update.message.reply_text(
-                message,
-                parse_mode=ParseMode.MARKDOWN,
-                reply_markup=reply_markup
-            )
-            
-            context.user_data['waiting_for'] = 'activity'
-            
-        except ValueError:
-            await update.message.reply_text("❌ Пожалуйста, введите вес числом (например: 70 или 65.5)")
+        
+        reply_markup = _markup("onboarding_activity")
+        
+        await update.message.reply_text(
+            message,
+            parse_mode=ParseMode.MARKDOWN,
+            reply_markup=reply_markup
+        )
+        
+        context.user_data['waiting_for'] = 'activity'
 
     @staticmethod
     async def complete_onboarding(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1338,13 +1649,11 @@ class CalorieBotHandlers:
         activity_level, activity_text = activity_mapping[query.data]
         
         # Сохраняем уровень активности в контексте
-        context.user_data['onboarding_activity'] = activity_level
-        
+        state = context.user_data['onboarding']
+        state.activity = activity_level
+
         # Получаем все данные из контекста
-        gender = context.user_data['onboarding_gender']
-        age = context.user_data['onboarding_age']
-        height = context.user_data['onboarding_height']
-        weight = context.user_data['onboarding_weight']
+        gender, age, height, weight = state.gender, state.age, state.height, state.weight
         
         # Шаг выбора цели по весу временно отключен
         # message = f"🎯 **Последний шаг: выберите вашу цель**\n\n"
@@ -1370,7 +1679,8 @@ class CalorieBotHandlers:
         # )
         
         # Завершаем онбординг напрямую
-        daily_calories = DatabaseManager.complete_onboarding(
+        daily_calories = await asyncio.to_thread(
+            DatabaseManager.complete_onboarding,
             telegram_id=user.id,
             weight=weight,
             height=height,
@@ -1383,23 +1693,13 @@ class CalorieBotHandlers:
         
         if daily_calories:
             # Очищаем данные онбординга
-            for key in ['onboarding_gender', 'onboarding_age', 'onboarding_height', 'onboarding_weight', 'waiting_for']:
-                context.user_data.pop(key, None)
+            context.user_data.pop('onboarding', None)
+            context.user_data.pop('waiting_for', None)
             
             # Рассчитываем ИМТ
-            bmi = weight / ((height/100) ** 2)
-            if bmi < 18.5:
-                bmi_status = "Недостаток веса"
-                bmi_emoji = "📉"
-            elif bmi < 25:
-                bmi_status = "Нормальный вес"
-                bmi_emoji = "✅"
-            elif bmi < 30:
-                bmi_status = "Избыточный вес"
-                bmi_emoji = "📈"
-            else:
-                bmi_status = "Ожирение"
-                bmi_emoji = "🔺"
+            height_m = height * 0.01
+            bmi = weight / (height_m * height_m)
+            bmi_status, bmi_emoji = _BMI_LABELS[bisect.bisect_right(_BMI_EDGES, bmi)]
             
             gender_text = "мужской" if gender == 'male' else "женский"
             
@@ -1423,12 +1723,7 @@ class CalorieBotHandlers:
 💡 **Совет:** Норма рассчитана для поддержания текущего веса. Вы можете изменить цель в настройках для похудения или набора массы.
 """
             
-            keyboard = [
-                [InlineKeyboardButton("🍽️ Начать анализ еды!", callback_data="add_photo_tip")],
-                [InlineKeyboardButton("👤 Мой профиль", callback_data="profile")]
-            ]
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = _markup("onboarding_done")
             
             await query.edit_message_text(
                 success_message,
@@ -1438,7 +1733,7 @@ class CalorieBotHandlers:
         else:
             await query.edit_message_text(
                 "❌ Произошла ошибка при настройке профиля. Попробуйте еще раз.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Попробовать снова", callback_data="start_onboarding")]])
+                reply_markup=_markup("onboarding_retry")
             )
     
     @staticmethod
@@ -1457,19 +1752,16 @@ class CalorieBotHandlers:
         weight_goal = goal_mapping.get(query.data, 'maintain')
         
         # Получаем все данные из контекста
-        gender = context.user_data['onboarding_gender']
-        age = context.user_data['onboarding_age']
-        height = context.user_data['onboarding_height']
-        weight = context.user_data['onboarding_weight']
-        activity_level = context.user_data['onboarding_activity']
+        state = context.user_data['onboarding']
+        gender, age, height, weight = state.gender, state.age, state.height, state.weight
+        activity_level = state.activity
         
         # Завершаем онбординг и получаем рассчитанную норму калорий
-        import logging
-        logger = logging.getLogger(__name__)
         logger.info(f"🎯 BOT: Вызываем complete_onboarding для пользователя {user.id}")
         logger.info(f"🎯 BOT: Данные: weight={weight}, height={height}, age={age}, gender={gender}, activity={activity_level}, weight_goal={weight_goal}")
         
-        daily_calories = DatabaseManager.complete_onboarding(
+        daily_calories = await asyncio.to_thread(
+            DatabaseManager.complete_onboarding,
             telegram_id=user.id,
             weight=weight,
             height=height,
@@ -1483,23 +1775,13 @@ class CalorieBotHandlers:
         
         if daily_calories:
             # Очищаем данные онбординга
-            for key in ['onboarding_gender', 'onboarding_age', 'onboarding_height', 'onboarding_weight', 'waiting_for']:
-                context.user_data.pop(key, None)
+            context.user_data.pop('onboarding', None)
+            context.user_data.pop('waiting_for', None)
             
             # Рассчитываем ИМТ
-            bmi = weight / ((height/100) ** 2)
-            if bmi < 18.5:
-                bmi_status = "Недостаток веса"
-                bmi_emoji = "📉"
-            elif bmi < 25:
-                bmi_status = "Нормальный вес"
-                bmi_emoji = "✅"
-            elif bmi < 30:
-                bmi_status = "Избыточный вес"
-                bmi_emoji = "📈"
-            else:
-                bmi_status = "Ожирение"
-                bmi_emoji = "🔺"
+            height_m = height * 0.01
+            bmi = weight / (height_m * height_m)
+            bmi_status, bmi_emoji = _BMI_LABELS[bisect.bisect_right(_BMI_EDGES, bmi)]
             
             gender_text = "мужской" if gender == 'male' else "женский"
             activity_text = {
@@ -1528,12 +1810,7 @@ class CalorieBotHandlers:
 💡 **Совет:** Норма рассчитана для поддержания текущего веса. Вы можете изменить цель в настройках для похудения или набора массы.
 """
             
-            keyboard = [
-                [InlineKeyboardButton("🍽️ Начать анализ еды!", callback_data="add_photo_tip")],
-                [InlineKeyboardButton("👤 Мой профиль", callback_data="profile")]
-            ]
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = _markup("onboarding_done")
             
             await query.edit_message_text(
                 success_message,
@@ -1551,7 +1828,8 @@ class CalorieBotHandlers:
         user = update.effective_user
         
         # Устанавливаем базовые настройки
-        DatabaseManager.complete_onboarding(
+        await asyncio.to_thread(
+            DatabaseManager.complete_onboarding,
             telegram_id=user.id,
             weight=70.0,  # Средний вес
             height=170.0,  # Средний рост
@@ -1572,12 +1850,7 @@ class CalorieBotHandlers:
 Отправьте фото еды и получите анализ калорий!
 """
         
-        keyboard = [
-            [InlineKeyboardButton("📸 Анализ фото", callback_data="add_photo_tip")],
-            [InlineKeyboardButton("👤 Мой профиль", callback_data="profile")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = _markup("onboarding_skipped")
         
         await query.edit_message_text(
             message,
@@ -1599,44 +1872,28 @@ class CalorieBotHandlers:
     async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда истории питания"""
         try:
-            user = update.effective_user
-            db_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
+            db_user = await CalorieBotHandlers.get_db_user(update, context)
             
             # Получаем последние записи
-            from database import SessionLocal, FoodEntry
-            db = SessionLocal()
-            try:
-                recent_entries = db.query(FoodEntry).filter(
-                    FoodEntry.user_id == db_user.id
-                ).order_by(FoodEntry.created_at.desc()).limit(10).all()
-                
-                if not recent_entries:
-                    message = "📅 **История питания пуста**\n\nНачните с отправки фото еды!"
-                else:
-                    message = "📅 **Последние записи:**\n\n"
-                    for entry in recent_entries:
-                        date_str = entry.created_at.strftime("%d.%m %H:%M")
-                        message += f"• {date_str} - {entry.total_calories:.0f} ккал\n"
-                        # Пытаемся извлечь название еды из JSON
-                        try:
-                            import json
-                            if entry.food_items:
-                                food_data = json.loads(entry.food_items)
-                                if isinstance(food_data, list) and len(food_data) > 0:
-                                    first_item = food_data[0]
-                                    if isinstance(first_item, dict) and 'name' in first_item:
-                                        message += f"  {first_item['name']}\n"
-                        except:
-                            pass  # Если не удалось распарсить JSON, просто пропускаем
-                        message += "\n"
-                
-                await update.message.reply_text(
-                    message,
-                    parse_mode=ParseMode.MARKDOWN,
-                    reply_markup=CalorieBotHandlers.get_main_keyboard()
-                )
-            finally:
-                db.close()
+            recent_entries = await asyncio.to_thread(DatabaseManager.get_recent_food_entries, db_user.id, 10)
+            
+            if not recent_entries:
+                message = "📅 **История питания пуста**\n\nНачните с отправки фото еды!"
+            else:
+                parts = ["📅 **Последние записи:**\n\n"]
+                for entry in recent_entries:
+                    date_str = _format_day_time(entry['created_at'])
+                    parts.append(f"• {date_str} - {entry['total_calories']:.0f} ккал\n")
+                    if entry['first_item_name']:
+                        parts.append(f"  {entry['first_item_name']}\n")
+                    parts.append("\n")
+                message = "".join(parts)
+            
+            await update.message.reply_text(
+                message,
+                parse_mode=ParseMode.MARKDOWN,
+                reply_markup=CalorieBotHandlers.get_main_keyboard()
+            )
         except Exception as e:
             logger.error(f"Ошибка в history_command: {e}")
             await update.message.reply_text(
@@ -1650,26 +1907,21 @@ class CalorieBotHandlers:
         user = update.effective_user
         
         # Проверяем, что это админ
-        if user.id != 247485745:  # Замените на ваш Telegram ID
+        if not CalorieBotHandlers.is_admin(user.id):
             await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
             return
         
         try:
-            # Подключаемся к базе данных
-            from database import SessionLocal
-            db = SessionLocal()
-            
-            # Выполняем миграцию
-            from sqlalchemy import text
-            db.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS weight_goal VARCHAR(20) DEFAULT 'maintain'"))
-            db.commit()
+            # Подключаемся к базе данных и выполняем миграцию
+            await asyncio.to_thread(
+                DatabaseManager.execute_migration,
+                "ALTER TABLE users ADD COLUMN IF NOT EXISTS weight_goal VARCHAR(20) DEFAULT 'maintain'"
+            )
             
             await update.message.reply_text("✅ Поле weight_goal успешно добавлено в базу данных!")
             
         except Exception as e:
             await update.message.reply_text(f"❌ Ошибка при миграции: {str(e)}")
-        finally:
-            db.close()
     
     @staticmethod
     async def migrate_timezone_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1677,51 +1929,51 @@ class CalorieBotHandlers:
         user = update.effective_user
         
         # Проверяем, что это админ
-        if user.id != 247485745:  # Замените на ваш Telegram ID
+        if not CalorieBotHandlers.is_admin(user.id):
             await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
             return
         
         try:
-            # Подключаемся к базе данных
-            from database import SessionLocal
-            db = SessionLocal()
-            
-            # Выполняем миграцию
-            from sqlalchemy import text
-            db.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS timezone VARCHAR(50) DEFAULT 'UTC'"))
-            db.commit()
+            # Подключаемся к базе данных и выполняем миграцию
+            await asyncio.to_thread(
+                DatabaseManager.execute_migration,
+                "ALTER TABLE users ADD COLUMN IF NOT EXISTS timezone VARCHAR(50) DEFAULT 'UTC'"
+            )
             
             await update.message.reply_text("✅ Поле timezone успешно добавлено в базу данных!")
             
         except Exception as e:
             await update.message.reply_text(f"❌ Ошибка при миграции: {str(e)}")
-        finally:
-            db.close()
     
     @staticmethod
     async def undo_last_entry_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик отмены последнего анализа калорий"""
-        user = update.effective_user
-        db_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
+        db_user = await CalorieBotHandlers.get_db_user(update, context)
         user_timezone = getattr(db_user, 'timezone', 'UTC') or 'UTC'
         
         # Удаляем последнюю запись
-        deleted_entry = DatabaseManager.delete_last_food_entry(db_user.id, user_timezone)
+        deleted_entry = await asyncio.to_thread(DatabaseManager.delete_last_food_entry, db_user.id, user_timezone)
         
         if deleted_entry:
-            # Получаем обновленную статистику
-            today_calories = DatabaseManager.get_today_calories(db_user.id, user_timezone)
+            # Итог за сегодня пересчитан в той же транзакции - сразу обновляем счетчик в Redis
+            today_calories = deleted_entry['today_calories']
+            if today_calories is not None:
+                user_today = get_user_today_date(user_timezone)
+                await redis_cache.set_today_calories(
+                    db_user.id, user_today, today_calories, get_user_day_end(user_today, user_timezone)
+                )
+            else:
+                today_calories = await CalorieBotHandlers.get_today_calories(db_user)
             daily_goal = db_user.daily_calorie_goal
             
             # Форматируем время записи
             try:
-                import json
-                food_data = json.loads(deleted_entry['food_items'])
+                food_data = orjson.loads(deleted_entry['food_items'])
                 food_name = food_data[0]['name'] if isinstance(food_data, list) and len(food_data) > 0 and 'name' in food_data[0] else "Блюдо"
             except:
                 food_name = "Блюдо"
             
-            entry_time = deleted_entry['created_at'].strftime("%d.%m %H:%M")
+            entry_time = _format_day_time(deleted_entry['created_at'])
             
             message = f"""
 ✅ **Последний анализ отменен!**
@@ -1747,121 +1999,85 @@ class CalorieBotHandlers:
 """
         
         await update.message.reply_text(
-            message,
-            parse_mode=ParseMode.MARKDOWN,
-            reply_markup=CalorieBotHandlers.get_main_keyboard()
-        )
-    
-    @staticmethod
-    async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Команда /help"""
-        help_message = f"""
-❓ **Справка по использованию бота**
-
-🚀 **Быстрый старт:**
-1️⃣ Отправьте фото еды боту
-2️⃣ Получите анализ калорий за 5 секунд  
-3️⃣ Следите за прогрессом в статистике
-
-📸 **Анализ фото еды:**
-• AI определяет виды продуктов
-• Подсчитывает калории, БЖУ и вес
-• Работает с любыми блюдами
-• Точность анализа 85-95%
-
-💡 **Советы для лучших результатов:**
-🔍 Хорошее освещение
-🍽️ Вся порция в кадре
-📏 Добавьте ложку для масштаба
-🎯 Четкое фото без размытия
-
-📊 **Что отслеживает бот:**
-• Ежедневные калории и БЖУ
-• Прогресс к вашей цели
-• Статистика по дням/неделям  
-• История всех записей
-
-⚙️ **Персонализация:**
-• Установите свою цель калорий
-• Укажите вес, рост, возраст
-• Настройте уведомления
-• Экспортируйте данные
-
-🔒 **Безопасность данных:**
-{'''• ✅ PostgreSQL - данные сохраняются навсегда
-• 🛡️ Никаких потерь при обновлениях''' if config.DATABASE_URL.startswith('postgresql') else 
-'''• ⚠️ SQLite - данные могут сбрасываться
-• 💡 Рекомендуется настроить PostgreSQL'''}
-
-❓ Остались вопросы? Просто напишите мне!
-"""
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("📸 Как отправить фото", callback_data="add_photo_tip"),
-                InlineKeyboardButton("🎯 Моя цель", callback_data="my_goal")
-            ],
-            [
-                InlineKeyboardButton("👤 Мой профиль", callback_data="profile"),
-                InlineKeyboardButton("📊 Статистика", callback_data="stats")
-            ],
-            [
-                InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")
-            ]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+            message,
+            parse_mode=ParseMode.MARKDOWN,
+            reply_markup=CalorieBotHandlers.get_main_keyboard()
+        )
+    
+    @staticmethod
+    async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Команда /help"""
+        reply_markup = _HELP_MARKUP
         
         message = update.message or update.callback_query.message
         
         if update.callback_query:
             await update.callback_query.edit_message_text(
-                help_message,
-                parse_mode=ParseMode.MARKDOWN,
+                _HELP_MESSAGE_HTML,
+                parse_mode=ParseMode.HTML,
                 reply_markup=reply_markup
             )
         else:
             # Используем постоянную клавиатуру для обычных сообщений
             main_keyboard = CalorieBotHandlers.get_main_keyboard()
             await update.message.reply_text(
-                help_message,
-                parse_mode=ParseMode.MARKDOWN,
+                _HELP_MESSAGE_HTML,
+                parse_mode=ParseMode.HTML,
                 reply_markup=main_keyboard
             )
     
     @staticmethod
+    async def download_photo(file):
+        """Скачивает фото по прямой ссылке через общую aiohttp-сессию, PTB - запасной вариант
+        
+        Возвращает bytes или bytearray - без промежуточного BytesIO и копии getvalue().
+        """
+        try:
+            async with get_http_session().get(file.file_path) as response:
+                response.raise_for_status()
+                return await response.read()
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось скачать фото напрямую, используем PTB: {e}")
+            return await file.download_as_bytearray()
+    
+    @staticmethod
+    @serialized_per_chat
     async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик фотографий еды"""
-        user = update.effective_user
         
         # Сбрасываем флаг сохранения анализа при получении нового фото
         context.user_data.pop('preserve_analysis_message', None)
         
         # Получаем или создаем пользователя
-        db_user = DatabaseManager.get_or_create_user(
-            telegram_id=user.id,
-            username=user.username,
-            first_name=user.first_name,
-            last_name=user.last_name
-        )
+        db_user = await CalorieBotHandlers.get_db_user(update, context)
         
         # Отправляем сообщение о начале анализа
         analyzing_message = await update.message.reply_text(
-            f"{config.EMOJIS['food']} Анализирую ваше блюдо...\n⏳ Это может занять несколько секунд"
+            _PHOTO_ANALYZING_TEXT
         )
         
         try:
-            # Получаем фото наибольшего размера
-            photo = update.message.photo[-1]
+            # Берем наименьший размер, которого хватает анализатору (все равно уменьшит до
+            # AI_IMAGE_MAX_SIZE), - меньше скачивать; если такого нет, самый большой
+            photo = next(
+                (size for size in update.message.photo if max(size.width, size.height) >= config.AI_IMAGE_MAX_SIZE),
+                update.message.photo[-1]
+            )
             file = await context.bot.get_file(photo.file_id)
             
             # Скачиваем фото
-            image_bytes = BytesIO()
-            await file.download_to_memory(image_bytes)
-            image_data = image_bytes.getvalue()
-            
-            # Анализируем с помощью AI
-            result = await analyzer.analyze_food_image(image_data)
+            image_data = await CalorieBotHandlers.download_photo(file)
+            
+            # То же фото уже анализировали - берем результат из Redis, без запроса к AI
+            image_digest = hashlib.sha256(image_data).hexdigest()
+            result = await redis_cache.get_photo_analysis(image_digest)
+            if result is None:
+                # Анализируем с помощью AI
+                async with _AI_SEMAPHORE:
+                    result = await analyzer.analyze_food_image(image_data)
+                # Кешируем только успешный анализ, ошибки и пустые результаты повторяем
+                if not result.get('error') and result.get('total_calories', 0) > 0:
+                    await redis_cache.set_photo_analysis(image_digest, result)
             
             # Показываем ошибку только если совсем ничего не найдено
             if result.get('error') and result.get('total_calories', 0) == 0:
@@ -1872,10 +2088,16 @@ class CalorieBotHandlers:
             
             # Сохраняем результат в базу данных с учетом таймзоны пользователя
             user_timezone = getattr(db_user, 'timezone', 'UTC') or 'UTC'
-            if result.get('total_calories', 0) > 0:
-                DatabaseManager.add_food_entry(
+            user_today = get_user_today_date(user_timezone)
+            expire_at = get_user_day_end(user_today, user_timezone)
+            save_entry = result.get('total_calories', 0) > 0
+            if save_entry:
+                # Запись и дневной счетчик обновляются в одной транзакции -
+                # итог за день приходит сразу, без повторного запроса
+                db_task = asyncio.create_task(asyncio.to_thread(
+                    DatabaseManager.add_food_entry,
                     user_id=db_user.id,
-                    food_data=json.dumps(result['food_items'], ensure_ascii=False),
+                    food_data=orjson.dumps(result['food_items']).decode(),
                     total_calories=result['total_calories'],
                     total_proteins=result.get('total_proteins', 0),
                     total_carbs=result.get('total_carbs', 0),
@@ -1883,13 +2105,21 @@ class CalorieBotHandlers:
                     confidence=result.get('confidence', 0),
                     photo_id=photo.file_id,
                     user_timezone=user_timezone
-                )
-            
-            # Форматируем результат
+                ))
+            else:
+                db_task = asyncio.create_task(CalorieBotHandlers.get_today_calories(db_user))
+
+            # Форматируем результат, пока запрос к БД выполняется в потоке
             formatted_result = analyzer.format_analysis_result(result)
+
+            if save_entry:
+                _, today_calories = await db_task
+                # Счетчик дня в Redis общий для всех процессов бота
+                await redis_cache.set_today_calories(db_user.id, user_today, today_calories, expire_at)
+            else:
+                today_calories = await db_task
             
-            # Добавляем информацию о дневном прогрессе с учетом таймзоны
-            today_calories = DatabaseManager.get_today_calories(db_user.id, user_timezone)
+            # Добавляем информацию о дневном прогрессе - только арифметика в памяти
             daily_goal = db_user.daily_calorie_goal
             remaining = daily_goal - today_calories
             
@@ -1909,29 +2139,7 @@ class CalorieBotHandlers:
             context.user_data['last_analysis_result'] = result
             context.user_data['preserve_analysis_message'] = True  # Флаг для сохранения сообщения с анализом
             
-            # Улучшенная клавиатура с действиями
-            keyboard = [
-                # Первый ряд - уточнение калорий
-                [
-                    InlineKeyboardButton("🔍 Уточнить калории", callback_data="refine_calories")
-                ],
-                # Второй ряд - основные действия
-                [
-                    InlineKeyboardButton("📊 Посмотреть статистику", callback_data="stats"),
-                    InlineKeyboardButton("👤 Мой профиль", callback_data="profile")
-                ],
-                # Третий ряд - редактирование и добавление
-                [
-                    InlineKeyboardButton("🔧 Исправить анализ", callback_data="correct_analysis"),
-                    InlineKeyboardButton("➕ Добавить еще блюдо", callback_data="add_more")
-                ],
-                # Четвертый ряд - навигация
-                [
-                    InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")
-                ]
-            ]
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = _PHOTO_RESULT_MARKUP
             
             # Отправляем результат
             await analyzing_message.edit_text(
@@ -1943,69 +2151,57 @@ class CalorieBotHandlers:
         except Exception as e:
             logger.error(f"Ошибка при обработке фото: {e}")
             await analyzing_message.edit_text(
-                f"{config.EMOJIS['error']} Произошла ошибка при анализе фото.\n\nПожалуйста, попробуйте еще раз или отправьте другое изображение."
+                _PHOTO_ERROR_TEXT
             )
     
     @staticmethod
     async def stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик статистики"""
-        user = update.effective_user if update.message else update.callback_query.from_user
         
-        db_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
+        db_user = await CalorieBotHandlers.get_db_user(update, context)
         
         # Получаем статистику за неделю
-        stats = DatabaseManager.get_user_stats(db_user.id, days=7)
+        stats = await CalorieBotHandlers.cached_profile_query(
+            db_user.id, 'stats_7', DatabaseManager.get_user_stats, db_user.id, days=7
+        )
         
         if not stats:
             message = f"{config.EMOJIS['stats']} **Статистика питания**\n\nУ вас пока нет записей о питании.\nОтправьте фото еды, чтобы начать отслеживание!"
         else:
-            # Сегодняшняя статистика
-            today = datetime.now().date()
-            today_stat = next((s for s in stats if s.date == today), None)
-            
-            message = f"{config.EMOJIS['stats']} **Статистика питания**\n\n"
+            # Сегодняшняя статистика - точечный запрос по (user_id, date)
+            user_timezone = getattr(db_user, 'timezone', 'UTC') or 'UTC'
+            today = get_user_today_date(user_timezone)
+            today_stat = await CalorieBotHandlers.cached_profile_query(
+                db_user.id, f'day_{today}', DatabaseManager.get_daily_stat, db_user.id, today
+            )
             
+            message = _STATS_HEADER
+
             if today_stat:
-                message += f"**Сегодня ({today.strftime('%d.%m')})**\n"
-                message += f"{config.EMOJIS['fire']} Калории: {today_stat.total_calories:.0f} из {db_user.daily_calorie_goal}\n"
-                
-                # Отображаем цель по весу
-                weight_goal_text = {
-                    'lose': '📉 Похудение',
-                    'maintain': '⚖️ Поддержание веса',
-                    'gain': '📈 Набор веса',
-                    'recomp': '💪 Рекомпозиция'
-                }.get(db_user.weight_goal, '⚖️ Поддержание веса')
-                message += f"🎯 Цель: {weight_goal_text}\n"
-                
-                message += f"{config.EMOJIS['muscle']} Белки: {today_stat.total_proteins:.1f}г\n"
-                message += f"🍞 Углеводы: {today_stat.total_carbs:.1f}г\n"
-                message += f"🥑 Жиры: {today_stat.total_fats:.1f}г\n"
-                message += f"{config.EMOJIS['food']} Приемов пищи: {today_stat.meals_count}\n\n"
-                
                 # Прогресс к цели
                 progress = (today_stat.total_calories / db_user.daily_calorie_goal) * 100
-                if progress <= 100:
-                    message += f"📊 Прогресс к цели: {progress:.1f}% {config.EMOJIS['checkmark']}\n\n"
-                else:
-                    message += f"📊 Превышение цели: {progress:.1f}% {config.EMOJIS['warning']}\n\n"
-            
+                progress_template = _STATS_PROGRESS_OK if progress <= 100 else _STATS_PROGRESS_OVER
+                message += _STATS_TODAY_TEMPLATE.format(
+                    day=f"{today.day:02d}.{today.month:02d}",
+                    calories=today_stat.total_calories,
+                    goal=db_user.daily_calorie_goal,
+                    weight_goal=_WEIGHT_GOAL_LABELS.get(db_user.weight_goal, '⚖️ Поддержание веса'),
+                    proteins=today_stat.total_proteins,
+                    carbs=today_stat.total_carbs,
+                    fats=today_stat.total_fats,
+                    meals=today_stat.meals_count,
+                    progress=progress_template.format(progress)
+                )
+
             # Средние за неделю
-            weekly_avg_calories = sum(s.total_calories for s in stats) / len(stats)
             weekly_total_calories = sum(s.total_calories for s in stats)
-            
-            message += f"**За неделю (средние в день)**\n"
-            message += f"{config.EMOJIS['fire']} Калории: {weekly_avg_calories:.0f}\n"
-            message += f"📈 Всего за неделю: {weekly_total_calories:.0f} ккал\n"
-            message += f"📅 Дней с записями: {len(stats)} из 7"
-        
-        keyboard = [
-            [InlineKeyboardButton(f"{config.EMOJIS['chart']} Подробная статистика", callback_data="detailed_stats")],
-            [InlineKeyboardButton(f"{config.EMOJIS['settings']} Настройки цели", callback_data="settings")],
-            [InlineKeyboardButton(f"{config.EMOJIS['back']} Главное меню", callback_data="main_menu")]
-        ]
+            weekly_avg_calories = weekly_total_calories / len(stats)
+
+            message += _STATS_WEEK_TEMPLATE.format(
+                avg=weekly_avg_calories, total=weekly_total_calories, days=len(stats)
+            )
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = _STATS_MARKUP
         
         # Проверяем флаг сохранения сообщения с анализом фото
         preserve_analysis = context.user_data.get('preserve_analysis_message', False)
@@ -2023,10 +2219,8 @@ class CalorieBotHandlers:
             # Если это callback после анализа фото или обычное сообщение - отправляем новое сообщение
             if update.callback_query:
                 await update.callback_query.answer()  # Закрываем "часики" на кнопке
-                bot = update.callback_query.get_bot()
-                chat_id = update.callback_query.message.chat_id
-                await bot.send_message(
-                    chat_id=chat_id,
+                await context.bot.send_message(
+                    chat_id=update.effective_chat.id,
                     text=message,
                     parse_mode=ParseMode.MARKDOWN,
                     reply_markup=reply_markup
@@ -2042,7 +2236,7 @@ class CalorieBotHandlers:
     async def settings_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик настроек"""
         user = update.effective_user if update.message else update.callback_query.from_user
-        db_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
+        db_user = await CalorieBotHandlers.get_db_user(update, context)
         
         # ЛОГИРОВАНИЕ: Текущие настройки пользователя
         logger.info(f"⚙️ Загрузка настроек пользователя {user.id} ({db_user.telegram_id}):")
@@ -2066,26 +2260,12 @@ class CalorieBotHandlers:
             message += f"👤 Пол: {'мужской' if db_user.gender == 'male' else 'женский'}\n"
         
         # Отображаем цель по весу
-        weight_goal_text = {
-            'lose': '📉 Похудение',
-            'maintain': '⚖️ Поддержание веса',
-            'gain': '📈 Набор веса',
-            'recomp': '💪 Рекомпозиция'
-        }.get(db_user.weight_goal, '⚖️ Поддержание веса')
+        weight_goal_text = _WEIGHT_GOAL_LABELS.get(db_user.weight_goal, '⚖️ Поддержание веса')
         message += f"🎯 Цель: {weight_goal_text}\n"
         
         message += f"\nВыберите, что хотите настроить:"
         
-        keyboard = [
-            [InlineKeyboardButton("🎯 Изменить цель калорий", callback_data="set_calorie_goal")],
-            [InlineKeyboardButton("🎯 Изменить цель по весу", callback_data="goals")],
-            [InlineKeyboardButton(f"{config.EMOJIS['scales']} Обновить вес", callback_data="set_weight")],
-            [InlineKeyboardButton("📏 Указать рост", callback_data="set_height")],
-            [InlineKeyboardButton("👤 Указать пол и возраст", callback_data="set_personal_info")],
-            [InlineKeyboardButton(f"{config.EMOJIS['back']} Назад", callback_data="main_menu")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = _SETTINGS_MARKUP
         
         # Используем постоянную клавиатуру для обычных сообщений
         if update.callback_query:
@@ -2104,133 +2284,75 @@ class CalorieBotHandlers:
             )
     
     @staticmethod
+    @serialized_per_chat
     async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик inline кнопок"""
         query = update.callback_query
         await query.answer()
         
-        if query.data == "main_menu":
-            await CalorieBotHandlers.start_command(update, context)
-        elif query.data == "stats":
-            await CalorieBotHandlers.stats_handler(update, context)
-        elif query.data == "settings":
-            await CalorieBotHandlers.settings_handler(update, context)
-        elif query.data == "goals":
-            await CalorieBotHandlers.goals_command(update, context)
-        elif query.data == "goals_menu":
-            # Открываем меню выбора целей
-            await CalorieBotHandlers.goals_command(update, context)
-        elif query.data == "help":
-            await CalorieBotHandlers.help_command(update, context)
-        elif query.data == "add_more":
-            await query.answer()
-            bot = query.get_bot()
-            chat_id = query.message.chat_id
-            await bot.send_message(
-                chat_id=chat_id,
-                text=f"{config.EMOJIS['food']} Отправьте фото следующего блюда для анализа калорий!"
+        handler = _BUTTON_ROUTES.get(query.data)
+        if handler is None:
+            handler = next(
+                (route for prefix, route in _BUTTON_PREFIX_ROUTES if query.data.startswith(prefix)),
+                None
             )
-        elif query.data == "detailed_stats":
-            await CalorieBotHandlers.detailed_stats_handler(update, context)
-        elif query.data.startswith("set_"):
-            await CalorieBotHandlers.settings_input_handler(update, context)
-        elif query.data.startswith("goal_"):
-            await CalorieBotHandlers.goal_selection_handler(update, context)
-        elif query.data == "refine_calories":
-            await CalorieBotHandlers.refine_calories_handler(update, context)
-        elif query.data.startswith("select_food_"):
-            await CalorieBotHandlers.select_food_from_fatsecret(update, context)
-        elif query.data.startswith("apply_food_"):
-            await CalorieBotHandlers.apply_fatsecret_choice(update, context)
-        elif query.data == "cancel_refine":
-            await query.answer("✅ Оставлены исходные данные")
-            await query.edit_message_text(
-                "✅ Калории остались без изменений",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")
-                ]])
-            )
-        elif query.data == "correct_analysis":
-            await CalorieBotHandlers.correction_handler(update, context)
-        elif query.data == "cancel_correction":
-            context.user_data.pop('waiting_for', None)
-            context.user_data.pop('correction_photo_id', None)
-            await query.edit_message_text("❌ Коррекция отменена")
-        elif query.data == "daily_history":
-            await CalorieBotHandlers.daily_history_handler(update, context)
-        elif query.data == "weekly_stats_detail":
-            await CalorieBotHandlers.weekly_stats_detail_handler(update, context)
-        elif query.data == "back_to_profile":
-            await CalorieBotHandlers.back_to_profile_handler(update, context)
-        elif query.data == "edit_profile":
-            await CalorieBotHandlers.settings_handler(update, context)
-        elif query.data == "profile":
-            await CalorieBotHandlers.profile_callback_handler(update, context)
-        elif query.data == "add_photo_tip":
-            await CalorieBotHandlers.photo_tip_handler(update, context)
-        elif query.data == "my_goal":
-            await CalorieBotHandlers.my_goal_handler(update, context) 
-        elif query.data == "data_status":
-            await CalorieBotHandlers.data_status_handler(update, context)
-        
-        # Онбординг callbacks
-        elif query.data == "start_setup":
-            await CalorieBotHandlers.onboarding_gender(update, context)
-        elif query.data == "skip_setup":
-            await CalorieBotHandlers.skip_onboarding(update, context)
-        elif query.data in ["gender_male", "gender_female"]:
-            await CalorieBotHandlers.onboarding_age(update, context)
-        elif query.data in ["activity_low", "activity_moderate", "activity_high"]:
-            await CalorieBotHandlers.complete_onboarding(update, context)
+        if handler:
+            await handler(update, context)
+    
+    @staticmethod
+    async def add_more_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Кнопка "Добавить еще блюдо" после анализа"""
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=f"{config.EMOJIS['food']} Отправьте фото следующего блюда для анализа калорий!"
+        )
+    
+    @staticmethod
+    async def cancel_refine_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Отказ от уточнения калорий - оставляем исходные данные"""
+        await update.callback_query.edit_message_text(
+            "✅ Калории остались без изменений",
+            reply_markup=_markup("main_menu")
+        )
+    
+    @staticmethod
+    async def cancel_correction_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Отмена коррекции анализа"""
+        context.user_data.pop('waiting_for', None)
+        context.user_data.pop('correction_photo_id', None)
+        await update.callback_query.edit_message_text("❌ Коррекция отменена")
     
     @staticmethod
     async def detailed_stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Детальная статистика"""
-        user = update.callback_query.from_user
-        db_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
-        
-        # Получаем статистику за месяц
-        stats = DatabaseManager.get_user_stats(db_user.id, days=30)
+        db_user = await CalorieBotHandlers.get_db_user(update, context)
         
-        if not stats:
+        # Итоги за месяц считаются в базе одним запросом
+        summary = await CalorieBotHandlers.cached_profile_query(
+            db_user.id, 'stats_summary_30',
+            DatabaseManager.get_user_stats_summary, db_user.id, days=30, daily_goal=db_user.daily_calorie_goal
+        )
+        days_with_records = summary['days_count']
+
+        if not days_with_records:
             message = f"{config.EMOJIS['chart']} **Подробная статистика**\n\nНедостаточно данных для анализа.\nПродолжайте добавлять записи о питании!"
         else:
-            message = f"{config.EMOJIS['chart']} **Подробная статистика за 30 дней**\n\n"
-            
-            # Общая статистика
-            total_calories = sum(s.total_calories for s in stats)
-            avg_calories = total_calories / len(stats)
-            days_with_records = len(stats)
-            
-            message += f"**Общие показатели:**\n"
-            message += f"📊 Дней с записями: {days_with_records} из 30\n"
-            message += f"🔥 Общее потребление: {total_calories:.0f} ккал\n"
-            message += f"📈 Среднее в день: {avg_calories:.0f} ккал\n"
-            message += f"🎯 Цель в день: {db_user.daily_calorie_goal} ккал\n\n"
-            
-            # Анализ соблюдения цели
-            goal_days = sum(1 for s in stats if s.total_calories <= db_user.daily_calorie_goal)
-            goal_percentage = (goal_days / days_with_records) * 100 if days_with_records > 0 else 0
-            
-            message += f"**Соблюдение цели:**\n"
-            message += f"✅ Дней в пределах цели: {goal_days} ({goal_percentage:.1f}%)\n"
-            message += f"⚠️ Дней с превышением: {days_with_records - goal_days}\n\n"
-            
-            # Питательные вещества
-            avg_proteins = sum(s.total_proteins for s in stats) / len(stats)
-            avg_carbs = sum(s.total_carbs for s in stats) / len(stats)
-            avg_fats = sum(s.total_fats for s in stats) / len(stats)
-            
-            message += f"**Питательные вещества (среднее в день):**\n"
-            message += f"💪 Белки: {avg_proteins:.1f}г\n"
-            message += f"🍞 Углеводы: {avg_carbs:.1f}г\n"
-            message += f"🥑 Жиры: {avg_fats:.1f}г\n"
-        
-        keyboard = [
-            [InlineKeyboardButton(f"{config.EMOJIS['back']} К статистике", callback_data="stats")]
-        ]
+            total_calories = summary['total_calories']
+            goal_days = summary['goal_days']
+            message = _DETAILED_STATS_TEMPLATE.format(
+                days=days_with_records,
+                total_calories=total_calories,
+                avg_calories=total_calories / days_with_records,
+                goal=db_user.daily_calorie_goal,
+                goal_days=goal_days,
+                goal_percentage=goal_days / days_with_records * 100,
+                over_days=days_with_records - goal_days,
+                avg_proteins=summary['total_proteins'] / days_with_records,
+                avg_carbs=summary['total_carbs'] / days_with_records,
+                avg_fats=summary['total_fats'] / days_with_records
+            )
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = _markup("detailed_stats")
         
         await update.callback_query.edit_message_text(
             message,
@@ -2245,7 +2367,7 @@ class CalorieBotHandlers:
         setting_type = query.data
         
         if setting_type == "set_calorie_goal":
-            message = f"🎯 **Установка цели калорий**\n\nВведите желаемое количество калорий в день (например: 2000):"
+            message = f"🎯 <b>Установка цели калорий</b>\n\nВведите желаемое количество калорий в день (например: 2000):"
             context.user_data['waiting_for'] = 'calorie_goal'
         # elif setting_type == "set_weight_goal":  # временно отключено
         #     message = f"⚖️ **Выбор цели по весу**\n\nВыберите вашу цель:"
@@ -2267,24 +2389,20 @@ class CalorieBotHandlers:
         #     )
         #     return
         elif setting_type == "set_weight":
-            message = f"{config.EMOJIS['scales']} **Обновление веса**\n\nВведите ваш текущий вес в килограммах (например: 70.5):"
+            message = f"{config.EMOJIS['scales']} <b>Обновление веса</b>\n\nВведите ваш текущий вес в килограммах (например: 70.5):"
             context.user_data['waiting_for'] = 'weight'
         elif setting_type == "set_height":
-            message = f"📏 **Указание роста**\n\nВведите ваш рост в сантиметрах (например: 175):"
+            message = f"📏 <b>Указание роста</b>\n\nВведите ваш рост в сантиметрах (например: 175):"
             context.user_data['waiting_for'] = 'height'
         elif setting_type == "set_personal_info":
-            message = f"👤 **Личная информация**\n\nВведите ваш возраст и пол через пробел (например: 25 мужской или 30 женский):"
+            message = f"👤 <b>Личная информация</b>\n\nВведите ваш возраст и пол через пробел (например: 25 мужской или 30 женский):"
             context.user_data['waiting_for'] = 'personal_info'
         
-        keyboard = [
-            [InlineKeyboardButton(f"{config.EMOJIS['back']} Отмена", callback_data="settings")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = _CANCEL_TO_SETTINGS_MARKUP
         
         await query.edit_message_text(
             message,
-            parse_mode=ParseMode.MARKDOWN,
+            parse_mode=ParseMode.HTML,
             reply_markup=reply_markup
         )
     
@@ -2295,7 +2413,7 @@ class CalorieBotHandlers:
         await query.answer()
         
         user = query.from_user
-        db_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
+        db_user = await CalorieBotHandlers.get_db_user(update, context)
         
         # Определяем выбранную цель
         goal_mapping = {
@@ -2307,17 +2425,19 @@ class CalorieBotHandlers:
         selected_goal = goal_mapping.get(query.data, 'maintain')
         
         # Обновляем цель в базе данных
-        DatabaseManager.update_user_settings(
+        await asyncio.to_thread(
+            DatabaseManager.update_user_settings,
             user_id=db_user.id,
             weight_goal=selected_goal
         )
         
         # Пересчитываем цель калорий с учетом новой цели по весу
-        updated_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
+        updated_user = await asyncio.to_thread(DatabaseManager.get_or_create_user, telegram_id=user.id)
         new_calorie_goal = updated_user.calculate_daily_calorie_goal()
         
         # Обновляем цель калорий в базе данных
-        DatabaseManager.update_user_settings(
+        await asyncio.to_thread(
+            DatabaseManager.update_user_settings,
             user_id=db_user.id,
             daily_calorie_goal=new_calorie_goal
         )
@@ -2349,11 +2469,7 @@ class CalorieBotHandlers:
             message += "• Ожидаемый набор: ~0.3 кг/неделю\n"
             message += "• Рекомендуется силовые тренировки"
         
-        keyboard = [
-            [InlineKeyboardButton("⚙️ Настройки", callback_data="settings")],
-            [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = _markup("weight_goal_saved")
         
         await query.edit_message_text(
             message,
@@ -2368,22 +2484,14 @@ class CalorieBotHandlers:
         if update.callback_query:
             query = update.callback_query
             await query.answer()
-            user = query.from_user
-        else:
-            user = update.effective_user
             
-        db_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
+        db_user = await CalorieBotHandlers.get_db_user(update, context)
         
         # Получаем текущую цель
         current_goal = db_user.weight_goal or 'maintain'
         
         # Формируем сообщение с текущей целью
-        goal_texts = {
-            'lose': '📉 Похудение',
-            'maintain': '⚖️ Поддержание веса',
-            'gain': '📈 Набор веса',
-            'recomp': '💪 Рекомпозиция'
-        }
+        goal_texts = _WEIGHT_GOAL_LABELS
         
         current_goal_text = goal_texts.get(current_goal, '⚖️ Поддержание веса')
         
@@ -2415,15 +2523,7 @@ class CalorieBotHandlers:
         
         message += "\n**Выберите новую цель:**"
         
-        keyboard = [
-            [InlineKeyboardButton("📉 Похудеть", callback_data="goal_lose")],
-            [InlineKeyboardButton("⚖️ Сохранить вес", callback_data="goal_maintain")],
-            [InlineKeyboardButton("📈 Набрать вес", callback_data="goal_gain")],
-            [InlineKeyboardButton("💪 Рекомпозиция", callback_data="goal_recomp")],
-            [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = _markup("goals")
         
         # Отправляем сообщение в зависимости от типа update
         if update.callback_query:
@@ -2446,7 +2546,7 @@ class CalorieBotHandlers:
         await query.answer()
         
         user = query.from_user
-        db_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
+        db_user = await CalorieBotHandlers.get_db_user(update, context)
         
         # Определяем выбранную цель
         goal_mapping = {
@@ -2459,28 +2559,25 @@ class CalorieBotHandlers:
         selected_goal = goal_mapping.get(query.data, 'maintain')
         
         # Обновляем цель в базе данных
-        DatabaseManager.update_user_settings(
+        await asyncio.to_thread(
+            DatabaseManager.update_user_settings,
             user_id=db_user.id,
             weight_goal=selected_goal
         )
         
         # Пересчитываем цель калорий с учетом новой цели по весу
-        updated_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
+        updated_user = await asyncio.to_thread(DatabaseManager.get_or_create_user, telegram_id=user.id)
         new_calorie_goal = updated_user.calculate_daily_calorie_goal()
         
         # Обновляем цель калорий в базе данных
-        DatabaseManager.update_user_settings(
+        await asyncio.to_thread(
+            DatabaseManager.update_user_settings,
             user_id=db_user.id,
             daily_calorie_goal=new_calorie_goal
         )
         
         # Формируем сообщение
-        goal_texts = {
-            'lose': '📉 Похудение',
-            'maintain': '⚖️ Поддержание веса',
-            'gain': '📈 Набор веса',
-            'recomp': '💪 Рекомпозиция'
-        }
+        goal_texts = _WEIGHT_GOAL_LABELS
         
         message = f"✅ **Цель обновлена!**\n\n"
         message += f"🎯 **Новая цель:** {goal_texts[selected_goal]}\n"
@@ -2514,12 +2611,7 @@ class CalorieBotHandlers:
         
         message += "\n\n🚀 **Теперь ваша цель калорий пересчитана!**"
         
-        keyboard = [
-            [InlineKeyboardButton("🎯 Мои цели", callback_data="goals_menu")],
-            [InlineKeyboardButton("📊 Статистика", callback_data="stats")],
-            [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = _markup("goal_selected")
         
         await query.edit_message_text(
             message,
@@ -2528,6 +2620,7 @@ class CalorieBotHandlers:
         )
     
     @staticmethod
+    @serialized_per_chat
     async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик текстовых сообщений"""
         user = update.effective_user
@@ -2571,83 +2664,85 @@ class CalorieBotHandlers:
                 f"/help - помощь"
             )
     
+    @staticmethod
+    async def apply_calorie_goal_input(db_user, text: str):
+        """Ввод цели калорий. Возвращает (сообщение об успехе, текст ошибки)"""
+        match = _INT_INPUT_RE.match(text)
+        if not match:
+            return None, _INVALID_INPUT_TEXT
+        calorie_goal = int(match.group(1))
+        low, high = _SETTINGS_RANGES['calorie_goal']
+        if not low <= calorie_goal <= high:
+            return None, f"Цель калорий должна быть между {low} и {high} ккал"
+        
+        # ЛОГИРОВАНИЕ: Сохранение цели калорий
+        logger.info(f"👤 Пользователь {db_user.telegram_id} меняет цель калорий: {db_user.daily_calorie_goal} → {calorie_goal}")
+        updated_user = await asyncio.to_thread(DatabaseManager.update_user_settings, db_user.id, daily_calorie_goal=calorie_goal)
+        logger.info(f"✅ Цель обновлена в БД: {updated_user.daily_calorie_goal}")
+        return f"✅ Цель калорий установлена: {calorie_goal} ккал в день", None
+    
+    @staticmethod
+    async def apply_weight_input(db_user, text: str):
+        """Ввод веса (допускается запятая как разделитель)"""
+        match = _NUMBER_INPUT_RE.match(text)
+        if not match:
+            return None, _INVALID_INPUT_TEXT
+        weight = float(match.group(1).replace(',', '.'))
+        low, high = _SETTINGS_RANGES['weight']
+        if not low <= weight <= high:
+            return None, f"Вес должен быть между {low} и {high} кг"
+        
+        logger.info(f"👤 Пользователь {db_user.telegram_id} устанавливает вес: {weight} кг")
+        updated_user = await asyncio.to_thread(DatabaseManager.update_user_settings, db_user.id, weight=weight)
+        logger.info(f"✅ Вес сохранен в БД: {updated_user.weight}")
+        return f"✅ Вес обновлен: {weight} кг", None
+    
+    @staticmethod
+    async def apply_height_input(db_user, text: str):
+        """Ввод роста в сантиметрах"""
+        match = _INT_INPUT_RE.match(text)
+        if not match:
+            return None, _INVALID_INPUT_TEXT
+        height = int(match.group(1))
+        low, high = _SETTINGS_RANGES['height']
+        if not low <= height <= high:
+            return None, f"Рост должен быть между {low} и {high} см"
+        
+        await asyncio.to_thread(DatabaseManager.update_user_settings, db_user.id, height=height)
+        return f"✅ Рост установлен: {height} см", None
+    
+    @staticmethod
+    async def apply_personal_info_input(db_user, text: str):
+        """Ввод возраста и пола через пробел (например: 25 мужской)"""
+        low, high = _SETTINGS_RANGES['age']
+        match = _PERSONAL_INFO_INPUT_RE.match(text)
+        if not match or not low <= int(match['age']) <= high:
+            return None, f"Проверьте формат ввода: возраст ({low}-{high}) и пол (мужской/женский)"
+        age = int(match['age'])
+        gender = 'male' if match['gender'].lower() == 'муж' else 'female'
+        
+        await asyncio.to_thread(DatabaseManager.update_user_settings, db_user.id, age=age, gender=gender)
+        gender_text = 'мужской' if gender == 'male' else 'женский'
+        return f"✅ Информация обновлена: {age} лет, {gender_text}", None
+    
     @staticmethod
     async def process_settings_input(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
         """Обработка ввода настроек"""
-        user = update.effective_user
-        db_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
-        waiting_for = context.user_data.get('waiting_for')
-        
-        success = False
-        error_message = ""
-        
-        try:
-            if waiting_for == 'calorie_goal':
-                calorie_goal = int(text)
-                if 500 <= calorie_goal <= 5000:
-                    # ЛОГИРОВАНИЕ: Сохранение цели калорий
-                    logger.info(f"👤 Пользователь {user.id} ({db_user.telegram_id}) меняет цель калорий: {db_user.daily_calorie_goal} → {calorie_goal}")
-                    updated_user = DatabaseManager.update_user_settings(db_user.id, daily_calorie_goal=calorie_goal)
-                    success = True
-                    message = f"✅ Цель калорий установлена: {calorie_goal} ккал в день"
-                    logger.info(f"✅ Цель обновлена в БД: {updated_user.daily_calorie_goal}")
-                else:
-                    error_message = "Цель калорий должна быть между 500 и 5000 ккал"
-            
-            elif waiting_for == 'weight':
-                weight = float(text.replace(',', '.'))
-                if 20 <= weight <= 300:
-                    logger.info(f"👤 Пользователь {user.id} ({db_user.telegram_id}) устанавливает вес: {weight} кг")
-                    updated_user = DatabaseManager.update_user_settings(db_user.id, weight=weight)
-                    success = True
-                    message = f"✅ Вес обновлен: {weight} кг"
-                    logger.info(f"✅ Вес сохранен в БД: {updated_user.weight}")
-                else:
-                    error_message = "Вес должен быть между 20 и 300 кг"
-            
-            elif waiting_for == 'height':
-                height = int(text)
-                if 100 <= height <= 250:
-                    DatabaseManager.update_user_settings(db_user.id, height=height)
-                    success = True
-                    message = f"✅ Рост установлен: {height} см"
-                else:
-                    error_message = "Рост должен быть между 100 и 250 см"
-            
-            elif waiting_for == 'personal_info':
-                parts = text.lower().split()
-                if len(parts) >= 2:
-                    age = int(parts[0])
-                    gender = 'male' if 'муж' in parts[1] else 'female' if 'жен' in parts[1] else None
-                    
-                    if 10 <= age <= 120 and gender:
-                        DatabaseManager.update_user_settings(db_user.id, age=age, gender=gender)
-                        success = True
-                        gender_text = 'мужской' if gender == 'male' else 'женский'
-                        message = f"✅ Информация обновлена: {age} лет, {gender_text}"
-                    else:
-                        error_message = "Проверьте формат ввода: возраст (10-120) и пол (мужской/женский)"
-                else:
-                    error_message = "Введите возраст и пол через пробел"
+        db_user = await CalorieBotHandlers.get_db_user(update, context)
+        handler = _SETTINGS_INPUT_ROUTES.get(context.user_data.get('waiting_for'))
         
-        except ValueError:
-            error_message = "Неверный формат данных"
+        message, error_message = None, ""
+        if handler:
+            message, error_message = await handler(db_user, text)
         
         # Очищаем состояние ожидания
         context.user_data.pop('waiting_for', None)
         
-        if success:
-            keyboard = [
-                [InlineKeyboardButton(f"{config.EMOJIS['settings']} Настройки", callback_data="settings")],
-                [InlineKeyboardButton(f"{config.EMOJIS['back']} Главное меню", callback_data="main_menu")]
-            ]
+        if message:
+            reply_markup = _SETTINGS_SAVED_MARKUP
         else:
             message = f"❌ {error_message}\n\nПопробуйте еще раз или отмените операцию."
-            keyboard = [
-                [InlineKeyboardButton(f"{config.EMOJIS['back']} Отмена", callback_data="settings")]
-            ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = _CANCEL_TO_SETTINGS_MARKUP
         
         await update.message.reply_text(
             message,
@@ -2662,10 +2757,8 @@ class CalorieBotHandlers:
         # Проверяем есть ли данные для коррекции
         if 'last_analysis_result' not in context.user_data:
             await query.answer()
-            bot = query.get_bot()
-            chat_id = query.message.chat_id
-            await bot.send_message(
-                chat_id=chat_id,
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id,
                 text="❌ Нет данных для коррекции. Пошлите новое фото."
             )
             return
@@ -2698,18 +2791,12 @@ class CalorieBotHandlers:
 Напишите ваше исправление:
 """
         
-        keyboard = [
-            [InlineKeyboardButton("❌ Отмена", callback_data="cancel_correction")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = _CANCEL_CORRECTION_MARKUP
         
         # Отправляем новое сообщение, сохраняя исходный анализ
         await query.answer()
-        bot = query.get_bot()
-        chat_id = query.message.chat_id
-        await bot.send_message(
-            chat_id=chat_id,
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
             text=message,
             parse_mode=ParseMode.MARKDOWN,
             reply_markup=reply_markup
@@ -2718,16 +2805,13 @@ class CalorieBotHandlers:
     @staticmethod
     async def process_correction(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
         """Обработка коррекции данных"""
-        user = update.effective_user
-        db_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
-        
         try:
             # Парсим введенную коррекцию
-            text_lower = text.lower()
+            calories_match = _CORRECTION_CALORIES_RE.match(text)
             
-            if text_lower.startswith('калории '):
+            if calories_match:
                 # Коррекция общих калорий
-                new_calories = int(text.split()[1])
+                new_calories = int(calories_match.group(1))
                 if 0 <= new_calories <= 5000:
                     # Здесь можно обновить последнюю запись в БД
                     message = f"✅ Калории скорректированы: {new_calories} ккал"
@@ -2755,12 +2839,7 @@ class CalorieBotHandlers:
         context.user_data.pop('waiting_for', None)
         context.user_data.pop('correction_photo_id', None)
         
-        keyboard = [
-            [InlineKeyboardButton(f"{config.EMOJIS['stats']} Статистика", callback_data="stats")],
-            [InlineKeyboardButton(f"{config.EMOJIS['back']} Главное меню", callback_data="main_menu")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = _CORRECTION_DONE_MARKUP
         
         await update.message.reply_text(
             message,
@@ -2779,9 +2858,7 @@ class CalorieBotHandlers:
         if not last_result or 'food_items' not in last_result:
             await query.edit_message_text(
                 "❌ Не найден последний анализ. Отправьте фото еды заново.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")
-                ]])
+                reply_markup=_markup("main_menu")
             )
             return
         
@@ -2791,9 +2868,7 @@ class CalorieBotHandlers:
         if not food_items:
             await query.edit_message_text(
                 "❌ Нет продуктов для уточнения.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")
-                ]])
+                reply_markup=_markup("main_menu")
             )
             return
         
@@ -2853,15 +2928,12 @@ class CalorieBotHandlers:
         ai_calories = selected_food.get('calories', 0)
         
         # Извлекаем числовое значение веса
-        import re
         weight_match = re.search(r'(\d+)', ai_weight)
         weight_grams = int(weight_match.group(1)) if weight_match else 100
         
         # Ищем в FatSecret
-        from food_database import food_database
         
         # Переводим название на русский для поиска
-        from ai_analyzer import translate_food_name
         russian_name = translate_food_name(food_name)
         
         # Поиск в базе данных
@@ -2881,15 +2953,10 @@ class CalorieBotHandlers:
             message += "• Ввести название вручную\n"
             message += "• Выбрать другой продукт"
             
-            keyboard = [
-                [InlineKeyboardButton("🔙 Назад к списку", callback_data="refine_calories")],
-                [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
-            ]
-            
             await query.edit_message_text(
                 message,
                 parse_mode=ParseMode.MARKDOWN,
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=_markup("fatsecret_not_found")
             )
             return
         
@@ -2949,8 +3016,7 @@ class CalorieBotHandlers:
         query = update.callback_query
         await query.answer("✅ Применяю выбранный вариант...")
         
-        user = query.from_user
-        db_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
+        db_user = await CalorieBotHandlers.get_db_user(update, context)
         
         # Парсим callback_data: apply_food_{food_idx}_{result_idx}
         try:
@@ -2993,38 +3059,25 @@ class CalorieBotHandlers:
         # Сохраняем обновленный результат
         context.user_data['last_analysis_result'] = last_result
         
-        # Обновляем запись в базе данных (последнюю запись пользователя)
+        # Обновляем запись в базе данных (последнюю запись пользователя) вместе с дневной статистикой
         try:
-            from database import SessionLocal, FoodEntry
-            db = SessionLocal()
-            try:
-                # Находим последнюю запись пользователя
-                last_entry = db.query(FoodEntry).filter(
-                    FoodEntry.user_id == db_user.id
-                ).order_by(FoodEntry.created_at.desc()).first()
-                
-                if last_entry:
-                    # Обновляем данные записи
-                    last_entry.food_items = json.dumps(last_result['food_items'], ensure_ascii=False)
-                    last_entry.total_calories = last_result['total_calories']
-                    db.commit()
-                    
-                    # Обновляем дневную статистику
-                    user_timezone = getattr(db_user, 'timezone', 'UTC') or 'UTC'
-                    from database import get_user_timezone
-                    user_tz = get_user_timezone(user_timezone)
-                    entry_date = last_entry.created_at.astimezone(user_tz).date()
-                    DatabaseManager._update_daily_stats(db_user.id, entry_date, user_timezone)
-                    
-                    logger.info(f"✅ Обновлена запись #{last_entry.id}: {old_calories:.0f} → {new_calories:.0f} ккал")
-            finally:
-                db.close()
+            user_timezone = getattr(db_user, 'timezone', 'UTC') or 'UTC'
+            entry_id = await asyncio.to_thread(
+                DatabaseManager.update_last_food_entry,
+                db_user.id,
+                orjson.dumps(last_result['food_items']).decode(),
+                last_result['total_calories'],
+                user_timezone
+            )
+            
+            if entry_id:
+                await redis_cache.invalidate_today_calories(db_user.id, get_user_today_date(user_timezone))
+                logger.info(f"✅ Обновлена запись #{entry_id}: {old_calories:.0f} → {new_calories:.0f} ккал")
         except Exception as e:
             logger.error(f"Ошибка при обновлении БД: {e}")
         
         # Получаем обновленную статистику
-        user_timezone = getattr(db_user, 'timezone', 'UTC') or 'UTC'
-        today_calories = DatabaseManager.get_today_calories(db_user.id, user_timezone)
+        today_calories = await CalorieBotHandlers.get_today_calories(db_user)
         daily_goal = db_user.daily_calorie_goal
         
         # Формируем сообщение об успехе
@@ -3044,13 +3097,7 @@ class CalorieBotHandlers:
         else:
             message += f"• Превышение: +{abs(remaining):.0f} ккал ⚠️"
         
-        keyboard = [
-            [InlineKeyboardButton("🔍 Уточнить другой продукт", callback_data="refine_calories")],
-            [InlineKeyboardButton("📊 Статистика", callback_data="stats")],
-            [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = _markup("fatsecret_applied")
         
         await query.edit_message_text(
             message,
@@ -3059,140 +3106,99 @@ class CalorieBotHandlers:
         )
 
     @staticmethod
-    async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Личный кабинет пользователя"""
-        user = update.effective_user
-        db_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
-        
-        # Основная информация
-        profile_info = DatabaseManager.get_user_info(db_user.id)
-        
-        # Количество дней ведения записей
-        tracking_days = DatabaseManager.get_tracking_days(db_user.id)
-        
-        message = f"""
-👤 **Личный кабинет**
-
-**Основная информация:**
-📝 Имя: {user.first_name or 'Не указано'}
-📊 Ведёте записи: {tracking_days} дней
-🎯 Цель калорий: {db_user.daily_calorie_goal} ккал/день
-
-**Физические параметры:**
-⚖️ Вес: {db_user.weight if db_user.weight else 'Не указан'} кг
-📏 Рост: {db_user.height if db_user.height else 'Не указан'} см
-🎂 Возраст: {db_user.age if db_user.age else 'Не указан'} лет
-🚻 Пол: {db_user.gender if db_user.gender else 'Не указан'}
-
-**Текущая статистика:**
-🔥 Сегодня: {profile_info['today_calories']} / {db_user.daily_calorie_goal} ккал
-📈 За неделю: {profile_info['week_avg']:.0f} ккал/день (среднее)
-📅 За месяц: {profile_info['month_avg']:.0f} ккал/день (среднее)
-"""
+    async def cached_profile_query(user_id, kind, func, *args, **kwargs):
+        """Запрос данных экрана профиля через короткий TTL-кеш (повторные нажатия кнопок)
+        
+        Кеш сбрасывается в DatabaseManager при изменении записей и настроек пользователя.
+        """
+        value = profile_cache.get(user_id, kind)
+        if value is None:
+            value = await asyncio.to_thread(func, *args, **kwargs)
+            profile_cache.set(user_id, kind, value)
+        return value
+    
+    @staticmethod
+    def build_profile_message(user, db_user, profile_info) -> str:
+        """Текст личного кабинета по шаблону _PROFILE_TEMPLATE"""
+        return _PROFILE_TEMPLATE.format(
+            name=html.escape(user.first_name or 'Не указано'),
+            tracking_days=profile_info['tracking_days'],
+            goal=db_user.daily_calorie_goal,
+            weight=db_user.weight if db_user.weight else 'Не указан',
+            height=db_user.height if db_user.height else 'Не указан',
+            age=db_user.age if db_user.age else 'Не указан',
+            gender=html.escape(db_user.gender) if db_user.gender else 'Не указан',
+            today_calories=profile_info['today_calories'],
+            week_avg=profile_info['week_avg'],
+            month_avg=profile_info['month_avg']
+        )
+    
+    @staticmethod
+    async def render_profile(send, user, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Личный кабинет: send - reply_text для команды или edit_message_text для кнопки"""
+        db_user = await CalorieBotHandlers.get_db_user(update, context)
         
-        keyboard = [
-            [InlineKeyboardButton("📅 История по дням", callback_data="daily_history")],
-            [InlineKeyboardButton("📊 Недельная статистика", callback_data="weekly_stats_detail")],
-            [InlineKeyboardButton("⚙️ Изменить параметры", callback_data="edit_profile")],
-            [InlineKeyboardButton(f"{config.EMOJIS['back']} Главное меню", callback_data="main_menu")]
-        ]
+        # Основная информация и количество дней ведения записей (один запрос)
+        user_timezone = getattr(db_user, 'timezone', 'UTC') or 'UTC'
+        profile_info = await CalorieBotHandlers.cached_profile_query(
+            db_user.id, 'info', DatabaseManager.get_user_info, db_user.id, user_timezone
+        )
+        message = CalorieBotHandlers.build_profile_message(user, db_user, profile_info)
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(
+        await send(
             message,
-            parse_mode=ParseMode.MARKDOWN,
-            reply_markup=reply_markup
+            parse_mode=ParseMode.HTML,
+            reply_markup=_PROFILE_MARKUP
+        )
+    
+    @staticmethod
+    async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Личный кабинет пользователя"""
+        await CalorieBotHandlers.render_profile(
+            update.message.reply_text, update.effective_user, update, context
         )
 
     @staticmethod
     async def profile_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик callback для личного кабинета"""
         query = update.callback_query
-        user = query.from_user
-        db_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
-        
-        # Основная информация
-        profile_info = DatabaseManager.get_user_info(db_user.id)
-        
-        # Количество дней ведения записей
-        tracking_days = DatabaseManager.get_tracking_days(db_user.id)
-        
-        message = f"""
-👤 **Личный кабинет**
-
-**Основная информация:**
-📝 Имя: {user.first_name or 'Не указано'}
-📊 Ведёте записи: {tracking_days} дней
-🎯 Цель калорий: {db_user.daily_calorie_goal} ккал/день
-
-**Физические параметры:**
-⚖️ Вес: {db_user.weight if db_user.weight else 'Не указан'} кг
-📏 Рост: {db_user.height if db_user.height else 'Не указан'} см
-🎂 Возраст: {db_user.age if db_user.age else 'Не указан'} лет
-🚻 Пол: {db_user.gender if db_user.gender else 'Не указан'}
-
-**Текущая статистика:**
-🔥 Сегодня: {profile_info['today_calories']} / {db_user.daily_calorie_goal} ккал
-📈 За неделю: {profile_info['week_avg']:.0f} ккал/день (среднее)
-📅 За месяц: {profile_info['month_avg']:.0f} ккал/день (среднее)
-"""
-        
-        keyboard = [
-            [InlineKeyboardButton("📅 История по дням", callback_data="daily_history")],
-            [InlineKeyboardButton("📊 Недельная статистика", callback_data="weekly_stats_detail")],
-            [InlineKeyboardButton("⚙️ Изменить параметры", callback_data="edit_profile")],
-            [InlineKeyboardButton(f"{config.EMOJIS['back']} Главное меню", callback_data="main_menu")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(
-            message,
-            parse_mode=ParseMode.MARKDOWN,
-            reply_markup=reply_markup
+        await CalorieBotHandlers.render_profile(
+            query.edit_message_text, query.from_user, update, context
         )
 
     @staticmethod
     async def daily_history_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показывает историю калорий по дням"""
         query = update.callback_query
-        user = query.from_user
-        db_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
+        db_user = await CalorieBotHandlers.get_db_user(update, context)
         
         # Получаем историю за последние 14 дней
-        daily_history = DatabaseManager.get_daily_calorie_history(db_user.id, days=14)
+        daily_history = await CalorieBotHandlers.cached_profile_query(
+            db_user.id, 'daily_history',
+            DatabaseManager.get_daily_calorie_history, db_user.id, days=14, daily_goal=db_user.daily_calorie_goal
+        )
         
         if not daily_history:
-            message = f"{config.EMOJIS['warning']} **История калорий**\n\nПока нет записей о питании.\nНачните добавлять фото еды!"
+            message = f"{config.EMOJIS['warning']} <b>История калорий</b>\n\nПока нет записей о питании.\nНачните добавлять фото еды!"
         else:
-            message = f"📅 **История калорий (последние 14 дней)**\n\n"
+            parts = ["📅 <b>История калорий (последние 14 дней)</b>\n\n"]
             
             for entry in daily_history:
-                date_str = entry['date'].strftime("%d.%m")
-                day_name = entry['date'].strftime("%a")  # сокращенное название дня
+                # дата и сокращенное название дня
+                date_str, day_name = entry['date'].strftime("%d.%m %a").split(" ")
                 calories = entry['calories']
-                goal = db_user.daily_calorie_goal
                 
-                # Эмодзи в зависимости от достижения цели
-                if calories >= goal * 0.9 and calories <= goal * 1.1:
-                    status = "🎯"  # близко к цели
-                elif calories < goal * 0.7:
-                    status = "🔽"  # мало
-                elif calories > goal * 1.3:
-                    status = "🔺"  # много
-                else:
-                    status = "📊"  # норма
+                # Эмодзи в зависимости от достижения цели (статус посчитан в SQL)
+                status = _DAY_STATUS_EMOJI[entry['status']]
                 
-                message += f"{status} **{date_str} ({day_name}):** {calories:.0f} ккал\n"
-        
-        keyboard = [
-            [InlineKeyboardButton("📊 Подробная статистика", callback_data="detailed_stats")],
-            [InlineKeyboardButton(f"{config.EMOJIS['back']} К профилю", callback_data="back_to_profile")]
-        ]
+                parts.append(f"{status} <b>{date_str} ({day_name}):</b> {calories:.0f} ккал\n")
+            
+            message = "".join(parts)
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = _DAILY_HISTORY_MARKUP
         await query.edit_message_text(
             message,
-            parse_mode=ParseMode.MARKDOWN,
+            parse_mode=ParseMode.HTML,
             reply_markup=reply_markup
         )
 
@@ -3200,49 +3206,40 @@ class CalorieBotHandlers:
     async def weekly_stats_detail_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Детальная недельная статистика"""
         query = update.callback_query
-        user = query.from_user
-        db_user = DatabaseManager.get_or_create_user(telegram_id=user.id)
+        db_user = await CalorieBotHandlers.get_db_user(update, context)
         
         # Получаем статистику за последние 4 недели
-        weekly_stats = DatabaseManager.get_weekly_stats(db_user.id)
+        weekly_stats = await CalorieBotHandlers.cached_profile_query(
+            db_user.id, 'weekly_stats', DatabaseManager.get_weekly_stats, db_user.id, db_user.daily_calorie_goal
+        )
         
         if not weekly_stats:
-            message = f"{config.EMOJIS['warning']} **Недельная статистика**\n\nНедостаточно данных.\nПродолжайте вести записи!"
+            message = f"{config.EMOJIS['warning']} <b>Недельная статистика</b>\n\nНедостаточно данных.\nПродолжайте вести записи!"
         else:
-            message = f"📊 **Статистика по неделям**\n\n"
+            parts = ["📊 <b>Статистика по неделям</b>\n\n"]
+            goal = db_user.daily_calorie_goal
             
-            for i, week in enumerate(weekly_stats):
-                week_num = i + 1
+            for week_num, week in enumerate(weekly_stats, 1):
                 avg_calories = week['avg_calories']
                 days_tracked = week['days_tracked']
-                goal = db_user.daily_calorie_goal
                 
-                # Процент от цели
+                # Процент от цели и оценка недели (статус посчитан в SQL)
                 goal_percent = (avg_calories / goal * 100) if goal > 0 else 0
+                status = _WEEK_STATUS_LABELS[week['status']]
                 
-                if goal_percent >= 90 and goal_percent <= 110:
-                    status = "🎯 Отлично"
-                elif goal_percent < 80:
-                    status = "🔽 Мало калорий"
-                elif goal_percent > 120:
-                    status = "🔺 Много калорий"
-                else:
-                    status = "📊 Норма"
-                
-                message += f"**Неделя {week_num}:**\n"
-                message += f"📈 Среднее: {avg_calories:.0f} ккал/день ({goal_percent:.0f}%)\n"
-                message += f"📅 Дней с записями: {days_tracked}/7\n"
-                message += f"{status}\n\n"
-        
-        keyboard = [
-            [InlineKeyboardButton("📅 История по дням", callback_data="daily_history")],
-            [InlineKeyboardButton(f"{config.EMOJIS['back']} К профилю", callback_data="back_to_profile")]
-        ]
+                parts.append(
+                    f"<b>Неделя {week_num}:</b>\n"
+                    f"📈 Среднее: {avg_calories:.0f} ккал/день ({goal_percent:.0f}%)\n"
+                    f"📅 Дней с записями: {days_tracked}/7\n"
+                    f"{status}\n\n"
+                )
+            
+            message = "".join(parts)
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = _WEEKLY_DETAIL_MARKUP
         await query.edit_message_text(
             message,
-            parse_mode=ParseMode.MARKDOWN,
+            parse_mode=ParseMode.HTML,
             reply_markup=reply_markup
         )
 
@@ -3251,58 +3248,121 @@ class CalorieBotHandlers:
         """Возврат к профилю"""
         await CalorieBotHandlers.profile_callback_handler(update, context)
 
+
+# Маршрутизация inline кнопок: точное совпадение callback_data
+_BUTTON_ROUTES = {
+    "main_menu": CalorieBotHandlers.start_command,
+    "stats": CalorieBotHandlers.stats_handler,
+    "settings": CalorieBotHandlers.settings_handler,
+    "goals": CalorieBotHandlers.goals_command,
+    "goals_menu": CalorieBotHandlers.goals_command,
+    "help": CalorieBotHandlers.help_command,
+    "add_more": CalorieBotHandlers.add_more_handler,
+    "detailed_stats": CalorieBotHandlers.detailed_stats_handler,
+    "refine_calories": CalorieBotHandlers.refine_calories_handler,
+    "cancel_refine": CalorieBotHandlers.cancel_refine_handler,
+    "correct_analysis": CalorieBotHandlers.correction_handler,
+    "cancel_correction": CalorieBotHandlers.cancel_correction_handler,
+    "daily_history": CalorieBotHandlers.daily_history_handler,
+    "weekly_stats_detail": CalorieBotHandlers.weekly_stats_detail_handler,
+    "back_to_profile": CalorieBotHandlers.back_to_profile_handler,
+    "edit_profile": CalorieBotHandlers.settings_handler,
+    "profile": CalorieBotHandlers.profile_callback_handler,
+    "add_photo_tip": CalorieBotHandlers.photo_tip_handler,
+    "my_goal": CalorieBotHandlers.my_goal_handler,
+    "data_status": CalorieBotHandlers.data_status_handler,
+    # Онбординг callbacks
+    "start_setup": CalorieBotHandlers.onboarding_gender,
+    "skip_setup": CalorieBotHandlers.skip_onboarding,
+    "gender_male": CalorieBotHandlers.onboarding_age,
+    "gender_female": CalorieBotHandlers.onboarding_age,
+    "activity_low": CalorieBotHandlers.complete_onboarding,
+    "activity_moderate": CalorieBotHandlers.complete_onboarding,
+    "activity_high": CalorieBotHandlers.complete_onboarding,
+}
+
+# Маршруты по префиксу callback_data (проверяются, если нет точного совпадения)
+_BUTTON_PREFIX_ROUTES = (
+    ("set_", CalorieBotHandlers.settings_input_handler),
+    ("goal_", CalorieBotHandlers.goal_selection_handler),
+    ("select_food_", CalorieBotHandlers.select_food_from_fatsecret),
+    ("apply_food_", CalorieBotHandlers.apply_fatsecret_choice),
+)
+
+# Ввод настроек: значение waiting_for -> обработчик текста
+_SETTINGS_INPUT_ROUTES = {
+    "calorie_goal": CalorieBotHandlers.apply_calorie_goal_input,
+    "weight": CalorieBotHandlers.apply_weight_input,
+    "height": CalorieBotHandlers.apply_height_input,
+    "personal_info": CalorieBotHandlers.apply_personal_info_input,
+}
+
 class WeeklyStatsScheduler:
     """Класс для планирования еженедельных уведомлений"""
     
-    def __init__(self, application):
-        self.application = application
+    def __init__(self):
+        self.application = None
+        self._task = None
+    
+    # Не более 25 сообщений в секунду - ниже общего лимита Telegram (30 msg/s)
+    SEND_CONCURRENCY = 25
+    # Пользователи читаются страницами, чтобы не держать в памяти всю таблицу
+    USERS_BATCH_SIZE = 500
+    
+    @staticmethod
+    def _get_active_users(after_id, limit):
+        """Страница активных пользователей с id > after_id (только нужные поля, без ORM-объектов)"""
+        with session_scope() as db:
+            return db.query(User.id, User.telegram_id, User.daily_calorie_goal).filter(
+                User.is_active == True,
+                User.id > after_id
+            ).order_by(User.id).limit(limit).all()
     
     async def send_weekly_stats(self):
         """Отправка еженедельной статистики всем активным пользователям"""
         logger.info("Начинаем отправку еженедельной статистики...")
         
-        from database import SessionLocal, User
-        db = SessionLocal()
-        try:
-            # Получаем всех активных пользователей
-            users = db.query(User).filter(User.is_active == True).all()
+        semaphore = asyncio.Semaphore(self.SEND_CONCURRENCY)
+        last_id = 0
+        
+        while True:
+            users = await asyncio.to_thread(self._get_active_users, last_id, self.USERS_BATCH_SIZE)
+            if not users:
+                break
             
-            for user in users:
-                try:
-                    # Получаем статистику за неделю
-                    weekly_stats = DatabaseManager.get_weekly_stats(user.id)
-                    
-                    if not weekly_stats:
-                        continue  # Пропускаем пользователей без статистики
-                    
-                    # Формируем сообщение
-                    current_week = weekly_stats[0] if weekly_stats else None
-                    if not current_week:
-                        continue
-                    
-                    avg_calories = current_week['avg_calories']
-                    days_tracked = current_week['days_tracked']
-                    goal = user.daily_calorie_goal
-                    goal_percent = (avg_calories / goal * 100) if goal > 0 else 0
-                    
-                    # Определяем статус
-                    if goal_percent >= 90 and goal_percent <= 110:
-                        status = "🎯 Отлично! Вы близки к цели"
-                        emoji = "🎉"
-                    elif goal_percent < 80:
-                        status = "🔽 Стоит увеличить калорийность"
-                        emoji = "💪"
-                    elif goal_percent > 120:
-                        status = "🔺 Возможно, стоит быть умереннее"
-                        emoji = "🧘‍♂️"
-                    else:
-                        status = "📊 Держитесь в норме"
-                        emoji = "✅"
-                    
-                    message = f"""
-{emoji} **Итоги недели**
+            # Статистика всей страницы пользователей одним запросом
+            week_stats = await asyncio.to_thread(
+                DatabaseManager.get_current_week_stats, [user.id for user in users]
+            )
+            
+            await asyncio.gather(
+                *(
+                    self._send_user_stats(user, week_stats[user.id], semaphore)
+                    for user in users if user.id in week_stats  # Пропускаем пользователей без статистики
+                ),
+                return_exceptions=True
+            )
+            last_id = users[-1].id
+        
+        logger.info("Отправка еженедельной статистики завершена")
+    
+    async def _send_user_stats(self, user, current_week, semaphore):
+        """Отправка статистики одному пользователю; слот семафора занят не меньше секунды"""
+        async with semaphore:
+            try:
+                # Формируем сообщение
+                avg_calories = current_week['avg_calories']
+                days_tracked = current_week['days_tracked']
+                goal = user.daily_calorie_goal
+                goal_percent = (avg_calories / goal * 100) if goal > 0 else 0
+                
+                # Определяем статус (посчитан в SQL)
+                status, emoji = _WEEKLY_REPORT_STATUS[current_week['status']]
+                
+                message = f"""
+{emoji} <b>Итоги недели</b>
 
-**Ваша статистика за последние 7 дней:**
+<b>Ваша статистика за последние 7 дней:</b>
 📈 Среднее потребление: {avg_calories:.0f} ккал/день
 🎯 Ваша цель: {goal} ккал/день
 📊 Выполнение цели: {goal_percent:.0f}%
@@ -3310,49 +3370,56 @@ class WeeklyStatsScheduler:
 
 {status}
 
-**Совет на следующую неделю:**
+<b>Совет на следующую неделю:</b>
 {"Продолжайте в том же духе!" if 90 <= goal_percent <= 110 else "Попробуйте следить за калориями каждый день для лучших результатов!"}
 
 Удачи в новой неделе! 🌟
-                    """
-                    
-                    # Отправляем сообщение
-                    await self.application.bot.send_message(
+                """
+                
+                # Отправляем сообщение (и выдерживаем паузу, чтобы не превысить лимит)
+                await asyncio.gather(
+                    self.application.bot.send_message(
                         chat_id=user.telegram_id,
                         text=message.strip(),
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                    
-                    logger.info(f"Еженедельная статистика отправлена пользователю {user.telegram_id}")
-                    
-                    # Небольшая пауза между отправками
-                    await asyncio.sleep(1)
-                    
-                except Exception as e:
-                    logger.error(f"Ошибка отправки статистики пользователю {user.telegram_id}: {e}")
-                    continue
-                    
-        finally:
-            db.close()
-        
-        logger.info("Отправка еженедельной статистики завершена")
+                        parse_mode=ParseMode.HTML
+                    ),
+                    asyncio.sleep(1)
+                )
+                
+                logger.info(f"Еженедельная статистика отправлена пользователю {user.telegram_id}")
+                
+            except Exception as e:
+                logger.error(f"Ошибка отправки статистики пользователю {user.telegram_id}: {e}")
     
-    def schedule_weekly_stats(self):
-        """Планирование еженедельных уведомлений"""
-        # Отправляем каждое воскресенье в 20:00
-        schedule.every().sunday.at("20:00").do(
-            lambda: asyncio.create_task(self.send_weekly_stats())
-        )
-        
-        # Запускаем планировщик в отдельном потоке
-        def run_scheduler():
-            while True:
-                schedule.run_pending()
-                time.sleep(60)  # Проверяем каждую минуту
-        
-        scheduler_thread = threading.Thread(target=run_scheduler, daemon=True)
-        scheduler_thread.start()
+    @staticmethod
+    def seconds_until_next_run(now=None):
+        """Секунды до ближайшего воскресенья 20:00 (локальное время сервера)"""
+        now = now or datetime.now()
+        next_run = now.replace(hour=20, minute=0, second=0, microsecond=0)
+        next_run += timedelta(days=(6 - now.weekday()) % 7)
+        if next_run <= now:
+            next_run += timedelta(days=7)
+        return (next_run - now).total_seconds()
+    
+    async def run_forever(self):
+        """Цикл планировщика: спит до воскресенья 20:00 и отправляет статистику"""
+        while True:
+            await asyncio.sleep(self.seconds_until_next_run())
+            try:
+                await self.send_weekly_stats()
+            except Exception as e:
+                logger.error(f"Ошибка рассылки еженедельной статистики: {e}")
+    
+    async def start(self, application):
+        """Запуск планировщика в цикле событий бота (post_init)"""
+        self.application = application
+        self._task = asyncio.create_task(self.run_forever())
         logger.info("Планировщик еженедельной статистики запущен")
+    
+    async def stop(self, application):
+        """Остановка планировщика вместе с ботом (post_stop)"""
+        if self._task:
+            self._task.cancel()
 
 def main():
     """Основная функция запуска бота"""
@@ -3365,12 +3432,10 @@ def main():
     # КРИТИЧЕСКИ ВАЖНО: Принудительно запускаем миграцию ПЕРЕД любыми операциями
     logger.info("🔧 ЗАПУСКАЕМ КРИТИЧЕСКИ ВАЖНУЮ МИГРАЦИЮ telegram_id...")
     try:
-        from database import migrate_telegram_id_if_needed, engine
         migrate_telegram_id_if_needed()
         
         # Проверяем что миграция действительно выполнилась
         try:
-            from sqlalchemy import text
             with engine.connect() as connection:
                 result = connection.execute(text("""
                     SELECT data_type 
@@ -3394,7 +3459,27 @@ def main():
         logger.error("🚨 Бот будет работать, но пользователи с большими ID получат ошибки!")
     
     # Создаем приложение
-    application = Application.builder().token(config.TELEGRAM_BOT_TOKEN).build()
+    install_event_loop_policy()
+    
+    # Планировщик еженедельной статистики работает в цикле событий бота
+    scheduler = WeeklyStatsScheduler()
+    
+    async def post_init(application):
+        await setup_db_executor()
+        await scheduler.start(application)
+    
+    application = (
+        Application.builder()
+        .token(config.TELEGRAM_BOT_TOKEN)
+        .request(build_request())
+        .get_updates_request(build_request(connection_pool_size=1))
+        .concurrent_updates(True)  # Обновления разных пользователей обрабатываются параллельно
+        .rate_limiter(build_rate_limiter())
+        .post_init(post_init)
+        .post_stop(scheduler.stop)
+        .post_shutdown(close_shared_clients)
+        .build()
+    )
     
     # Регистрируем обработчики
     application.add_handler(CommandHandler("start", CalorieBotHandlers.start_command))
@@ -3430,10 +3515,6 @@ def main():
     # Обработчик inline кнопок
     application.add_handler(CallbackQueryHandler(CalorieBotHandlers.button_handler))
     
-    # Запускаем планировщик еженедельной статистики
-    scheduler = WeeklyStatsScheduler(application)
-    scheduler.schedule_weekly_stats()
-    
     # Запускаем бота
     logger.info(f"Запускаем {config.BOT_NAME}...")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
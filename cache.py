@@ -0,0 +1,136 @@
+"""
+Кеши бота: в памяти процесса (короткий TTL) и на Redis для данных,
+общих для всех процессов бота (опционально)
+"""
+import logging
+import threading
+import time
+
+import orjson
+import redis.asyncio as redis
+
+import config
+
+logger = logging.getLogger(__name__)
+
+class TTLCache:
+    """Кеш в памяти процесса: значения по (пользователь, вид данных) живут ttl секунд
+    
+    При превышении maxsize пользователей вытесняются самые старые записи.
+    Потокобезопасен: get/set вызываются из цикла событий, invalidate - из потоков БД.
+    """
+
+    def __init__(self, maxsize=10000, ttl=10):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id, kind):
+        """Значение из кеша или None, если его нет или оно устарело"""
+        with self._lock:
+            values = self._data.get(user_id)
+            item = values.get(kind) if values else None
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                values.pop(kind, None)
+                return None
+            return value
+
+    def set(self, user_id, kind, value):
+        """Сохраняет значение на ttl секунд"""
+        with self._lock:
+            if user_id not in self._data and len(self._data) >= self.maxsize:
+                self._data.pop(next(iter(self._data)), None)
+            self._data.setdefault(user_id, {})[kind] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self, user_id):
+        """Сбрасывает все значения пользователя (после изменения его данных)"""
+        with self._lock:
+            self._data.pop(user_id, None)
+
+class RedisCache:
+    """Кеш счетчиков в Redis. Без REDIS_URL все методы просто возвращают None"""
+
+    def __init__(self):
+        self.client = None
+
+        if not config.REDIS_URL:
+            logger.info("REDIS_URL не задан - кеш Redis отключен")
+            self.enabled = False
+            return
+
+        self.client = redis.from_url(config.REDIS_URL, decode_responses=True)
+        self.enabled = True
+        logger.info("🧠 Кеш Redis включен")
+
+    @staticmethod
+    def _today_calories_key(user_id, day):
+        """Ключ счетчика калорий пользователя за день"""
+        return f"cal:{user_id}:{day:%Y%m%d}"
+
+    async def get_today_calories(self, user_id, day):
+        """Калории за день из кеша или None"""
+        if not self.enabled:
+            return None
+        try:
+            value = await self.client.get(self._today_calories_key(user_id, day))
+            return float(value) if value is not None else None
+        except Exception as e:
+            logger.warning(f"⚠️ Redis недоступен (get_today_calories): {e}")
+            return None
+
+    async def set_today_calories(self, user_id, day, calories, expire_at):
+        """Записывает счетчик дня, который истекает в полночь пользователя (expire_at)"""
+        if not self.enabled:
+            return
+        try:
+            await self.client.set(self._today_calories_key(user_id, day), calories, exat=expire_at)
+        except Exception as e:
+            logger.warning(f"⚠️ Redis недоступен (set_today_calories): {e}")
+
+    async def invalidate_today_calories(self, user_id, day):
+        """Сбрасывает счетчик дня (после удаления или изменения записей)"""
+        if not self.enabled:
+            return
+        try:
+            await self.client.delete(self._today_calories_key(user_id, day))
+        except Exception as e:
+            logger.warning(f"⚠️ Redis недоступен (invalidate_today_calories): {e}")
+
+    async def get_photo_analysis(self, digest):
+        """Результат анализа фото по SHA-256 его байтов или None"""
+        if not self.enabled:
+            return None
+        try:
+            value = await self.client.get(f"img:{digest}")
+            return orjson.loads(value) if value is not None else None
+        except Exception as e:
+            logger.warning(f"⚠️ Redis недоступен (get_photo_analysis): {e}")
+            return None
+
+    async def set_photo_analysis(self, digest, result):
+        """Сохраняет результат анализа фото на PHOTO_ANALYSIS_CACHE_TTL секунд"""
+        if not self.enabled:
+            return
+        try:
+            await self.client.set(f"img:{digest}", orjson.dumps(result), ex=config.PHOTO_ANALYSIS_CACHE_TTL)
+        except Exception as e:
+            logger.warning(f"⚠️ Redis недоступен (set_photo_analysis): {e}")
+
+    async def close(self):
+        """Закрывает соединения с Redis"""
+        if self.client is not None:
+            await self.client.aclose()
+
+# Глобальные экземпляры кешей
+redis_cache = RedisCache()
+
+# Данные экранов профиля: повторные нажатия кнопок в течение 10 секунд не ходят в БД
+profile_cache = TTLCache(maxsize=10000, ttl=10)
+
+# Пользователи по telegram_id: каждое обновление начинается с get_or_create_user,
+# поэтому строка users берется из БД не чаще раза в минуту
+user_cache = TTLCache(maxsize=10000, ttl=60)
@@ -20,6 +20,15 @@ if not OPENAI_API_KEY:
 # Database Configuration
 DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///calorie_bot.db')
 
+# Redis Configuration (опционально - общий кеш для нескольких процессов бота)
+REDIS_URL = os.getenv('REDIS_URL', '')
+
+# Пул соединений PostgreSQL
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 20))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+# Потоки для синхронных запросов к БД из async-обработчиков
+DB_THREAD_WORKERS = int(os.getenv('DB_THREAD_WORKERS', 32))
+
 # Логирование информации о базе данных
 def log_database_info():
     """Логирование информации о подключении к базе данных"""
@@ -40,6 +49,8 @@ def log_database_info():
 # Bot Configuration
 BOT_NAME = os.getenv('BOT_NAME', 'Калории Бот 🍎')
 ADMIN_USER_ID = os.getenv('ADMIN_USER_ID', '')
+# Telegram ID администраторов (можно несколько через запятую), разбираются один раз при старте
+ADMIN_USER_IDS = frozenset(int(x) for x in ADMIN_USER_ID.split(',') if x.strip().isdigit())
 
 # FatSecret API Configuration
 FATSECRET_CONSUMER_KEY = os.getenv('FATSECRET_CONSUMER_KEY', '')
@@ -53,6 +64,12 @@ WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
 # AI Configuration
 AI_MODEL = "gpt-4o"
 MAX_TOKENS = 1000
+# Большая сторона фото, которое уходит в AI (больше - уменьшается перед отправкой)
+AI_IMAGE_MAX_SIZE = 1024
+# Максимум одновременных запросов к OpenAI (остальные фото ждут в очереди)
+AI_MAX_CONCURRENCY = int(os.getenv('AI_MAX_CONCURRENCY', 8))
+# Сколько секунд хранить в Redis результат анализа фото (повторная отправка того же фото)
+PHOTO_ANALYSIS_CACHE_TTL = int(os.getenv('PHOTO_ANALYSIS_CACHE_TTL', 86400))
 
 # Настройки анализа калорий
 # AI Configuration - English prompts for better understanding
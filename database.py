@@ -1,12 +1,18 @@
 """
 Модель базы данных для телеграм-бота подсчета калорий
 """
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Float, Boolean, ForeignKey, func, BigInteger, text
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Float, Boolean, ForeignKey, func, BigInteger, text, Index, case, inspect, select, literal
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from contextlib import contextmanager
+from dataclasses import dataclass, fields
+import csv
+import io
 from datetime import datetime, timezone, timedelta
+import orjson
 import pytz
 import config
+from cache import profile_cache, user_cache
 
 Base = declarative_base()
 
@@ -74,12 +80,45 @@ class User(Base):
         
         return daily_calories
 
+@dataclass(frozen=True, slots=True)
+class UserSnapshot:
+    """Неизменяемый снимок строки users: его хранит user_cache и получают обработчики
+    
+    Один экземпляр из кеша разделяют параллельные обработчики, поэтому изменить его нельзя.
+    """
+    id: int
+    telegram_id: int
+    username: str
+    first_name: str
+    last_name: str
+    created_at: datetime
+    is_active: bool
+    daily_calorie_goal: int
+    weight: float
+    height: float
+    age: int
+    gender: str
+    activity_level: str
+    weight_goal: str
+    timezone: str
+    
+    calculate_daily_calorie_goal = User.calculate_daily_calorie_goal
+    
+    @classmethod
+    def from_user(cls, user):
+        """Снимок ORM-объекта User"""
+        return cls(**{field.name: getattr(user, field.name) for field in fields(cls)})
+
     def __repr__(self):
         return f"<User(telegram_id={self.telegram_id}, username={self.username})>"
 
 class FoodEntry(Base):
     """Модель записи о еде"""
     __tablename__ = 'food_entries'
+    __table_args__ = (
+        # Записи пользователя по времени: "за сегодня", последние записи, история
+        Index('ix_food_entry_user_created', 'user_id', 'created_at'),
+    )
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
@@ -106,6 +145,10 @@ class FoodEntry(Base):
 class DailyStats(Base):
     """Модель дневной статистики пользователя"""
     __tablename__ = 'daily_stats'
+    __table_args__ = (
+        # Одна запись на пользователя в день - точечный поиск "калорий за сегодня"
+        Index('ix_daily_stats_user_date', 'user_id', 'date', unique=True),
+    )
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
@@ -123,11 +166,32 @@ class DailyStats(Base):
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
 
+# Тип базы определяется один раз при импорте
+IS_POSTGRES = config.DATABASE_URL.startswith('postgresql')
+
 # Создание движка базы данных
-engine = create_engine(config.DATABASE_URL, echo=False)
+if IS_POSTGRES:
+    # Пул соединений: держим открытые соединения вместо подключения на каждый запрос
+    _engine_options = {
+        'pool_size': config.DB_POOL_SIZE,
+        'max_overflow': config.DB_MAX_OVERFLOW,
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+        'connect_args': {'keepalives': 1, 'keepalives_idle': 30},
+    }
+else:
+    _engine_options = {}
 
-# Создание сессии
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = create_engine(config.DATABASE_URL, echo=False, **_engine_options)
+
+# Создание сессии (объекты остаются доступны после commit - они уходят в обработчики)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+
+# INSERT ... ON CONFLICT DO UPDATE есть в обоих диалектах (в SQLite - с версии 3.24)
+if IS_POSTGRES:
+    from sqlalchemy.dialects.postgresql import insert as upsert_insert
+else:
+    from sqlalchemy.dialects.sqlite import insert as upsert_insert
 
 # ========== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ДЛЯ РАБОТЫ С ТАЙМЗОНАМИ ==========
 
@@ -163,13 +227,17 @@ def get_user_day_end(date, user_timezone_str: str = 'UTC'):
     # Конвертируем в UTC для хранения в БД
     return day_end.astimezone(pytz.UTC)
 
+def has_completed_onboarding(user) -> bool:
+    """Прошел ли пользователь онбординг: заполнены основные данные профиля"""
+    return bool(user.weight and user.height and user.age and user.gender and user.weight_goal)
+
 def migrate_telegram_id_if_needed():
     """Автоматическая миграция telegram_id с INTEGER на BIGINT если необходимо"""
     import logging
     logger = logging.getLogger(__name__)
     
     # Проверяем только для PostgreSQL
-    if not config.DATABASE_URL.startswith('postgresql'):
+    if not IS_POSTGRES:
         logger.info("Используется SQLite, миграция telegram_id не нужна")
         return
     
@@ -243,13 +311,29 @@ def migrate_telegram_id_if_needed():
                 logger.info("🚀 Теперь поддерживаются любые Telegram ID!")
             
     except Exception as e:
-        logger.error(f"🚨 КРИТИЧЕСКАЯ ОШИБКА при проверке/миграции telegram_id: {e}")
-        logger.error(f"🚨 Тип ошибки: {type(e).__name__}")
-        import traceback
-        logger.error(f"🚨 Полный traceback: {traceback.format_exc()}")
+        logger.exception(f"🚨 КРИТИЧЕСКАЯ ОШИБКА при проверке/миграции telegram_id: {e}")
         logger.warning("⚠️ Продолжаем работу с текущей схемой - большие Telegram ID будут вызывать ошибки!")
         logger.warning("⚠️ Рекомендуется использовать /forcemigration для повторной попытки")
 
+def _dedupe_daily_stats():
+    """Оставить по одной строке DailyStats на (user_id, date) - последнюю записанную
+    
+    Строки статистики пересчитываются из FoodEntry целиком, поэтому последняя
+    строка дня содержит самые полные суммы, остальные можно удалить.
+    """
+    import logging
+    logger = logging.getLogger(__name__)
+    
+    with engine.begin() as connection:
+        result = connection.execute(text("""
+            DELETE FROM daily_stats
+            WHERE id NOT IN (
+                SELECT MAX(id) FROM daily_stats GROUP BY user_id, date
+            )
+        """))
+    if result.rowcount:
+        logger.info(f"🧹 Удалено дублей дневной статистики: {result.rowcount}")
+
 def create_tables():
     """Создание всех таблиц в базе данных"""
     import logging
@@ -258,16 +342,64 @@ def create_tables():
     Base.metadata.create_all(bind=engine)
     logger.info("Таблицы базы данных созданы")
     
+    # Старые базы могут содержать несколько строк DailyStats за один день -
+    # уникальный индекс (user_id, date) на них не создастся
+    if 'ix_daily_stats_user_date' not in {index['name'] for index in inspect(engine).get_indexes('daily_stats')}:
+        _dedupe_daily_stats()
+    
+    # create_all не добавляет индексы в уже существующие таблицы - создаем их отдельно
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось создать индекс {index.name}: {e}")
+    
     # Примечание: Миграция telegram_id теперь выполняется в main() функции
     # Убрали дублирование вызова migrate_telegram_id_if_needed() отсюда
 
-def get_db():
-    """Получение сессии базы данных"""
+@contextmanager
+def session_scope():
+    """Сессия базы данных: откат при ошибке и возврат соединения в пул в любом случае"""
     db = SessionLocal()
     try:
-        return db
+        yield db
+    except Exception:
+        db.rollback()
+        raise
     finally:
-        pass  # Сессия закроется в коде, который её использует
+        db.close()
+
+# Выгрузка пользователей для /adminexport: колонки CSV
+USERS_EXPORT_HEADER = [
+    'Telegram ID', 'Имя', 'Username', 'Дата регистрации',
+    'Последняя активность', 'Количество записей', 'Цель калорий',
+    'Вес', 'Рост', 'Возраст', 'Пол'
+]
+
+# В PostgreSQL CSV формирует сам сервер (COPY), те же колонки и форматы дат
+_USERS_EXPORT_COPY_SQL = """
+COPY (
+    SELECT u.telegram_id AS "Telegram ID",
+           COALESCE(u.first_name, 'Неизвестно') AS "Имя",
+           u.username AS "Username",
+           to_char(u.created_at, 'YYYY-MM-DD HH24:MI:SS') AS "Дата регистрации",
+           to_char(f.last_activity, 'YYYY-MM-DD HH24:MI:SS') AS "Последняя активность",
+           COALESCE(f.entries_count, 0) AS "Количество записей",
+           u.daily_calorie_goal AS "Цель калорий",
+           NULLIF(u.weight, 0) AS "Вес",
+           NULLIF(u.height, 0) AS "Рост",
+           NULLIF(u.age, 0) AS "Возраст",
+           NULLIF(u.gender, '') AS "Пол"
+    FROM users u
+    LEFT JOIN (
+        SELECT user_id, COUNT(*) AS entries_count, MAX(created_at) AS last_activity
+        FROM food_entries
+        GROUP BY user_id
+    ) f ON f.user_id = u.id
+    ORDER BY u.created_at DESC
+) TO STDOUT WITH (FORMAT csv, HEADER)
+"""
 
 class DatabaseManager:
     """Менеджер для работы с базой данных"""
@@ -275,72 +407,130 @@ class DatabaseManager:
     @staticmethod
     def get_or_create_user(telegram_id, username=None, first_name=None, last_name=None):
         """Получить или создать пользователя с полной загрузкой настроек"""
-        db = SessionLocal()
         import logging
         logger = logging.getLogger(__name__)
-        
-        try:
-            logger.info(f"👤 GET_OR_CREATE_USER: Ищем/создаем пользователя {telegram_id}")
-            user = db.query(User).filter(User.telegram_id == telegram_id).first()
+        cached = user_cache.get(telegram_id, 'user')
+        if cached is not None and all(
+            not new or getattr(cached, field) == new
+            for field, new in (('username', username), ('first_name', first_name), ('last_name', last_name))
+        ):
+            return cached
+        with session_scope() as db:
+            try:
+                logger.info(f"👤 GET_OR_CREATE_USER: Ищем/создаем пользователя {telegram_id}")
+                user = db.query(User).filter(User.telegram_id == telegram_id).first()
             
-            if not user:
-                logger.info(f"🆕 СОЗДАЕМ НОВОГО пользователя {telegram_id}")
-                user = User(
-                    telegram_id=telegram_id,
-                    username=username,
-                    first_name=first_name,
-                    last_name=last_name,
-                    daily_calorie_goal=2000  # Дефолтная цель для новых пользователей
-                )
-                db.add(user)
-                db.commit()
-                db.refresh(user)
+                if not user:
+                    logger.info(f"🆕 СОЗДАЕМ НОВОГО пользователя {telegram_id}")
+                    user = User(
+                        telegram_id=telegram_id,
+                        username=username,
+                        first_name=first_name,
+                        last_name=last_name,
+                        daily_calorie_goal=2000  # Дефолтная цель для новых пользователей
+                    )
+                    db.add(user)
+                    db.commit()
+                    db.refresh(user)
                 
-                logger.info(f"✅ НОВЫЙ ПОЛЬЗОВАТЕЛЬ создан: ID={user.id}, telegram_id={user.telegram_id}, цель={user.daily_calorie_goal} ккал")
-            else:
-                logger.info(f"📋 НАЙДЕН СУЩЕСТВУЮЩИЙ пользователь: ID={user.id}, telegram_id={user.telegram_id}")
-                logger.info(f"📊 Текущие данные: вес={user.weight}, рост={user.height}, возраст={user.age}, цель={user.daily_calorie_goal} ккал")
+                    logger.info(f"✅ НОВЫЙ ПОЛЬЗОВАТЕЛЬ создан: ID={user.id}, telegram_id={user.telegram_id}, цель={user.daily_calorie_goal} ккал")
+                else:
+                    logger.info(f"📋 НАЙДЕН СУЩЕСТВУЮЩИЙ пользователь: ID={user.id}, telegram_id={user.telegram_id}")
+                    logger.info(f"📊 Текущие данные: вес={user.weight}, рост={user.height}, возраст={user.age}, цель={user.daily_calorie_goal} ккал")
                 
-                # Обновляем данные существующего пользователя
-                updated = False
-                if username and user.username != username:
-                    user.username = username
-                    updated = True
-                if first_name and user.first_name != first_name:
-                    user.first_name = first_name
-                    updated = True
-                if last_name and user.last_name != last_name:
-                    user.last_name = last_name
-                    updated = True
+                    # Обновляем данные существующего пользователя
+                    updated = False
+                    if username and user.username != username:
+                        user.username = username
+                        updated = True
+                    if first_name and user.first_name != first_name:
+                        user.first_name = first_name
+                        updated = True
+                    if last_name and user.last_name != last_name:
+                        user.last_name = last_name
+                        updated = True
                 
-                if updated:
-                    db.commit()
-                    db.refresh(user)
-                    logger.info(f"✅ Данные пользователя обновлены")
+                    if updated:
+                        db.commit()
+                        db.refresh(user)
+                        logger.info(f"✅ Данные пользователя обновлены")
                 
-                logger.info(f"✅ ПОЛЬЗОВАТЕЛЬ ГОТОВ: ID={user.id}, тип={type(user).__name__}, цель={user.daily_calorie_goal} ккал")
+                    logger.info(f"✅ ПОЛЬЗОВАТЕЛЬ ГОТОВ: ID={user.id}, тип={type(user).__name__}, цель={user.daily_calorie_goal} ккал")
                 
-            return user
-        except Exception as e:
-            # Обработка ошибок базы данных, включая integer out of range
-            db.rollback()
-            logger.error(f"🚨 КРИТИЧЕСКАЯ ОШИБКА при работе с пользователем {telegram_id}: {e}")
-            logger.error(f"🚨 Тип ошибки: {type(e).__name__}")
-            
-            # Если это ошибка integer out of range, пытаемся использовать альтернативную схему
-            if "integer out of range" in str(e).lower() or "numericvalueoutofrange" in str(type(e).__name__).lower():
-                logger.error(f"💥 Telegram ID {telegram_id} слишком большой для текущей схемы базы данных")
-                logger.error("💥 Требуется миграция схемы: telegram_id INTEGER → BIGINT")
-                logger.warning(f"⚠️ СОЗДАЕМ ВРЕМЕННОГО ПОЛЬЗОВАТЕЛЯ для {telegram_id} - ДАННЫЕ НЕ БУДУТ СОХРАНЯТЬСЯ!")
+                snapshot = UserSnapshot.from_user(user)
+                user_cache.set(telegram_id, 'user', snapshot)
+                return snapshot
+            except Exception as e:
+                # Обработка ошибок базы данных, включая integer out of range
+                db.rollback()
+                logger.error(f"🚨 КРИТИЧЕСКАЯ ОШИБКА при работе с пользователем {telegram_id}: {e}")
+                logger.error(f"🚨 Тип ошибки: {type(e).__name__}")
+            
+                # Если это ошибка integer out of range, пытаемся использовать альтернативную схему
+                if "integer out of range" in str(e).lower() or "numericvalueoutofrange" in str(type(e).__name__).lower():
+                    logger.error(f"💥 Telegram ID {telegram_id} слишком большой для текущей схемы базы данных")
+                    logger.error("💥 Требуется миграция схемы: telegram_id INTEGER → BIGINT")
+                    logger.warning(f"⚠️ СОЗДАЕМ ВРЕМЕННОГО ПОЛЬЗОВАТЕЛЯ для {telegram_id} - ДАННЫЕ НЕ БУДУТ СОХРАНЯТЬСЯ!")
                 
-                # Создаем фиктивного пользователя с базовыми настройками для продолжения работы
+                    # Создаем фиктивного пользователя с базовыми настройками для продолжения работы
+                    class TempUser:
+                        def __init__(self):
+                            self.id = None
+                            self.telegram_id = telegram_id
+                            self.username = username
+                            self.first_name = first_name  
+                            self.last_name = last_name
+                            self.daily_calorie_goal = 2000
+                            self.weight = None
+                            self.height = None
+                            self.age = None
+                            self.gender = None
+                            self.activity_level = 'moderate'
+                            self.weight_goal = 'maintain'
+                            self.timezone = 'UTC'
+                    
+                        def calculate_daily_calorie_goal(self):
+                            """Рассчитывает дневную норму калорий с учетом цели по весу"""
+                            if not all([self.weight, self.height, self.age, self.gender]):
+                                return 2000
+                        
+                            # Базальный метаболизм
+                            if self.gender.lower() == 'male':
+                                bmr = (10 * self.weight) + (6.25 * self.height) - (5 * self.age) + 5
+                            else:
+                                bmr = (10 * self.weight) + (6.25 * self.height) - (5 * self.age) - 161
+                        
+                            # Коэффициент активности
+                            activity_multipliers = {'low': 1.2, 'moderate': 1.55, 'high': 1.9}
+                            multiplier = activity_multipliers.get(self.activity_level, 1.55)
+                            base_calories = int(bmr * multiplier)
+                        
+                            # Коррекция в зависимости от цели по весу
+                            weight_goal_corrections = {
+                                'lose': -500,      # Дефицит 500 ккал для похудения
+                                'maintain': 0,     # Поддержание текущего веса
+                                'gain': 300,       # Профицит 300 ккал для набора веса
+                                'recomp': 0        # Рекомпозиция - поддержание веса с фокусом на мышцы
+                            }
+                        
+                            correction = weight_goal_corrections.get(self.weight_goal, 0)
+                            daily_calories = base_calories + correction
+                        
+                            # Минимальная норма калорий
+                            min_calories = 1500 if self.gender.lower() == 'male' else 1200
+                            return max(daily_calories, min_calories)
+                        
+                    return TempUser()
+            
+                # Для других ошибок создаем базового пользователя
+                logger.warning(f"⚠️ СОЗДАЕМ ВРЕМЕННОГО ПОЛЬЗОВАТЕЛЯ для {telegram_id} из-за ошибки БД - ДАННЫЕ НЕ БУДУТ СОХРАНЯТЬСЯ!")
                 class TempUser:
                     def __init__(self):
                         self.id = None
                         self.telegram_id = telegram_id
                         self.username = username
-                        self.first_name = first_name  
-                        self.last_name = last_name
+                        self.first_name = first_name
+                        self.last_name = last_name  
                         self.daily_calorie_goal = 2000
                         self.weight = None
                         self.height = None
@@ -349,23 +539,23 @@ class DatabaseManager:
                         self.activity_level = 'moderate'
                         self.weight_goal = 'maintain'
                         self.timezone = 'UTC'
-                    
+                
                     def calculate_daily_calorie_goal(self):
                         """Рассчитывает дневную норму калорий с учетом цели по весу"""
                         if not all([self.weight, self.height, self.age, self.gender]):
                             return 2000
-                        
+                    
                         # Базальный метаболизм
                         if self.gender.lower() == 'male':
                             bmr = (10 * self.weight) + (6.25 * self.height) - (5 * self.age) + 5
                         else:
                             bmr = (10 * self.weight) + (6.25 * self.height) - (5 * self.age) - 161
-                        
+                    
                         # Коэффициент активности
                         activity_multipliers = {'low': 1.2, 'moderate': 1.55, 'high': 1.9}
                         multiplier = activity_multipliers.get(self.activity_level, 1.55)
                         base_calories = int(bmr * multiplier)
-                        
+                    
                         # Коррекция в зависимости от цели по весу
                         weight_goal_corrections = {
                             'lose': -500,      # Дефицит 500 ккал для похудения
@@ -373,75 +563,25 @@ class DatabaseManager:
                             'gain': 300,       # Профицит 300 ккал для набора веса
                             'recomp': 0        # Рекомпозиция - поддержание веса с фокусом на мышцы
                         }
-                        
+                    
                         correction = weight_goal_corrections.get(self.weight_goal, 0)
                         daily_calories = base_calories + correction
-                        
+                    
                         # Минимальная норма калорий
                         min_calories = 1500 if self.gender.lower() == 'male' else 1200
                         return max(daily_calories, min_calories)
-                        
-                return TempUser()
-            
-            # Для других ошибок создаем базового пользователя
-            logger.warning(f"⚠️ СОЗДАЕМ ВРЕМЕННОГО ПОЛЬЗОВАТЕЛЯ для {telegram_id} из-за ошибки БД - ДАННЫЕ НЕ БУДУТ СОХРАНЯТЬСЯ!")
-            class TempUser:
-                def __init__(self):
-                    self.id = None
-                    self.telegram_id = telegram_id
-                    self.username = username
-                    self.first_name = first_name
-                    self.last_name = last_name  
-                    self.daily_calorie_goal = 2000
-                    self.weight = None
-                    self.height = None
-                    self.age = None
-                    self.gender = None
-                    self.activity_level = 'moderate'
-                    self.weight_goal = 'maintain'
-                    self.timezone = 'UTC'
-                
-                def calculate_daily_calorie_goal(self):
-                    """Рассчитывает дневную норму калорий с учетом цели по весу"""
-                    if not all([self.weight, self.height, self.age, self.gender]):
-                        return 2000
-                    
-                    # Базальный метаболизм
-                    if self.gender.lower() == 'male':
-                        bmr = (10 * self.weight) + (6.25 * self.height) - (5 * self.age) + 5
-                    else:
-                        bmr = (10 * self.weight) + (6.25 * self.height) - (5 * self.age) - 161
-                    
-                    # Коэффициент активности
-                    activity_multipliers = {'low': 1.2, 'moderate': 1.55, 'high': 1.9}
-                    multiplier = activity_multipliers.get(self.activity_level, 1.55)
-                    base_calories = int(bmr * multiplier)
-                    
-                    # Коррекция в зависимости от цели по весу
-                    weight_goal_corrections = {
-                        'lose': -500,      # Дефицит 500 ккал для похудения
-                        'maintain': 0,     # Поддержание текущего веса
-                        'gain': 300,       # Профицит 300 ккал для набора веса
-                        'recomp': 0        # Рекомпозиция - поддержание веса с фокусом на мышцы
-                    }
-                    
-                    correction = weight_goal_corrections.get(self.weight_goal, 0)
-                    daily_calories = base_calories + correction
-                    
-                    # Минимальная норма калорий
-                    min_calories = 1500 if self.gender.lower() == 'male' else 1200
-                    return max(daily_calories, min_calories)
             
-            return TempUser()
-        finally:
-            db.close()
+                return TempUser()
     
     @staticmethod
     def add_food_entry(user_id, food_data, total_calories, total_proteins=0, total_carbs=0, total_fats=0, 
                       confidence=0, meal_type=None, photo_id=None, user_timezone='UTC'):
-        """Добавить запись о еде с учетом часового пояса пользователя"""
-        db = SessionLocal()
-        try:
+        """Добавить запись о еде с учетом часового пояса пользователя
+        
+        Запись и дневная статистика сохраняются в одной транзакции.
+        Возвращает (запись, калории за сегодня после добавления).
+        """
+        with session_scope() as db:
             entry = FoodEntry(
                 user_id=user_id,
                 food_items=food_data,
@@ -454,74 +594,140 @@ class DatabaseManager:
                 photo_id=photo_id
             )
             db.add(entry)
-            db.commit()
-            db.refresh(entry)
+            db.flush()
             
             # Обновляем дневную статистику с учетом таймзоны пользователя
             user_date = get_user_today_date(user_timezone)
-            DatabaseManager._update_daily_stats(user_id, user_date, user_timezone)
+            today_calories = DatabaseManager._update_daily_stats(user_id, user_date, user_timezone, db=db)
             
-            return entry
-        finally:
-            db.close()
+            db.commit()
+            db.refresh(entry)
+            profile_cache.invalidate(user_id)
+            
+            return entry, today_calories
     
     @staticmethod
-    def _update_daily_stats(user_id, date, user_timezone='UTC'):
-        """Обновить дневную статистику с учетом часового пояса пользователя"""
-        db = SessionLocal()
-        try:
-            # Получаем границы дня с учетом часового пояса пользователя
-            start_of_day = get_user_day_start(date, user_timezone)
-            end_of_day = get_user_day_end(date, user_timezone)
-            
-            entries = db.query(FoodEntry).filter(
-                FoodEntry.user_id == user_id,
-                FoodEntry.created_at >= start_of_day,
-                FoodEntry.created_at <= end_of_day
-            ).all()
-            
-            # Считаем суммы
-            total_calories = sum(entry.total_calories for entry in entries)
-            total_proteins = sum(entry.total_proteins for entry in entries)
-            total_carbs = sum(entry.total_carbs for entry in entries)
-            total_fats = sum(entry.total_fats for entry in entries)
-            
-            # Получаем или создаем запись дневной статистики
-            daily_stat = db.query(DailyStats).filter(
-                DailyStats.user_id == user_id,
-                DailyStats.date == date
-            ).first()
-            
-            if not daily_stat:
-                daily_stat = DailyStats(
-                    user_id=user_id,
-                    date=date
-                )
-                db.add(daily_stat)
-            
-            # Обновляем данные
-            daily_stat.total_calories = total_calories
-            daily_stat.total_proteins = total_proteins
-            daily_stat.total_carbs = total_carbs
-            daily_stat.total_fats = total_fats
-            daily_stat.meals_count = len(entries)
-            daily_stat.updated_at = datetime.now(timezone.utc)
-            
+    def _update_daily_stats(user_id, date, user_timezone='UTC', db=None):
+        """Обновить дневную статистику с учетом часового пояса пользователя
+        
+        Если передана сессия db, изменения выполняются в ней без commit -
+        фиксирует их вызывающий код. Возвращает калории за день.
+        """
+        if db is None:
+            with session_scope() as db:
+                total_calories = DatabaseManager._update_daily_stats(user_id, date, user_timezone, db=db)
+                db.commit()
+                profile_cache.invalidate(user_id)
+                return total_calories
+        
+        # Получаем границы дня с учетом часового пояса пользователя
+        start_of_day = get_user_day_start(date, user_timezone)
+        end_of_day = get_user_day_end(date, user_timezone)
+        
+        # Считаем суммы одним агрегирующим запросом
+        total_calories, total_proteins, total_carbs, total_fats, meals_count = db.query(
+            func.coalesce(func.sum(FoodEntry.total_calories), 0),
+            func.coalesce(func.sum(FoodEntry.total_proteins), 0),
+            func.coalesce(func.sum(FoodEntry.total_carbs), 0),
+            func.coalesce(func.sum(FoodEntry.total_fats), 0),
+            func.count(FoodEntry.id)
+        ).filter(
+            FoodEntry.user_id == user_id,
+            FoodEntry.created_at >= start_of_day,
+            FoodEntry.created_at <= end_of_day
+        ).one()
+        
+        # Создаем или обновляем запись дневной статистики одним UPSERT по индексу (user_id, date):
+        # параллельные записи за тот же день не упираются в уникальный индекс
+        # (ключ - полночь дня: DateTime-колонка не совпадает с date в SQLite)
+        now = datetime.now(timezone.utc)
+        stmt = upsert_insert(DailyStats).values(
+            user_id=user_id,
+            date=datetime.combine(date, datetime.min.time()),
+            total_calories=float(total_calories),
+            total_proteins=float(total_proteins),
+            total_carbs=float(total_carbs),
+            total_fats=float(total_fats),
+            meals_count=meals_count,
+            created_at=now,
+            updated_at=now
+        )
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[DailyStats.user_id, DailyStats.date],
+            set_={
+                'total_calories': stmt.excluded.total_calories,
+                'total_proteins': stmt.excluded.total_proteins,
+                'total_carbs': stmt.excluded.total_carbs,
+                'total_fats': stmt.excluded.total_fats,
+                'meals_count': stmt.excluded.meals_count,
+                'updated_at': stmt.excluded.updated_at
+            }
+        ))
+        
+        # ЛОГИРОВАНИЕ: Отслеживаем обновление дневной статистики
+        import logging
+        logger = logging.getLogger(__name__)
+        logger.info(f"📊 Обновлена дневная статистика для user_id {user_id} за {date}: {total_calories:.1f} ккал, {meals_count} записей")
+        
+        return float(total_calories)
+    
+    @staticmethod
+    def rebuild_daily_stats(user_id: int) -> int:
+        """Пересоздать DailyStats пользователя по всем его записям (дни по UTC)
+        
+        Старые строки статистики удаляются, новые строятся одним
+        INSERT ... SELECT ... GROUP BY с ON CONFLICT DO UPDATE (на случай записи,
+        добавленной параллельно) - все в одной транзакции.
+        Возвращает количество обработанных дней.
+        """
+        if IS_POSTGRES:
+            entry_day = func.date_trunc('day', FoodEntry.created_at)
+        else:
+            # Полночь дня в том же формате, в котором SQLAlchemy хранит DateTime в SQLite
+            entry_day = func.strftime('%Y-%m-%d 00:00:00.000000', FoodEntry.created_at)
+        
+        now = datetime.now(timezone.utc)
+        day_totals = select(
+            FoodEntry.user_id,
+            entry_day,
+            func.coalesce(func.sum(FoodEntry.total_calories), 0),
+            func.coalesce(func.sum(FoodEntry.total_proteins), 0),
+            func.coalesce(func.sum(FoodEntry.total_carbs), 0),
+            func.coalesce(func.sum(FoodEntry.total_fats), 0),
+            func.count(FoodEntry.id),
+            literal(now, DateTime),
+            literal(now, DateTime)
+        ).where(FoodEntry.user_id == user_id).group_by(FoodEntry.user_id, entry_day)
+        
+        stmt = upsert_insert(DailyStats).from_select(
+            ['user_id', 'date', 'total_calories', 'total_proteins', 'total_carbs',
+             'total_fats', 'meals_count', 'created_at', 'updated_at'],
+            day_totals
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[DailyStats.user_id, DailyStats.date],
+            set_={
+                'total_calories': stmt.excluded.total_calories,
+                'total_proteins': stmt.excluded.total_proteins,
+                'total_carbs': stmt.excluded.total_carbs,
+                'total_fats': stmt.excluded.total_fats,
+                'meals_count': stmt.excluded.meals_count,
+                'updated_at': stmt.excluded.updated_at
+            }
+        )
+        
+        with session_scope() as db:
+            db.query(DailyStats).filter(DailyStats.user_id == user_id).delete(synchronize_session=False)
+            rebuilt_count = db.execute(stmt).rowcount
             db.commit()
-            
-            # ЛОГИРОВАНИЕ: Отслеживаем обновление дневной статистики
-            import logging
-            logger = logging.getLogger(__name__)
-            logger.info(f"📊 Обновлена дневная статистика для user_id {user_id} за {date}: {total_calories:.1f} ккал, {len(entries)} записей")
-            
-        finally:
-            db.close()
+        
+        profile_cache.invalidate(user_id)
+        return rebuilt_count
     
     @staticmethod
     def get_user_stats(user_id, days=7):
         """Получить статистику пользователя за последние N дней"""
-        db = SessionLocal()
-        try:
+        with session_scope() as db:
             from datetime import timedelta
             # ИСПРАВЛЕНИЕ: Используем UTC время для корректного поиска записей
             end_date = datetime.now(timezone.utc).date()
@@ -529,45 +735,82 @@ class DatabaseManager:
             
             stats = db.query(DailyStats).filter(
                 DailyStats.user_id == user_id,
-                DailyStats.date >= start_date,
-                DailyStats.date <= end_date
+                DailyStats.date >= datetime.combine(start_date, datetime.min.time()),
+                DailyStats.date <= datetime.combine(end_date, datetime.min.time())
             ).order_by(DailyStats.date).all()
             
             # ЛОГИРОВАНИЕ: Отслеживаем что находит get_user_stats
             import logging
             logger = logging.getLogger(__name__)
             logger.info(f"📈 get_user_stats для user_id {user_id}: найдено {len(stats)} записей за {days} дней ({start_date} - {end_date})")
-            
+
             return stats
-        finally:
-            db.close()
+    
+    @staticmethod
+    def get_user_stats_summary(user_id: int, days: int = 30, daily_goal: int = 2000) -> dict:
+        """Итоги дневной статистики за последние N дней одним агрегирующим запросом
+
+        Период тот же, что у get_user_stats. goal_days - дни, в которые калорий
+        было не больше daily_goal.
+        """
+        with session_scope() as db:
+            end_date = datetime.now(timezone.utc).date()
+            start_date = end_date - timedelta(days=days-1)
+
+            days_count, total_calories, total_proteins, total_carbs, total_fats, goal_days = db.query(
+                func.count(DailyStats.id),
+                func.coalesce(func.sum(DailyStats.total_calories), 0),
+                func.coalesce(func.sum(DailyStats.total_proteins), 0),
+                func.coalesce(func.sum(DailyStats.total_carbs), 0),
+                func.coalesce(func.sum(DailyStats.total_fats), 0),
+                func.coalesce(func.sum(case((DailyStats.total_calories <= daily_goal, 1), else_=0)), 0)
+            ).filter(
+                DailyStats.user_id == user_id,
+                DailyStats.date >= datetime.combine(start_date, datetime.min.time()),
+                DailyStats.date <= datetime.combine(end_date, datetime.min.time())
+            ).one()
+
+            return {
+                'days_count': days_count,
+                'total_calories': float(total_calories),
+                'total_proteins': float(total_proteins),
+                'total_carbs': float(total_carbs),
+                'total_fats': float(total_fats),
+                'goal_days': int(goal_days)
+            }
     
     @staticmethod
     def get_today_calories(user_id, user_timezone='UTC'):
-        """Получить калории за сегодня с учетом часового пояса пользователя"""
-        db = SessionLocal()
-        try:
+        """Получить калории за сегодня с учетом часового пояса пользователя
+        
+        Читает готовый счетчик из DailyStats (поддерживается при каждой записи)
+        точечным поиском по индексу (user_id, date).
+        """
+        with session_scope() as db:
             # Получаем сегодняшнюю дату в часовом поясе пользователя
             today = get_user_today_date(user_timezone)
-            start_of_day = get_user_day_start(today, user_timezone)
-            end_of_day = get_user_day_end(today, user_timezone)
             
-            today_calories = db.query(func.sum(FoodEntry.total_calories)).filter(
-                FoodEntry.user_id == user_id,
-                FoodEntry.created_at >= start_of_day,
-                FoodEntry.created_at <= end_of_day
+            today_calories = db.query(DailyStats.total_calories).filter(
+                DailyStats.user_id == user_id,
+                DailyStats.date == datetime.combine(today, datetime.min.time())
             ).scalar() or 0
             
             return float(today_calories)
-        finally:
-            db.close()
+    
+    @staticmethod
+    def get_daily_stat(user_id, date):
+        """Дневная статистика пользователя за дату (точечный поиск по индексу) или None"""
+        with session_scope() as db:
+            return db.query(DailyStats).filter(
+                DailyStats.user_id == user_id,
+                DailyStats.date == datetime.combine(date, datetime.min.time())
+            ).first()
     
     @staticmethod
     def update_user_settings(user_id, daily_calorie_goal=None, weight=None, height=None, 
                            age=None, gender=None, activity_level=None, weight_goal=None, timezone_str=None):
         """Обновить настройки пользователя"""
-        db = SessionLocal()
-        try:
+        with session_scope() as db:
             user = db.query(User).filter(User.id == user_id).first()
             if user:
                 old_goal = user.daily_calorie_goal
@@ -591,6 +834,8 @@ class DatabaseManager:
                 
                 db.commit()
                 db.refresh(user)
+                profile_cache.invalidate(user.id)
+                user_cache.invalidate(user.telegram_id)
                 
                 # Логируем изменения
                 if daily_calorie_goal is not None:
@@ -599,14 +844,11 @@ class DatabaseManager:
                     logger.info(f"Цель пользователя {user.telegram_id} изменена: {old_goal} → {user.daily_calorie_goal} ккал")
                 
                 return user
-        finally:
-            db.close()
-
+    
     @staticmethod  
     def get_user_info(telegram_id):
         """Получить подробную информацию о пользователе"""
-        db = SessionLocal()
-        try:
+        with session_scope() as db:
             user = db.query(User).filter(User.telegram_id == telegram_id).first()
             if not user:
                 return None
@@ -625,146 +867,231 @@ class DatabaseManager:
                 'recent_stats': recent_stats,
                 'total_entries_last_week': len(recent_stats) if recent_stats else 0
             }
-        finally:
-            db.close()
-
+    
     @staticmethod
     def force_update_user_goal(telegram_id, new_goal):
         """Принудительно обновить цель пользователя по telegram_id"""
-        db = SessionLocal()
-        try:
+        with session_scope() as db:
             user = db.query(User).filter(User.telegram_id == telegram_id).first()
             if user:
                 old_goal = user.daily_calorie_goal
                 user.daily_calorie_goal = new_goal
                 db.commit()
+                profile_cache.invalidate(user.id)
+                user_cache.invalidate(telegram_id)
                 
                 import logging
                 logger = logging.getLogger(__name__)
                 logger.info(f"ПРИНУДИТЕЛЬНО изменена цель пользователя {telegram_id}: {old_goal} → {new_goal} ккал")
                 
                 return True
-        finally:
-            db.close()
         return False
 
     @staticmethod
     def get_user_info(user_id: int, user_timezone: str = 'UTC') -> dict:
-        """Получить расширенную информацию о пользователе с учетом часового пояса"""
-        db = SessionLocal()
-        try:
+        """Получить расширенную информацию о пользователе с учетом часового пояса
+        
+        Калории за сегодня, средние за неделю и месяц и число дней с записями
+        считаются одним запросом.
+        """
+        with session_scope() as db:
             # Сегодняшние калории с учетом таймзоны
             today = get_user_today_date(user_timezone)
             start_of_day = get_user_day_start(today, user_timezone)
             end_of_day = get_user_day_end(today, user_timezone)
             
-            today_calories = db.query(func.sum(FoodEntry.total_calories)).filter(
-                FoodEntry.user_id == user_id,
-                FoodEntry.created_at >= start_of_day,
-                FoodEntry.created_at <= end_of_day
-            ).scalar() or 0
-            
-            # Средние за неделю
-            week_ago = datetime.now(timezone.utc) - timedelta(days=7)
-            week_entries = db.query(FoodEntry).filter(
-                FoodEntry.user_id == user_id,
-                FoodEntry.created_at >= week_ago
-            ).all()
+            now = datetime.now(timezone.utc)
+            week_ago = now - timedelta(days=7)
+            month_ago = now - timedelta(days=30)
             
-            week_total = sum(entry.total_calories for entry in week_entries)
-            week_avg = week_total / 7 if week_entries else 0
-            
-            # Средние за месяц
-            month_ago = datetime.now(timezone.utc) - timedelta(days=30)
-            month_entries = db.query(FoodEntry).filter(
+            # Количество уникальных дней с записями (за все время)
+            tracking_days = db.query(
+                func.count(func.distinct(func.date(FoodEntry.created_at)))
+            ).filter(FoodEntry.user_id == user_id).scalar_subquery()
+            
+            today_calories, week_total, week_count, month_total, month_count, days_count = db.query(
+                func.sum(case(
+                    (FoodEntry.created_at.between(start_of_day, end_of_day), FoodEntry.total_calories),
+                    else_=0
+                )),
+                func.sum(case((FoodEntry.created_at >= week_ago, FoodEntry.total_calories), else_=0)),
+                func.count(case((FoodEntry.created_at >= week_ago, FoodEntry.id))),
+                func.sum(FoodEntry.total_calories),
+                func.count(FoodEntry.id),
+                tracking_days
+            ).filter(
                 FoodEntry.user_id == user_id,
                 FoodEntry.created_at >= month_ago
-            ).all()
+            ).one()
             
-            month_total = sum(entry.total_calories for entry in month_entries)
-            month_avg = month_total / 30 if month_entries else 0
+            week_avg = week_total / 7 if week_count else 0
+            month_avg = month_total / 30 if month_count else 0
             
             return {
                 'today_calories': float(today_calories) if today_calories else 0.0,
                 'week_avg': float(week_avg) if week_avg else 0.0,
-                'month_avg': float(month_avg) if month_avg else 0.0
+                'month_avg': float(month_avg) if month_avg else 0.0,
+                'tracking_days': days_count or 0
             }
-        finally:
-            db.close()
-
+    
     @staticmethod
     def get_tracking_days(user_id: int) -> int:
         """Получить количество дней ведения записей"""
-        db = SessionLocal()
-        try:
+        with session_scope() as db:
             # Количество уникальных дней с записями
             days_count = db.query(
                 func.count(func.distinct(func.date(FoodEntry.created_at)))
             ).filter(FoodEntry.user_id == user_id).scalar()
             
             return days_count or 0
-        finally:
-            db.close()
     
     @staticmethod
-    def delete_last_food_entry(user_id: int, user_timezone: str = 'UTC'):
-        """Удалить последнюю запись о еде пользователя"""
-        import logging
-        logger = logging.getLogger(__name__)
-        db = SessionLocal()
+    def get_recent_food_entries(user_id: int, limit: int = 10) -> list:
+        """Последние записи о еде пользователя (новые первыми)
         
-        try:
-            # Находим последнюю запись
+        Возвращает словари с временем, калориями и названием первого блюда
+        (None, если состав пуст или не разбирается как JSON).
+        """
+        entries = []
+        with session_scope() as db:
+            # Строки читаются прямо из курсора, без промежуточного списка
+            rows = db.query(
+                FoodEntry.created_at, FoodEntry.total_calories, FoodEntry.food_items
+            ).filter(
+                FoodEntry.user_id == user_id
+            ).order_by(FoodEntry.created_at.desc()).limit(limit)
+            
+            for created_at, total_calories, food_items in rows:
+                first_item_name = None
+                try:
+                    food_data = orjson.loads(food_items) if food_items else None
+                    if isinstance(food_data, list) and food_data and isinstance(food_data[0], dict):
+                        first_item_name = food_data[0].get('name')
+                except orjson.JSONDecodeError:
+                    pass  # Если не удалось распарсить JSON, просто пропускаем
+                entries.append({
+                    'created_at': created_at,
+                    'total_calories': total_calories,
+                    'first_item_name': first_item_name
+                })
+        return entries
+    
+    @staticmethod
+    def update_last_food_entry(user_id: int, food_items: str, total_calories: float, user_timezone: str = 'UTC'):
+        """Обновить последнюю запись о еде и дневную статистику ее дня (один commit)
+        
+        Возвращает id обновленной записи или None, если записей нет.
+        """
+        with session_scope() as db:
             last_entry = db.query(FoodEntry).filter(
                 FoodEntry.user_id == user_id
             ).order_by(FoodEntry.created_at.desc()).first()
             
             if not last_entry:
-                logger.warning(f"⚠️ Не найдено записей для удаления у пользователя {user_id}")
                 return None
             
-            # Сохраняем информацию о записи для возврата
-            entry_info = {
-                'calories': last_entry.total_calories,
-                'food_items': last_entry.food_items,
-                'created_at': last_entry.created_at,
-                'id': last_entry.id
-            }
+            last_entry.food_items = food_items
+            last_entry.total_calories = total_calories
+            db.flush()
             
-            # Получаем дату записи в таймзоне пользователя для обновления статистики
             user_tz = get_user_timezone(user_timezone)
             entry_date = last_entry.created_at.astimezone(user_tz).date()
-            
-            # Удаляем запись
-            db.delete(last_entry)
+            DatabaseManager._update_daily_stats(user_id, entry_date, user_timezone, db=db)
             db.commit()
+            profile_cache.invalidate(user_id)
+            return last_entry.id
+    
+    @staticmethod
+    def get_tables_diagnostics(user_id: int) -> dict:
+        """Состояние таблиц FoodEntry и DailyStats пользователя (для /debugstats)"""
+        with session_scope() as db:
+            return {
+                'food_entries_count': db.query(func.count(FoodEntry.id)).filter(
+                    FoodEntry.user_id == user_id
+                ).scalar(),
+                'daily_stats_count': db.query(func.count(DailyStats.id)).filter(
+                    DailyStats.user_id == user_id
+                ).scalar(),
+                'recent_food_entries': db.query(FoodEntry).filter(
+                    FoodEntry.user_id == user_id
+                ).order_by(FoodEntry.created_at.desc()).limit(3).all(),
+                'recent_daily_stats': db.query(DailyStats).filter(
+                    DailyStats.user_id == user_id
+                ).order_by(DailyStats.date.desc()).limit(3).all()
+            }
+    
+    @staticmethod
+    def delete_last_food_entry(user_id: int, user_timezone: str = 'UTC'):
+        """Удалить последнюю запись о еде пользователя
+        
+        Удаление и пересчет дневной статистики выполняются в одной транзакции.
+        В результате 'today_calories' - калории за сегодня после удаления
+        (None, если запись была за другой день).
+        """
+        import logging
+        logger = logging.getLogger(__name__)
+        with session_scope() as db:
+            try:
+                # Находим последнюю запись
+                last_entry = db.query(FoodEntry).filter(
+                    FoodEntry.user_id == user_id
+                ).order_by(FoodEntry.created_at.desc()).first()
+            
+                if not last_entry:
+                    logger.warning(f"⚠️ Не найдено записей для удаления у пользователя {user_id}")
+                    return None
             
-            logger.info(f"✅ Удалена запись #{entry_info['id']} ({entry_info['calories']} ккал) для пользователя {user_id}")
+                # Сохраняем информацию о записи для возврата
+                entry_info = {
+                    'calories': last_entry.total_calories,
+                    'food_items': last_entry.food_items,
+                    'created_at': last_entry.created_at,
+                    'id': last_entry.id
+                }
             
-            # Обновляем дневную статистику
-            DatabaseManager._update_daily_stats(user_id, entry_date, user_timezone)
+                # Получаем дату записи в таймзоне пользователя для обновления статистики
+                user_tz = get_user_timezone(user_timezone)
+                entry_date = last_entry.created_at.astimezone(user_tz).date()
             
-            return entry_info
+                # Удаляем запись и обновляем дневную статистику в той же транзакции
+                db.delete(last_entry)
+                db.flush()
+                day_calories = DatabaseManager._update_daily_stats(user_id, entry_date, user_timezone, db=db)
+                db.commit()
+                profile_cache.invalidate(user_id)
             
-        except Exception as e:
-            logger.error(f"❌ Ошибка при удалении записи: {e}")
-            db.rollback()
-            return None
-        finally:
-            db.close()
-
+                logger.info(f"✅ Удалена запись #{entry_info['id']} ({entry_info['calories']} ккал) для пользователя {user_id}")
+            
+                entry_info['today_calories'] = day_calories if entry_date == get_user_today_date(user_timezone) else None
+                return entry_info
+            
+            except Exception as e:
+                logger.error(f"❌ Ошибка при удалении записи: {e}")
+                db.rollback()
+                return None
+    
     @staticmethod
-    def get_daily_calorie_history(user_id: int, days: int = 14) -> list:
-        """Получить историю калорий по дням"""
-        db = SessionLocal()
-        try:
+    def get_daily_calorie_history(user_id: int, days: int = 14, daily_goal: int = 2000) -> list:
+        """Получить историю калорий по дням
+        
+        status - оценка дня относительно цели, считается в SQL:
+        0 - близко к цели (90-110%), 1 - мало (<70%), 2 - много (>130%), 3 - норма.
+        """
+        with session_scope() as db:
             # Получаем записи за последние N дней
             start_date = datetime.now(timezone.utc) - timedelta(days=days)
             
             # Группируем по дням и суммируем калории
+            day_calories = func.sum(FoodEntry.total_calories)
             results = db.query(
                 func.date(FoodEntry.created_at).label('date'),
-                func.sum(FoodEntry.total_calories).label('calories')
+                day_calories.label('calories'),
+                case(
+                    (day_calories.between(daily_goal * 0.9, daily_goal * 1.1), 0),
+                    (day_calories < daily_goal * 0.7, 1),
+                    (day_calories > daily_goal * 1.3, 2),
+                    else_=3
+                ).label('status')
             ).filter(
                 FoodEntry.user_id == user_id,
                 FoodEntry.created_at >= start_date
@@ -777,77 +1104,161 @@ class DatabaseManager:
             return [
                 {
                     'date': result.date,
-                    'calories': float(result.calories or 0)
+                    'calories': float(result.calories or 0),
+                    'status': result.status
                 }
                 for result in results
             ]
-        finally:
-            db.close()
-
+    
     @staticmethod
-    def get_weekly_stats(user_id: int) -> list:
-        """Получить статистику по неделям (последние 4 недели)"""
-        db = SessionLocal()
-        try:
+    def get_weekly_stats(user_id: int, daily_goal: int = 2000) -> list:
+        """Получить статистику по неделям (последние 4 недели)
+        
+        status - оценка среднего за неделю относительно цели, считается в SQL:
+        0 - близко к цели (90-110%), 1 - мало (<80%), 2 - много (>120%), 3 - норма.
+        """
+        with session_scope() as db:
             weekly_stats = []
+            now = datetime.now(timezone.utc)
+            
+            # Среднее за 7 дней и его оценка относительно цели
+            avg_calories = func.coalesce(func.sum(FoodEntry.total_calories), 0) / 7.0
+            status = case(
+                (avg_calories.between(daily_goal * 0.9, daily_goal * 1.1), 0),
+                (avg_calories < daily_goal * 0.8, 1),
+                (avg_calories > daily_goal * 1.2, 2),
+                else_=3
+            )
             
             for week_num in range(4):
                 # Определяем даты недели
-                end_date = datetime.now(timezone.utc) - timedelta(days=week_num * 7)
+                end_date = now - timedelta(days=week_num * 7)
                 start_date = end_date - timedelta(days=6)  # 7 дней включительно
                 
-                # Получаем записи за неделю
-                week_entries = db.query(FoodEntry).filter(
+                # Суммы за неделю считаем в базе, без загрузки записей
+                entries_count, total_calories, unique_days, week_status = db.query(
+                    func.count(FoodEntry.id),
+                    func.coalesce(func.sum(FoodEntry.total_calories), 0),
+                    func.count(func.distinct(func.date(FoodEntry.created_at))),
+                    status
+                ).filter(
                     FoodEntry.user_id == user_id,
                     FoodEntry.created_at >= start_date,
                     FoodEntry.created_at <= end_date
-                ).all()
+                ).one()
                 
-                if week_entries:
-                    # Считаем статистику
-                    total_calories = sum(entry.total_calories for entry in week_entries)
-                    unique_days = len(set(entry.created_at.date() for entry in week_entries))
-                    avg_calories = total_calories / 7  # среднее за 7 дней
-                    
+                if entries_count:
                     weekly_stats.append({
                         'week_start': start_date.date(),
                         'week_end': end_date.date(),
-                        'total_calories': total_calories,
-                        'avg_calories': avg_calories,
-                        'days_tracked': unique_days
+                        'total_calories': float(total_calories),
+                        'avg_calories': float(total_calories) / 7,  # среднее за 7 дней
+                        'days_tracked': unique_days,
+                        'status': week_status if daily_goal > 0 else 1
                     })
             
             return weekly_stats
-        finally:
-            db.close()
-
+    
     @staticmethod
-    def get_admin_stats():
-        """Получить общую статистику по боту для администратора"""
-        db = SessionLocal()
-        try:
-            # Общая статистика по пользователям
-            total_users = db.query(func.count(User.id)).scalar() or 0
-            
-            # Активные пользователи (с записями за последние 7 дней)
-            week_ago = datetime.now(timezone.utc) - timedelta(days=7)
-            active_users = db.query(func.count(func.distinct(FoodEntry.user_id))).filter(
-                FoodEntry.created_at >= week_ago
-            ).scalar() or 0
-            
-            # Всего записей о еде
-            total_food_entries = db.query(func.count(FoodEntry.id)).scalar() or 0
+    def get_current_week_stats(user_ids) -> dict:
+        """Статистика за последние 7 дней сразу для группы пользователей (один запрос)
+        
+        Возвращает {user_id: {'avg_calories', 'days_tracked', 'status'}} только для
+        пользователей с записями; status - как в get_weekly_stats, по цели каждого пользователя.
+        """
+        if not user_ids:
+            return {}
+        
+        with session_scope() as db:
+            end_date = datetime.now(timezone.utc)
+            start_date = end_date - timedelta(days=6)  # 7 дней включительно
             
-            # Записей за сегодня
-            today_start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
-            today_entries = db.query(func.count(FoodEntry.id)).filter(
-                FoodEntry.created_at >= today_start
-            ).scalar() or 0
+            avg_calories = func.sum(FoodEntry.total_calories) / 7.0
+            goal = User.daily_calorie_goal
+            results = db.query(
+                FoodEntry.user_id,
+                func.sum(FoodEntry.total_calories).label('total_calories'),
+                func.count(func.distinct(func.date(FoodEntry.created_at))).label('days_tracked'),
+                case(
+                    (goal <= 0, 1),
+                    (avg_calories.between(goal * 0.9, goal * 1.1), 0),
+                    (avg_calories < goal * 0.8, 1),
+                    (avg_calories > goal * 1.2, 2),
+                    else_=3
+                ).label('status')
+            ).join(User, User.id == FoodEntry.user_id).filter(
+                FoodEntry.user_id.in_(user_ids),
+                FoodEntry.created_at >= start_date,
+                FoodEntry.created_at <= end_date
+            ).group_by(FoodEntry.user_id, User.daily_calorie_goal).all()
             
-            # Пользователи с настроенными целями калорий (не дефолтные)
-            configured_users = db.query(func.count(User.id)).filter(
-                User.daily_calorie_goal != 2000
-            ).scalar() or 0
+            return {
+                result.user_id: {
+                    'avg_calories': float(result.total_calories or 0) / 7,
+                    'days_tracked': result.days_tracked,
+                    'status': result.status
+                }
+                for result in results
+            }
+    
+    @staticmethod
+    def get_telegram_id_column_info():
+        """Тип, nullable и default колонки users.telegram_id (PostgreSQL) или None"""
+        with engine.connect() as connection:
+            return connection.execute(text("""
+                SELECT data_type, is_nullable, column_default
+                FROM information_schema.columns 
+                WHERE table_name = 'users' 
+                AND column_name = 'telegram_id'
+            """)).fetchone()
+    
+    @staticmethod
+    def probe_large_telegram_id(test_telegram_id: int = 9876543210):
+        """Проверить, что users.telegram_id принимает большие Telegram ID (ошибка - исключением)
+        
+        Тестовый пользователь вставляется и откатывается в одной транзакции,
+        в таблице ничего не остается.
+        """
+        with session_scope() as db:
+            if db.query(User.id).filter(User.telegram_id == test_telegram_id).first():
+                return
+            db.add(User(telegram_id=test_telegram_id, username="test_large_id", first_name="TestUser"))
+            db.flush()
+            db.rollback()
+    
+    @staticmethod
+    def execute_migration(statement: str):
+        """Выполнить DDL-миграцию (ALTER TABLE ...) и зафиксировать ее"""
+        with session_scope() as db:
+            db.execute(text(statement))
+            db.commit()
+    
+    @staticmethod
+    def get_admin_stats():
+        """Получить общую статистику по боту для администратора"""
+        with session_scope() as db:
+            now = datetime.now(timezone.utc)
+            week_ago = now - timedelta(days=7)
+            today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+            
+            # Все счетчики одним запросом: каждый - скалярный подзапрос в одном SELECT
+            (total_users, configured_users, total_food_entries,
+             active_users, today_entries) = db.query(
+                # Всего пользователей
+                db.query(func.count(User.id)).scalar_subquery(),
+                # Пользователи с настроенными целями калорий (не дефолтные)
+                db.query(func.count(User.id)).filter(User.daily_calorie_goal != 2000).scalar_subquery(),
+                # Всего записей о еде
+                db.query(func.count(FoodEntry.id)).scalar_subquery(),
+                # Активные пользователи (с записями за последние 7 дней)
+                db.query(func.count(func.distinct(FoodEntry.user_id))).filter(
+                    FoodEntry.created_at >= week_ago
+                ).scalar_subquery(),
+                # Записей за сегодня
+                db.query(func.count(FoodEntry.id)).filter(
+                    FoodEntry.created_at >= today_start
+                ).scalar_subquery(),
+            ).one()
             
             # Самые активные пользователи (топ 5)
             top_users = db.query(
@@ -859,11 +1270,11 @@ class DatabaseManager:
             ).limit(5).all()
             
             return {
-                'total_users': total_users,
-                'active_users_7d': active_users,
-                'total_food_entries': total_food_entries,
-                'today_entries': today_entries,
-                'configured_users': configured_users,
+                'total_users': total_users or 0,
+                'active_users_7d': active_users or 0,
+                'total_food_entries': total_food_entries or 0,
+                'today_entries': today_entries or 0,
+                'configured_users': configured_users or 0,
                 'top_users': [
                     {
                         'name': user.first_name or 'Неизвестно',
@@ -873,34 +1284,26 @@ class DatabaseManager:
                     for user in top_users
                 ]
             }
-        finally:
-            db.close()
-
+    
     @staticmethod
     def get_all_users_summary():
-        """Получить краткую информацию по всем пользователям"""
-        db = SessionLocal()
-        try:
-            users = db.query(User).order_by(User.created_at.desc()).all()
+        """Получить краткую информацию по всем пользователям (один запрос с агрегатами по записям)"""
+        with session_scope() as db:
+            entries = db.query(
+                FoodEntry.user_id,
+                func.count(FoodEntry.id).label('entries_count'),
+                func.max(FoodEntry.created_at).label('last_activity')
+            ).group_by(FoodEntry.user_id).subquery()
+            
+            rows = db.query(User, entries.c.entries_count, entries.c.last_activity).outerjoin(
+                entries, entries.c.user_id == User.id
+            ).order_by(User.created_at.desc()).all()
             
             users_summary = []
-            for user in users:
-                # Считаем количество записей для каждого пользователя
-                entries_count = db.query(func.count(FoodEntry.id)).filter(
-                    FoodEntry.user_id == user.id
-                ).scalar() or 0
-                
-                # Последняя активность
-                last_entry = db.query(FoodEntry.created_at).filter(
-                    FoodEntry.user_id == user.id
-                ).order_by(FoodEntry.created_at.desc()).first()
-                
-                last_activity = None
-                if last_entry:
-                    last_activity = last_entry[0]
-                    # Убеждаемся что datetime имеет timezone info
-                    if last_activity and last_activity.tzinfo is None:
-                        last_activity = last_activity.replace(tzinfo=timezone.utc)
+            for user, entries_count, last_activity in rows:
+                # Убеждаемся что datetime имеет timezone info
+                if last_activity and last_activity.tzinfo is None:
+                    last_activity = last_activity.replace(tzinfo=timezone.utc)
                 
                 users_summary.append({
                     'id': user.id,
@@ -909,21 +1312,58 @@ class DatabaseManager:
                     'username': user.username,
                     'created_at': user.created_at.replace(tzinfo=timezone.utc) if user.created_at and user.created_at.tzinfo is None else user.created_at,
                     'last_activity': last_activity,
-                    'entries_count': entries_count,
+                    'entries_count': entries_count or 0,
                     'daily_calorie_goal': user.daily_calorie_goal,
                     'weight': user.weight,
-                    'height': user.height
+                    'height': user.height,
+                    'age': user.age,
+                    'gender': user.gender
                 })
             
             return users_summary
-        finally:
-            db.close()
-
+    
+    @staticmethod
+    def export_users_csv(buffer) -> int:
+        """Записать CSV-выгрузку пользователей (UTF-8) в байтовый буфер
+        
+        В PostgreSQL строки формирует сервер через COPY ... TO STDOUT, в SQLite -
+        csv.writer по get_all_users_summary. Возвращает количество пользователей.
+        """
+        if IS_POSTGRES:
+            connection = engine.raw_connection()
+            try:
+                cursor = connection.cursor()
+                cursor.copy_expert(_USERS_EXPORT_COPY_SQL, buffer)
+                return cursor.rowcount
+            finally:
+                connection.close()
+        
+        users = DatabaseManager.get_all_users_summary()
+        csv_text = io.TextIOWrapper(buffer, encoding='utf-8', newline='', write_through=True)
+        writer = csv.writer(csv_text)
+        writer.writerow(USERS_EXPORT_HEADER)
+        for user_info in users:
+            writer.writerow([
+                user_info['telegram_id'],
+                user_info['name'],
+                user_info['username'] or '',
+                user_info['created_at'].strftime('%Y-%m-%d %H:%M:%S') if user_info['created_at'] else '',
+                user_info['last_activity'].strftime('%Y-%m-%d %H:%M:%S') if user_info['last_activity'] else '',
+                user_info['entries_count'],
+                user_info['daily_calorie_goal'],
+                user_info['weight'] or '',
+                user_info['height'] or '',
+                user_info['age'] or '',
+                user_info['gender'] or ''
+            ])
+        # detach - чтобы обертка не закрыла буфер вызывающего кода
+        csv_text.detach()
+        return len(users)
+    
     @staticmethod
     def get_user_detailed_info(telegram_id: int):
         """Получить детальную информацию о пользователе для админа"""
-        db = SessionLocal()
-        try:
+        with session_scope() as db:
             user = db.query(User).filter(User.telegram_id == telegram_id).first()
             if not user:
                 return None
@@ -966,167 +1406,150 @@ class DatabaseManager:
                     for entry in recent_entries
                 ]
             }
-        finally:
-            db.close()
     
     @staticmethod
     def complete_onboarding(telegram_id: int, weight: float, height: float, age: int, gender: str, activity_level: str, weight_goal: str = 'maintain', timezone_str: str = 'UTC'):
         """Завершить онбординг пользователя и рассчитать персональную норму калорий"""
         import logging
         logger = logging.getLogger(__name__)
-        db = SessionLocal()
-        
-        try:
-            logger.info(f"🚀 НАЧИНАЕМ ОНБОРДИНГ для пользователя {telegram_id}")
-            logger.info(f"📊 Входные данные: вес={weight}кг, рост={height}см, возраст={age}лет, пол={gender}, активность={activity_level}")
+        with session_scope() as db:
+            try:
+                logger.info(f"🚀 НАЧИНАЕМ ОНБОРДИНГ для пользователя {telegram_id}")
+                logger.info(f"📊 Входные данные: вес={weight}кг, рост={height}см, возраст={age}лет, пол={gender}, активность={activity_level}")
             
-            # Подробная диагностика поиска пользователя
-            logger.info(f"🔍 Ищем пользователя {telegram_id} в базе данных...")
-            user = db.query(User).filter(User.telegram_id == telegram_id).first()
+                # Подробная диагностика поиска пользователя
+                logger.info(f"🔍 Ищем пользователя {telegram_id} в базе данных...")
+                user = db.query(User).filter(User.telegram_id == telegram_id).first()
             
-            if not user:
-                logger.error(f"❌ Пользователь {telegram_id} НЕ НАЙДЕН в базе данных!")
-                logger.info(f"🔄 Возможно пользователь был создан как временный - попробуем создать заново")
+                if not user:
+                    logger.error(f"❌ Пользователь {telegram_id} НЕ НАЙДЕН в базе данных!")
+                    logger.info(f"🔄 Возможно пользователь был создан как временный - попробуем создать заново")
                 
-                try:
-                    # Пытаемся создать пользователя заново (после миграции это должно сработать)
-                    logger.info(f"🆕 СОЗДАЕМ ПОЛЬЗОВАТЕЛЯ ЗАНОВО после миграции: {telegram_id}")
-                    user = User(
-                        telegram_id=telegram_id,
-                        username=None,  # Мы не имеем эти данные в контексте onboarding
-                        first_name=None,
-                        last_name=None,
-                        daily_calorie_goal=2000
-                    )
-                    db.add(user)
-                    db.commit()
-                    db.refresh(user)
-                    logger.info(f"✅ ПОЛЬЗОВАТЕЛЬ УСПЕШНО СОЗДАН: ID={user.id}, telegram_id={user.telegram_id}")
+                    try:
+                        # Пытаемся создать пользователя заново (после миграции это должно сработать)
+                        logger.info(f"🆕 СОЗДАЕМ ПОЛЬЗОВАТЕЛЯ ЗАНОВО после миграции: {telegram_id}")
+                        user = User(
+                            telegram_id=telegram_id,
+                            username=None,  # Мы не имеем эти данные в контексте onboarding
+                            first_name=None,
+                            last_name=None,
+                            daily_calorie_goal=2000
+                        )
+                        db.add(user)
+                        db.commit()
+                        db.refresh(user)
+                        logger.info(f"✅ ПОЛЬЗОВАТЕЛЬ УСПЕШНО СОЗДАН: ID={user.id}, telegram_id={user.telegram_id}")
                     
-                except Exception as create_error:
-                    logger.error(f"❌ НЕ УДАЛОСЬ создать пользователя заново: {create_error}")
-                    db.rollback()  # Откатываем транзакцию после ошибки
+                    except Exception as create_error:
+                        logger.error(f"❌ НЕ УДАЛОСЬ создать пользователя заново: {create_error}")
+                        db.rollback()  # Откатываем транзакцию после ошибки
                     
-                    # Создаем новую сессию для дальнейшей работы
-                    try:
-                        fresh_db = SessionLocal()
-                        logger.info(f"📋 Проверим всех пользователей в БД:")
-                        all_users = fresh_db.query(User).all()
-                        for u in all_users[:5]:  # Показать первых 5
-                            logger.info(f"   📝 Найден пользователь: telegram_id={u.telegram_id}, имя={u.first_name}")
-                        if len(all_users) > 5:
-                            logger.info(f"   📝 ... и еще {len(all_users) - 5} пользователей")
-                        fresh_db.close()
-                    except Exception as list_error:
-                        logger.error(f"❌ Ошибка при получении списка пользователей: {list_error}")
+                        # Создаем новую сессию для дальнейшей работы
+                        try:
+                            with session_scope() as fresh_db:
+                                logger.info(f"📋 Проверим всех пользователей в БД:")
+                                all_users = fresh_db.query(User).all()
+                                for u in all_users[:5]:  # Показать первых 5
+                                    logger.info(f"   📝 Найден пользователь: telegram_id={u.telegram_id}, имя={u.first_name}")
+                                if len(all_users) > 5:
+                                    logger.info(f"   📝 ... и еще {len(all_users) - 5} пользователей")
+                        except Exception as list_error:
+                            logger.error(f"❌ Ошибка при получении списка пользователей: {list_error}")
                     
-                    return False
+                        return False
             
-            logger.info(f"✅ Пользователь НАЙДЕН: ID={user.id}, telegram_id={user.telegram_id}, имя={user.first_name}")
-            logger.info(f"🔍 Тип объекта пользователя: {type(user).__name__}")
-            logger.info(f"🔍 Модуль объекта: {type(user).__module__}")
+                logger.info(f"✅ Пользователь НАЙДЕН: ID={user.id}, telegram_id={user.telegram_id}, имя={user.first_name}")
+                logger.info(f"🔍 Тип объекта пользователя: {type(user).__name__}")
+                logger.info(f"🔍 Модуль объекта: {type(user).__module__}")
             
-            # Проверяем, является ли это настоящим пользователем из БД
-            if not hasattr(user, 'id'):
-                logger.error(f"❌ У пользователя {telegram_id} НЕТ АТРИБУТА 'id'!")
-                logger.info(f"🔍 Доступные атрибуты: {[attr for attr in dir(user) if not attr.startswith('_')]}")
-                return False
+                # Проверяем, является ли это настоящим пользователем из БД
+                if not hasattr(user, 'id'):
+                    logger.error(f"❌ У пользователя {telegram_id} НЕТ АТРИБУТА 'id'!")
+                    logger.info(f"🔍 Доступные атрибуты: {[attr for attr in dir(user) if not attr.startswith('_')]}")
+                    return False
                 
-            if user.id is None:
-                logger.error(f"❌ Пользователь {telegram_id} имеет id=None (временный пользователь)")
-                return False
+                if user.id is None:
+                    logger.error(f"❌ Пользователь {telegram_id} имеет id=None (временный пользователь)")
+                    return False
             
-            logger.info(f"✅ Пользователь ВАЛИДЕН для сохранения: ID={user.id}")
+                logger.info(f"✅ Пользователь ВАЛИДЕН для сохранения: ID={user.id}")
             
-            # Обновляем данные пользователя  
-            logger.info(f"📝 ОБНОВЛЯЕМ ДАННЫЕ пользователя {telegram_id}")
-            logger.info(f"🔍 Текущие данные ДО обновления: weight={user.weight}, height={user.height}, age={user.age}, gender={user.gender}, activity_level={user.activity_level}")
+                # Обновляем данные пользователя  
+                logger.info(f"📝 ОБНОВЛЯЕМ ДАННЫЕ пользователя {telegram_id}")
+                logger.info(f"🔍 Текущие данные ДО обновления: weight={user.weight}, height={user.height}, age={user.age}, gender={user.gender}, activity_level={user.activity_level}")
             
-            try:
-                user.weight = float(weight)
-                user.height = float(height) 
-                user.age = int(age)
-                user.gender = str(gender).lower()
-                user.activity_level = str(activity_level)
-                user.weight_goal = str(weight_goal).lower()
-                user.timezone = str(timezone_str)
-                logger.info(f"✅ Данные УСПЕШНО установлены: weight={user.weight}, height={user.height}, age={user.age}, gender={user.gender}, activity_level={user.activity_level}, weight_goal={user.weight_goal}, timezone={user.timezone}")
-            except Exception as set_error:
-                logger.error(f"❌ ОШИБКА при установке данных: {set_error}")
-                raise set_error
-            
-            # Проверяем что данные реально изменились
-            logger.info(f"🔍 Проверяем изменения в объекте пользователя...")
-            logger.info(f"   📊 user.weight: {user.weight} (тип: {type(user.weight)})")
-            logger.info(f"   📊 user.height: {user.height} (тип: {type(user.height)})")
-            logger.info(f"   📊 user.age: {user.age} (тип: {type(user.age)})")
-            logger.info(f"   📊 user.gender: {user.gender} (тип: {type(user.gender)})")
-            logger.info(f"   📊 user.activity_level: {user.activity_level} (тип: {type(user.activity_level)})")
-            logger.info(f"   📊 user.weight_goal: {user.weight_goal} (тип: {type(user.weight_goal)})")
-            
-            # Рассчитываем персональную норму калорий
-            logger.info(f"🧮 РАССЧИТЫВАЕМ дневную норму калорий для пользователя {telegram_id}")
-            try:
-                calculated_goal = user.calculate_daily_calorie_goal()
-                logger.info(f"✅ УСПЕШНО рассчитана норма калорий: {calculated_goal}")
-                user.daily_calorie_goal = calculated_goal
-                logger.info(f"✅ УСТАНОВЛЕНА цель калорий: {user.daily_calorie_goal}")
-            except Exception as calc_error:
-                logger.error(f"❌ ОШИБКА при расчете калорий: {calc_error}")
-                logger.error(f"❌ Тип ошибки: {type(calc_error).__name__}")
-                import traceback
-                logger.error(f"❌ Полный traceback: {traceback.format_exc()}")
-                # Устанавливаем значение по умолчанию
-                user.daily_calorie_goal = 2000
-                logger.info(f"⚠️ Установлена норма калорий по умолчанию: {user.daily_calorie_goal}")
-            
-            # Проверяем что объект готов к сохранению
-            logger.info(f"🔍 ПРОВЕРЯЕМ готовность к сохранению:")
-            logger.info(f"   📝 user.id: {user.id}")
-            logger.info(f"   📝 user.telegram_id: {user.telegram_id}")
-            logger.info(f"   📝 user.daily_calorie_goal: {user.daily_calorie_goal}")
-            logger.info(f"   📝 Все основные поля заполнены: {bool(user.weight and user.height and user.age and user.gender and user.weight_goal)}")
-            
-            logger.info(f"💾 СОХРАНЯЕМ изменения в базу данных для пользователя {telegram_id}")
-            try:
-                db.commit()
-                logger.info(f"✅ COMMIT УСПЕШЕН! Изменения сохранены в БД")
+                try:
+                    user.weight = float(weight)
+                    user.height = float(height) 
+                    user.age = int(age)
+                    user.gender = str(gender).lower()
+                    user.activity_level = str(activity_level)
+                    user.weight_goal = str(weight_goal).lower()
+                    user.timezone = str(timezone_str)
+                    logger.info(f"✅ Данные УСПЕШНО установлены: weight={user.weight}, height={user.height}, age={user.age}, gender={user.gender}, activity_level={user.activity_level}, weight_goal={user.weight_goal}, timezone={user.timezone}")
+                except Exception as set_error:
+                    logger.error(f"❌ ОШИБКА при установке данных: {set_error}")
+                    raise set_error
+            
+                # Проверяем что данные реально изменились
+                logger.info(f"🔍 Проверяем изменения в объекте пользователя...")
+                logger.info(f"   📊 user.weight: {user.weight} (тип: {type(user.weight)})")
+                logger.info(f"   📊 user.height: {user.height} (тип: {type(user.height)})")
+                logger.info(f"   📊 user.age: {user.age} (тип: {type(user.age)})")
+                logger.info(f"   📊 user.gender: {user.gender} (тип: {type(user.gender)})")
+                logger.info(f"   📊 user.activity_level: {user.activity_level} (тип: {type(user.activity_level)})")
+                logger.info(f"   📊 user.weight_goal: {user.weight_goal} (тип: {type(user.weight_goal)})")
+            
+                # Рассчитываем персональную норму калорий
+                logger.info(f"🧮 РАССЧИТЫВАЕМ дневную норму калорий для пользователя {telegram_id}")
+                try:
+                    calculated_goal = user.calculate_daily_calorie_goal()
+                    logger.info(f"✅ УСПЕШНО рассчитана норма калорий: {calculated_goal}")
+                    user.daily_calorie_goal = calculated_goal
+                    logger.info(f"✅ УСТАНОВЛЕНА цель калорий: {user.daily_calorie_goal}")
+                except Exception as calc_error:
+                    logger.exception(f"❌ ОШИБКА при расчете калорий: {calc_error}")
+                    # Устанавливаем значение по умолчанию
+                    user.daily_calorie_goal = 2000
+                    logger.info(f"⚠️ Установлена норма калорий по умолчанию: {user.daily_calorie_goal}")
+            
+                # Проверяем что объект готов к сохранению
+                logger.info(f"🔍 ПРОВЕРЯЕМ готовность к сохранению:")
+                logger.info(f"   📝 user.id: {user.id}")
+                logger.info(f"   📝 user.telegram_id: {user.telegram_id}")
+                logger.info(f"   📝 user.daily_calorie_goal: {user.daily_calorie_goal}")
+                logger.info(f"   📝 Все основные поля заполнены: {bool(user.weight and user.height and user.age and user.gender and user.weight_goal)}")
+            
+                logger.info(f"💾 СОХРАНЯЕМ изменения в базу данных для пользователя {telegram_id}")
+                try:
+                    db.commit()
+                    profile_cache.invalidate(user.id)
+                    user_cache.invalidate(telegram_id)
+                    logger.info(f"✅ COMMIT УСПЕШЕН! Изменения сохранены в БД")
                 
-                # Проверяем что данные реально сохранились  
-                logger.info(f"🔍 ПРОВЕРЯЕМ сохранение: перезагружаем пользователя из БД...")
-                db.refresh(user)
-                logger.info(f"✅ Данные после перезагрузки: weight={user.weight}, height={user.height}, age={user.age}, daily_calorie_goal={user.daily_calorie_goal}")
+                    # Проверяем что данные реально сохранились  
+                    logger.info(f"🔍 ПРОВЕРЯЕМ сохранение: перезагружаем пользователя из БД...")
+                    db.refresh(user)
+                    logger.info(f"✅ Данные после перезагрузки: weight={user.weight}, height={user.height}, age={user.age}, daily_calorie_goal={user.daily_calorie_goal}")
                 
-            except Exception as commit_error:
-                logger.error(f"❌ ОШИБКА при сохранении в БД: {commit_error}")
-                logger.error(f"❌ Тип ошибки: {type(commit_error).__name__}")
-                import traceback
-                logger.error(f"❌ Полный traceback: {traceback.format_exc()}")
-                raise commit_error
-            
-            logger.info(f"🎉 ОНБОРДИНГ ПОЛНОСТЬЮ ЗАВЕРШЕН для пользователя {telegram_id}. Цель калорий: {user.daily_calorie_goal}")
-            return user.daily_calorie_goal
-            
-        except Exception as e:
-            logger.error(f"Критическая ошибка при завершении онбординга для {telegram_id}: {e}")
-            logger.error(f"Тип ошибки: {type(e).__name__}")
-            import traceback
-            logger.error(f"Полный traceback: {traceback.format_exc()}")
-            db.rollback()
-            return False
-        finally:
-            db.close()
-
+                except Exception as commit_error:
+                    logger.exception(f"❌ ОШИБКА при сохранении в БД: {commit_error}")
+                    raise commit_error
+            
+                logger.info(f"🎉 ОНБОРДИНГ ПОЛНОСТЬЮ ЗАВЕРШЕН для пользователя {telegram_id}. Цель калорий: {user.daily_calorie_goal}")
+                return user.daily_calorie_goal
+            
+            except Exception as e:
+                logger.exception(f"Критическая ошибка при завершении онбординга для {telegram_id}: {e}")
+                db.rollback()
+                return False
+    
     @staticmethod 
     def is_onboarding_completed(telegram_id: int) -> bool:
         """Проверить завершен ли онбординг у пользователя"""
-        db = SessionLocal()
-        try:
+        with session_scope() as db:
             user = db.query(User).filter(User.telegram_id == telegram_id).first()
             if not user:
                 return False
             
-            # Считаем что пользователь прошел онбординг если у него есть основные данные
-            return bool(user.weight and user.height and user.age and user.gender and user.weight_goal)
-        finally:
-            db.close()
+            return has_completed_onboarding(user)
\ No newline at end of file
@@ -3,11 +3,15 @@ Webhook сервер для телеграм-бота (для продакшен
 """
 import asyncio
 import logging
+import orjson
 from aiohttp import web, web_request
 from telegram import Update
 from telegram.ext import Application
 import config
-from bot import CalorieBotHandlers
+from bot import (
+    CalorieBotHandlers, build_rate_limiter, build_request, close_shared_clients,
+    install_event_loop_policy, setup_db_executor
+)
 from database import create_tables
 
 # Настройка логирования
@@ -31,7 +35,13 @@ class WebhookServer:
         logger.info("База данных инициализирована")
         
         # Создаем приложение
-        self.application = Application.builder().token(config.TELEGRAM_BOT_TOKEN).build()
+        self.application = (
+            Application.builder()
+            .token(config.TELEGRAM_BOT_TOKEN)
+            .request(build_request())
+            .rate_limiter(build_rate_limiter())
+            .build()
+        )
         
         # Регистрируем обработчики
         from telegram.ext import CommandHandler, MessageHandler, CallbackQueryHandler, filters
@@ -54,7 +64,7 @@ class WebhookServer:
         """Обработчик webhook запросов"""
         try:
             # Получаем данные из запроса
-            data = await request.json()
+            data = orjson.loads(await request.read())
             
             # Создаем объект Update
             update = Update.de_json(data, self.application.bot)
@@ -100,6 +110,13 @@ class WebhookServer:
         app.router.add_get('/health', self.health_check)
         app.router.add_get('/', self.health_check)
         
+        # Синхронные запросы к БД выполняются в выделенном пуле потоков - пул ставится
+        # на цикл событий, который создает run_app и на котором обслуживаются запросы
+        app.on_startup.append(setup_db_executor)
+        
+        # Закрываем общие клиенты бота (HTTP, Redis) при остановке сервера
+        app.on_cleanup.append(close_shared_clients)
+        
         return app
 
 async def init_app():
@@ -123,6 +140,7 @@ def main():
         return
     
     # Создаем и запускаем сервер
+    install_event_loop_policy()
     app = asyncio.get_event_loop().run_until_complete(init_app())
     
     logger.info(f"Запускаем webhook сервер на {config.HOST}:{config.PORT}")